@@ -0,0 +1,200 @@
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+TOPICS_FIELD = "249a3c3d-b3f7-45ea-961e-442bcb9c85ed"
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Bulk scraping opens many connections at once, default backlog of 5 would delay them
+    request_queue_size = 256
+
+
+class StubAnnotatorServer:
+    """
+    Local stand-in for the annotation API, used to try out and measure scraping without credentials.
+    Serves login and token renewal, `/api/task/results` with generated annotation results and
+    `/api/task/task_instance/{id}` with texts of annotated task instances. Pass `base_url` to `Annotator_API`.
+
+    Each request waits `latency` seconds. Every annotated text has `annotations_per_text` results,
+    `rejected_ratio` of results are rejected. Login is kept in a cookie, which expires after `token_requests`
+    requests and then has to be renewed. `error_rate` of requests fail with 503 to exercise client retries.
+    """
+
+    def __init__(self, texts=100, annotations_per_text=2, rejected_ratio=0.1, latency=0.05, port=0, seed=0,
+                 token_requests=None, error_rate=0.0):
+        self.latency = latency
+        self.port = port
+        self.token_requests = token_requests
+        self.error_rate = error_rate
+        self.requests = {}
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.error_rng = random.Random(seed)
+        self.server = None
+        self.thread = None
+
+        rng = random.Random(seed)
+        self.instances = {}
+        self.results = []
+        start = time.mktime((2023, 10, 6, 0, 0, 0, 0, 0, -1))
+        for i in range(texts):
+            instance_id = str(uuid.UUID(int=rng.getrandbits(128)))
+            self.instances[instance_id] = f"Text číslo {i}. " + " ".join(f"slovo{j}" for j in range(rng.randint(5, 50)))
+            for j in range(annotations_per_text):
+                topics = [{"text": f"téma {rng.randint(0, 30)}"} for _ in range(rng.randint(0, 4))]
+                self.results.append(
+                    {
+                        "id": str(uuid.UUID(int=rng.getrandbits(128))),
+                        "user_id": str(uuid.UUID(int=j + 1)),
+                        "annotation_task_instance_id": instance_id,
+                        "result_type": "rejected" if rng.random() < rejected_ratio else "normal",
+                        "result": json.dumps({TOPICS_FIELD: json.dumps(topics, ensure_ascii=False)}),
+                        "created_date": time.strftime(
+                            "%Y-%m-%dT%H:%M:%S", time.localtime(start + 3600 * (i * annotations_per_text + j))
+                        ),
+                    }
+                )
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.server = StubHTTPServer(("127.0.0.1", self.port), self.create_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def new_token(self):
+        with self.lock:
+            token = uuid.uuid4().hex
+            self.tokens[token] = 0
+            return token
+
+    def authorize(self, token):
+        """
+        :return: False when token is unknown or expired
+        """
+        with self.lock:
+            if token not in self.tokens:
+                return False
+            self.tokens[token] += 1
+            return self.token_requests is None or self.tokens[token] <= self.token_requests
+
+    def fails(self):
+        with self.lock:
+            return self.error_rng.random() < self.error_rate
+
+    def select_results(self, query):
+        return [
+            result for result in self.results
+            if query.get("from_date", "") <= result["created_date"][:10] <= query.get("to_date", "9999")
+        ]
+
+    def create_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, Nagle's algorithm would delay the body on kept-alive connections
+            disable_nagle_algorithm = True
+
+            def read_body(self):
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def token(self):
+                cookies = SimpleCookie(self.headers.get("Cookie", ""))
+                return cookies["token"].value if "token" in cookies else None
+
+            def checked(self):
+                """
+                :return: True if request can be served, otherwise error response is sent
+                """
+                if stub.fails():
+                    self.respond(503, {"detail": "Service Unavailable"})
+                    return False
+                if not stub.authorize(self.token()):
+                    self.respond(401, {"detail": "Not authenticated"})
+                    return False
+                return True
+
+            def do_POST(self):
+                body = self.read_body()
+                path = urlparse(self.path).path
+                stub.count(path)
+                time.sleep(stub.latency)
+                if path == "/api/token":
+                    self.respond(200, {"token_type": "cookie"}, token=stub.new_token())
+                elif path == "/api/token/renew":
+                    if self.token() in stub.tokens:
+                        self.respond(200, {"token_type": "cookie"}, token=stub.new_token())
+                    else:
+                        self.respond(401, {"detail": "Not authenticated"})
+                elif path == "/api/task/results":
+                    if self.checked():
+                        self.respond(200, stub.select_results(json.loads(body or b"{}")))
+                else:
+                    self.respond(404, {"detail": "Not Found"})
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                prefix = "/api/task/task_instance/"
+                stub.count(prefix if path.startswith(prefix) else path)
+                time.sleep(stub.latency)
+                if not self.checked():
+                    return
+                instance_id = path[len(prefix):]
+                if path.startswith(prefix) and instance_id in stub.instances:
+                    self.respond(200, {"id": instance_id, "text": stub.instances[instance_id]})
+                else:
+                    self.respond(404, {"detail": "Not Found"})
+
+            def respond(self, status, payload, token=None):
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                if token is not None:
+                    self.send_header("Set-Cookie", f"token={token}; Path=/")
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs local stub of the annotation API until interrupted.")
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--texts", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.05, help="Latency of one response in seconds.")
+    parser.add_argument("--token-requests", type=int, default=None, help="Number of requests after which login expires.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Ratio of requests failing with 503.")
+    args = parser.parse_args()
+
+    with StubAnnotatorServer(texts=args.texts, latency=args.latency, port=args.port,
+                             token_requests=args.token_requests, error_rate=args.error_rate) as stub:
+        print(f"Annotation API stub listening on {stub.base_url}, press Ctrl+C to stop.")
+        try:
+            stub.thread.join()
+        except KeyboardInterrupt:
+            pass
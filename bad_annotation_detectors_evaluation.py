@@ -1,4 +1,12 @@
+import argparse
 import json
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+THRESHOLD = 0.4
 
 
 def print_results(name, true_positive, true_negative, false_negative, false_positive):
@@ -11,188 +19,401 @@ def print_results(name, true_positive, true_negative, false_negative, false_posi
     )
 
 
-class Detector:
-    def evaluate_annotations(self):
-        raise NotImplementedError("Subclasses must implement this method")
-
-
-class ModeledTopicsDetector(Detector):
-    MLM_THRESHOLD = 0.4
-    CE1TO1_THRESHOLD = 0.4
-    CE_THRESHOLD = 0.4
-
-    def evaluate_annotations(self, data, golden_data):
-        mlm_false_positive = 0
-        mlm_false_negative = 0
-        mlm_true_positive = 0
-        mlm_true_negative = 0
-        ce1to1_false_positive = 0
-        ce1to1_false_negative = 0
-        ce1to1_true_positive = 0
-        ce1to1_true_negative = 0
-        ce_false_positive = 0
-        ce_false_negative = 0
-        ce_true_positive = 0
-        ce_true_negative = 0
-
-        for text in golden_data:
-            ce_scores = data[text]["scoring"]["ce_scores"]
-            ce_scores_1to1 = data[text]["scoring"]["ce_scores_1to1"]
-            mlm_scores_1to1 = data[text]["scoring"]["mlm_scores_1to1"]
-
-            # mlm_scores_1to1
-            for t in mlm_scores_1to1:
-                max_score = -1
-                topic = t[0]["from"]
-                label = golden_data[text][topic]
-                for s in t:
-                    if s["score"] > max_score:
-                        max_score = s["score"]
-
-                if max_score >= self.MLM_THRESHOLD and label == 0:
-                    ce1to1_true_negative += 1
-                elif max_score >= self.MLM_THRESHOLD and label == 1:
-                    ce1to1_false_negative += 1
-                elif max_score < self.MLM_THRESHOLD and label == 0:
-                    ce1to1_false_positive += 1
-                elif max_score < self.MLM_THRESHOLD and label == 1:
-                    ce1to1_true_positive += 1
-
-            # ce_scores_1to1
-            for t in ce_scores_1to1:
-                max_score = -1
-                topic = t[0]["from"]
-                label = golden_data[text][topic]
-                for s in t:
-                    if s["score"] > max_score:
-                        max_score = s["score"]
-
-                if max_score >= self.CE1TO1_THRESHOLD and label == 0:
-                    ce_true_negative += 1
-                elif max_score >= self.CE1TO1_THRESHOLD and label == 1:
-                    ce_false_negative += 1
-                elif max_score < self.CE1TO1_THRESHOLD and label == 0:
-                    ce_false_positive += 1
-                elif max_score < self.CE1TO1_THRESHOLD and label == 1:
-                    ce_true_positive += 1
-
-            for t in ce_scores:
-                topic = t["to"]
-                score = t["score"]
-                label = golden_data[text][topic]
-
-                if score >= self.CE_THRESHOLD and label == 0:
-                    mlm_true_negative += 1
-                elif score >= self.CE_THRESHOLD and label == 1:
-                    mlm_false_negative += 1
-                elif score < self.CE_THRESHOLD and label == 0:
-                    mlm_false_positive += 1
-                elif score < self.CE_THRESHOLD and label == 1:
-                    mlm_true_positive += 1
-
-        print_results(
-            "MLM + Modeled Topics",
-            mlm_true_positive,
-            mlm_true_negative,
-            mlm_false_negative,
-            mlm_false_positive,
-        )
-        print_results(
-            "CE 1to1 + Modeled Topics",
-            ce1to1_true_positive,
-            ce1to1_true_negative,
-            ce1to1_false_negative,
-            ce1to1_false_positive,
-        )
-        print_results(
-            "CE + Modeled Topics",
-            ce_true_positive,
-            ce_true_negative,
-            ce_false_negative,
-            ce_false_positive,
-        )
+def confusion_at(scores, labels, threshold):
+    """
+    Computes confusion matrix for one threshold. Bad annotations (label 1) are positives
+    and a topic is detected as bad when its score is below the threshold.
+    :return: Tuple (true_positive, true_negative, false_negative, false_positive)
+    """
+    detected = scores < threshold
+    bad = labels == 1
+    true_positive = int(np.sum(detected & bad))
+    true_negative = int(np.sum(~detected & ~bad))
+    false_negative = int(np.sum(~detected & bad))
+    false_positive = int(np.sum(detected & ~bad))
+    return true_positive, true_negative, false_negative, false_positive
 
 
-class MLMCosineSimilarityDetector(Detector):
-    THRESHOLD = 0.4
-
-    def evaluate_annotations(self, data):
-        true_positive = 0
-        true_negative = 0
-        false_negative = 0
-        false_positive = 0
-        for text in data:
-            for topic in data[text]:
-                _, score, target = topic.values()
-                if score >= self.THRESHOLD and target == 0:
-                    true_negative += 1
-                elif score >= self.THRESHOLD and target == 1:
-                    false_negative += 1
-                elif score < self.THRESHOLD and target == 0:
-                    false_positive += 1
-                elif score < self.THRESHOLD and target == 1:
-                    true_positive += 1
-
-        print_results(
-            "MLM Cosine Similarity",
-            true_positive,
-            true_negative,
-            false_negative,
-            false_positive,
-        )
+def threshold_sweep(scores, labels, weights=None):
+    """
+    Computes confusion counts for every distinct threshold at once. Scores are sorted and
+    the number of bad annotations below each threshold is read from a cumulative sum.
+    :param scores: Array of detector scores, lower score means more likely bad annotation
+    :param labels: Array of gold labels, 1 for bad annotation, 0 for good one
+    :param weights: Optional array of item counts, either with shape of `scores` or with
+        shape (resamples, len(scores)) to sweep many bootstrap resamples at once
+    :return: Dict with arrays `thresholds`, `true_positive`, `true_negative`,
+        `false_negative`, `false_positive`, `fpr`, `fnr` and `tpr`; counts and rates
+        have an extra leading axis when 2D weights are given
+    """
+    if weights is None:
+        weights = np.ones(len(scores), dtype=int)
+    order = np.argsort(scores, kind="stable")
+    sorted_scores = scores[order]
+    sorted_weights = weights[..., order]
 
+    # Texts with score strictly lower than threshold are detected, so every distinct
+    # score is a candidate threshold, plus infinity which detects everything.
+    thresholds = np.append(np.unique(sorted_scores), np.inf)
+    detected_index = np.searchsorted(sorted_scores, thresholds, side="left")
 
-class DirectScoreDetector(Detector):
-    THRESHOLD = 0.4
-
-    def evaluate_annotations(self, data):
-        true_positive = 0
-        true_negative = 0
-        false_negative = 0
-        false_positive = 0
-        for text in data:
-            for topic in data[text]:
-                _, score, target = topic.values()
-                if score >= self.THRESHOLD and target == 0:
-                    true_negative += 1
-                elif score >= self.THRESHOLD and target == 1:
-                    false_negative += 1
-                elif score < self.THRESHOLD and target == 0:
-                    false_positive += 1
-                elif score < self.THRESHOLD and target == 1:
-                    true_positive += 1
-
-        print_results(
-            "Direct Score",
-            true_positive,
-            true_negative,
-            false_negative,
-            false_positive,
-        )
+    leading_zeros = np.zeros(sorted_weights.shape[:-1] + (1,), dtype=sorted_weights.dtype)
+    cumulative_bad = np.concatenate((leading_zeros, np.cumsum(sorted_weights * labels[order], axis=-1)), axis=-1)
+    cumulative_all = np.concatenate((leading_zeros, np.cumsum(sorted_weights, axis=-1)), axis=-1)
 
+    positives = cumulative_bad[..., -1:]
+    negatives = cumulative_all[..., -1:] - positives
 
-if __name__ == "__main__":
-    golden_data = json.load(open("data/gold_annotated_dataset.json", "r"))
-    golden_data = {entry["text"]: entry["topics"] for entry in golden_data.values()}
+    true_positive = cumulative_bad[..., detected_index]
+    false_positive = cumulative_all[..., detected_index] - true_positive
+    false_negative = positives - true_positive
+    true_negative = negatives - false_positive
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fpr = false_positive / negatives
+        fnr = false_negative / positives
+
+    return {
+        "thresholds": thresholds,
+        "true_positive": true_positive,
+        "true_negative": true_negative,
+        "false_negative": false_negative,
+        "false_positive": false_positive,
+        "fpr": fpr,
+        "fnr": fnr,
+        "tpr": 1 - fnr,
+    }
+
+
+def equal_error_rate(fpr, fnr):
+    """
+    Finds the point where false positive rate equals false negative rate. FPR grows and FNR
+    falls with threshold, so the crossing is interpolated between the two neighbouring points.
+    Rates with shape (resamples, thresholds) give one EER per resample.
+    """
+    difference = fpr - fnr
+    crossing = np.argmax(difference >= 0, axis=-1)[..., None]
+    previous = np.maximum(crossing - 1, 0)
+
+    d0 = np.take_along_axis(difference, previous, axis=-1)
+    d1 = np.take_along_axis(difference, crossing, axis=-1)
+    fpr0 = np.take_along_axis(fpr, previous, axis=-1)
+    fpr1 = np.take_along_axis(fpr, crossing, axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(d0 != d1, d0 / (d0 - d1), 0.0)
+    eer = fpr0 + ratio * (fpr1 - fpr0)
+
+    # Crossing already at the lowest threshold, there is no previous point to interpolate from
+    at_start = crossing == 0
+    fnr0 = np.take_along_axis(fnr, crossing, axis=-1)
+    eer = np.where(at_start, (fpr0 + fnr0) / 2, eer)[..., 0]
+    return float(eer) if eer.ndim == 0 else eer
+
+
+def bootstrap_counts(n, resamples, rng):
+    """
+    Draws bootstrap resamples as an index matrix and converts it to a matrix of counts,
+    how many times each item occurs in each resample.
+    :return: Integer array with shape (resamples, n)
+    """
+    indices = rng.integers(0, n, size=(resamples, n))
+    flat = indices + np.arange(resamples)[:, None] * n
+    return np.bincount(flat.ravel(), minlength=resamples * n).reshape(resamples, n)
+
+
+def bootstrap_intervals(scores, labels, threshold, resamples=2000, confidence=0.95, rng=None):
+    """
+    Computes bootstrap confidence intervals of precision and recall at given threshold and
+    of equal error rate. All resamples are evaluated together with NumPy.
+    :return: Dict which maps metric name to dict with `value` on full data, `low` and `high`
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    counts = bootstrap_counts(len(scores), resamples, rng)
+
+    detected = scores < threshold
+    bad = labels == 1
+    true_positive = counts[:, detected & bad].sum(axis=1)
+    false_positive = counts[:, detected & ~bad].sum(axis=1)
+    false_negative = counts[:, ~detected & bad].sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = true_positive / (true_positive + false_positive)
+        recall = true_positive / (true_positive + false_negative)
+
+    sweep = threshold_sweep(scores, labels, counts)
+    eer = equal_error_rate(sweep["fpr"], sweep["fnr"])
 
-    data_modeled_topics = json.load(open("evaluation-data/out-eval-golden.json", "r"))
-    data_modeled_topics = {
-        item["text"]: {k: v for k, v in item.items() if k != "text"}
-        for item in data_modeled_topics
+    tp, _, fn, fp = confusion_at(scores, labels, threshold)
+    full_data = {
+        "precision": tp / (tp + fp) if tp + fp else float("nan"),
+        "recall": tp / (tp + fn) if tp + fn else float("nan"),
+        "eer": evaluate_curve(scores, labels)["eer"],
     }
-    modeled_detector = ModeledTopicsDetector()
-    modeled_detector.evaluate_annotations(data_modeled_topics, golden_data=golden_data)
 
-    data_mlm_cosine_similarity = json.load(
-        open("evaluation-data/out_mlm_cos_similarity_scores.json", "r")
+    alpha = (1 - confidence) / 2
+    intervals = {}
+    for name, values in (("precision", precision), ("recall", recall), ("eer", eer)):
+        low, high = np.nanquantile(values, [alpha, 1 - alpha])
+        intervals[name] = {"value": full_data[name], "low": float(low), "high": float(high)}
+    return intervals
+
+
+def evaluate_curve(scores, labels):
+    """
+    Computes DET/ROC curve, equal error rate and the best threshold, which minimizes
+    mean of FPR and FNR (same criterion as in `notebooks/DET-ectors.ipynb`).
+    """
+    sweep = threshold_sweep(scores, labels)
+    cdet = (sweep["fpr"] + sweep["fnr"]) / 2
+    best = int(np.argmin(cdet))
+    sweep["eer"] = equal_error_rate(sweep["fpr"], sweep["fnr"])
+    sweep["best_threshold"] = float(sweep["thresholds"][best])
+    sweep["min_cdet"] = float(cdet[best])
+    sweep["best_fpr"] = float(sweep["fpr"][best])
+    sweep["best_fnr"] = float(sweep["fnr"][best])
+    return sweep
+
+
+GOLD_DATASET = "data/gold_annotated_dataset.json"
+
+DetectorEntry = namedtuple("DetectorEntry", ["name", "source", "extract"])
+
+DETECTORS = {}
+
+
+def register_detector(name, source, extract):
+    """
+    Registers a detector of bad annotations.
+    :param name: Name of the detector used in printed results and as a column of score table
+    :param source: Path to json file with scores, each source is loaded only once for all detectors
+    :param extract: Function which takes loaded source and yields tuples (text_id, topic, score)
+    """
+    DETECTORS[name] = DetectorEntry(name, source, extract)
+
+
+def modeled_topics_1to1_scores(scoring_key):
+    def extract(data):
+        for item in data:
+            # Annotator topic is scored by its best match among generated topics
+            for t in item["scoring"][scoring_key]:
+                yield item["text-id"], t[0]["from"], max(s["score"] for s in t)
+
+    return extract
+
+
+def modeled_topics_scores(data):
+    for item in data:
+        for t in item["scoring"]["ce_scores"]:
+            yield item["text-id"], t["to"], t["score"]
+
+
+def similarity_scores(data):
+    for text_id, entry in data.items():
+        for topic in entry["scores"]:
+            yield text_id, topic["topic"], topic["similarity"]
+
+
+register_detector(
+    "MLM + Modeled Topics", "evaluation-data/out-eval-golden.json", modeled_topics_1to1_scores("mlm_scores_1to1")
+)
+register_detector(
+    "CE 1to1 + Modeled Topics", "evaluation-data/out-eval-golden.json", modeled_topics_1to1_scores("ce_scores_1to1")
+)
+register_detector("CE + Modeled Topics", "evaluation-data/out-eval-golden.json", modeled_topics_scores)
+register_detector("MLM Cosine Similarity", "evaluation-data/out_mlm_cos_similarity_scores.json", similarity_scores)
+register_detector("Direct Score", "evaluation-data/out-direct-score.json", similarity_scores)
+register_detector("MLM mpnet-base-v2", "evaluation-data/out-mlm-mpnet-base-v2.json", similarity_scores)
+register_detector("MLM LaBSE", "evaluation-data/out-mlm-setu4993LaBSE.json", similarity_scores)
+register_detector(
+    "MLM googlebert-cased", "evaluation-data/out-mlm-multilingual-google-bert-cased.json", similarity_scores
+)
+
+
+def load_json(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def load_sources(paths, max_workers=None):
+    """
+    Loads json files concurrently.
+    :return: Dict which maps path to loaded data
+    """
+    paths = list(dict.fromkeys(paths))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(paths, executor.map(load_json, paths)))
+
+
+def build_score_table(golden_data, detectors, sources):
+    """
+    Creates columnar table of all gold annotated topics indexed by (text_id, topic) with column
+    `label` and one score column per detector. Topics a detector has no score for are NaN.
+    """
+    index = pd.MultiIndex.from_tuples(
+        [(text_id, topic) for text_id, entry in golden_data.items() for topic in entry["topics"]],
+        names=["text_id", "topic"],
     )
-    data_mlm_cosine_similarity = {
-        entry["text"]: entry["scores"] for entry in data_mlm_cosine_similarity.values()
+    labels = [label for entry in golden_data.values() for label in entry["topics"].values()]
+    table = pd.DataFrame({"label": labels}, index=index)
+
+    for detector in detectors:
+        extracted = list(detector.extract(sources[detector.source]))
+        scores = pd.Series(
+            [score for _, _, score in extracted],
+            index=pd.MultiIndex.from_tuples([(text_id, topic) for text_id, topic, _ in extracted]),
+            dtype=float,
+        )
+        scores = scores[~scores.index.duplicated()]
+        table[detector.name] = scores.reindex(table.index).to_numpy()
+    return table
+
+
+def detector_columns(table):
+    """
+    Yields name of each detector with its scores and labels, topics without score are left out.
+    """
+    labels = table["label"].to_numpy()
+    for name in table.columns.drop("label"):
+        scores = table[name].to_numpy()
+        scored = ~np.isnan(scores)
+        yield name, scores[scored], labels[scored]
+
+
+def evaluate_annotations(table, threshold):
+    """
+    Confusion matrices of all detectors at given threshold, computed together for all score columns.
+    """
+    scores = table.drop(columns="label").to_numpy()
+    scored = ~np.isnan(scores)
+    detected = scores < threshold
+    bad = (table["label"].to_numpy() == 1)[:, None]
+
+    true_positive = np.sum(scored & detected & bad, axis=0)
+    true_negative = np.sum(scored & ~detected & ~bad, axis=0)
+    false_negative = np.sum(scored & ~detected & bad, axis=0)
+    false_positive = np.sum(scored & detected & ~bad, axis=0)
+
+    for i, name in enumerate(table.columns.drop("label")):
+        print_results(name, true_positive[i], true_negative[i], false_negative[i], false_positive[i])
+
+
+def evaluate_curves(table):
+    return {name: evaluate_curve(scores, labels) for name, scores, labels in detector_columns(table)}
+
+
+def bootstrap(table, threshold=None, resamples=2000, confidence=0.95, rng=None):
+    """
+    Bootstrap confidence intervals for each detector. When threshold is not given,
+    the best threshold of each detector on the full data is used.
+    """
+    intervals = {}
+    for name, scores, labels in detector_columns(table):
+        detector_threshold = threshold
+        if detector_threshold is None:
+            detector_threshold = evaluate_curve(scores, labels)["best_threshold"]
+        intervals[name] = bootstrap_intervals(scores, labels, detector_threshold, resamples, confidence, rng)
+        intervals[name]["threshold"] = detector_threshold
+    return intervals
+
+
+def curves_to_json(curves):
+    return {
+        name: {
+            key: value.tolist() if isinstance(value, np.ndarray) else value
+            for key, value in curve.items()
+        }
+        for name, curve in curves.items()
     }
-    mlm_detector = MLMCosineSimilarityDetector()
-    mlm_detector.evaluate_annotations(data_mlm_cosine_similarity)
 
-    data_direct = json.load(open("evaluation-data/out-direct-score.json", "r"))
-    data_direct = {entry["text"]: entry["scores"] for entry in data_direct.values()}
-    direct_detector = DirectScoreDetector()
-    direct_detector.evaluate_annotations(data_direct)
+
+def print_curves(curves):
+    for name, curve in curves.items():
+        print(
+            f"{name}: EER={curve['eer']:.3f}, best threshold={curve['best_threshold']:.3f}, "
+            f"minCdet={curve['min_cdet']:.3f}, FPR={curve['best_fpr']:.3f}, FNR={curve['best_fnr']:.3f}"
+        )
+
+
+def print_intervals(intervals, confidence):
+    for name, detector_intervals in intervals.items():
+        print(f"{name} ({confidence:.0%} CI, threshold {detector_intervals['threshold']:.3f}):")
+        for metric in ("precision", "recall", "eer"):
+            interval = detector_intervals[metric]
+            print(f"\t{metric}: {interval['value']:.3f} [{interval['low']:.3f}, {interval['high']:.3f}]")
+
+
+def plot_det(curves, path):
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    for name, curve in curves.items():
+        ax.plot(curve["fpr"], curve["fnr"], linewidth=1.5, label=name)
+    ax.set_xlabel("False Positive Rate")
+    ax.set_ylabel("False Negative Rate")
+    ax.legend()
+    fig.savefig(path)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Evaluation of bad annotation detectors on gold dataset.")
+    parser.add_argument(
+        "--curves-output",
+        default="evaluation-data/detector-curves.json",
+        help="Path to json file with DET/ROC curves, EER and best threshold of each detector.",
+    )
+    parser.add_argument(
+        "--detectors",
+        nargs="+",
+        choices=list(DETECTORS),
+        default=list(DETECTORS),
+        help="Detectors to evaluate. Default are all registered detectors.",
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=THRESHOLD, help="Threshold for printed confusion matrices."
+    )
+    parser.add_argument("--plot", default=None, help="Path to save DET curves plot to.")
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=0,
+        help="Number of bootstrap resamples for confidence intervals of precision, recall and EER. "
+             "Default 0 turns bootstrap off.",
+    )
+    parser.add_argument("--confidence", type=float, default=0.95, help="Confidence level of bootstrap intervals.")
+    parser.add_argument(
+        "--bootstrap-threshold",
+        type=float,
+        default=None,
+        help="Threshold for bootstrapped precision and recall. Default is the best threshold of each detector.",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="Seed for bootstrap resampling.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    detectors = [DETECTORS[name] for name in args.detectors]
+    sources = load_sources([GOLD_DATASET] + [detector.source for detector in detectors])
+    table = build_score_table(sources[GOLD_DATASET], detectors, sources)
+
+    evaluate_annotations(table, args.threshold)
+
+    curves = evaluate_curves(table)
+    print_curves(curves)
+
+    with open(args.curves_output, "w") as f:
+        json.dump(curves_to_json(curves), f, indent=4)
+
+    if args.plot is not None:
+        plot_det(curves, args.plot)
+
+    if args.bootstrap > 0:
+        rng = np.random.default_rng(args.seed)
+        intervals = bootstrap(
+            table,
+            threshold=args.bootstrap_threshold,
+            resamples=args.bootstrap,
+            confidence=args.confidence,
+            rng=rng,
+        )
+        print_intervals(intervals, args.confidence)
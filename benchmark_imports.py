@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+# Command line tools, startup is measured with --help, which imports everything the script imports at module level
+SCRIPTS = [
+    "dataset_cleaner.py",
+    "hard_negatives.py",
+    "parse_annotations.py",
+    "llm_batch.py",
+    "topic_modelling.py",
+    "similarity_modeling.py",
+    "evaluate_topic_modelling.py",
+    "dataset_store.py",
+    "pipeline.py",
+]
+
+
+def run_time(command):
+    start = time.perf_counter()
+    result = subprocess.run(command, capture_output=True, text=True)
+    return time.perf_counter() - start, result
+
+
+def direct_imports(command):
+    """
+    :return: Dict which maps modules imported directly by the command to their cumulative import time in ms
+    """
+    _, result = run_time([sys.executable, "-X", "importtime", *command])
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Nested imports are indented, the script itself is not imported, so its imports are not indented
+        if not name.startswith("  "):
+            imports[name.strip()] = int(cumulative) / 1000
+    return imports
+
+
+def heaviest_imports(script, top):
+    """
+    :return: List of (module, cumulative import time in ms) of modules imported directly by the script,
+        modules imported by interpreter startup are left out
+    """
+    startup_modules = direct_imports(["-c", "pass"])
+    imports = direct_imports([script, "--help"])
+    imports = [(name, ms) for name, ms in imports.items() if name not in startup_modules]
+    return sorted(imports, key=lambda item: -item[1])[:top]
+
+
+def benchmark_script(script, runs, interpreter_startup, top):
+    times = []
+    for _ in range(runs):
+        elapsed, result = run_time([sys.executable, script, "--help"])
+        if result.returncode != 0:
+            return {"script": script, "error": result.stderr.strip().splitlines()[-1]}
+        times.append(elapsed)
+    startup = statistics.median(times)
+    return {
+        "script": script,
+        "startup_s": startup,
+        "imports_s": startup - interpreter_startup,
+        "heaviest_imports_ms": heaviest_imports(script, top),
+    }
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Measures startup time of command line tools, i.e. time spent importing their dependencies."
+    )
+    parser.add_argument("--scripts", nargs="+", default=SCRIPTS)
+    parser.add_argument("--runs", type=int, default=5, help="Number of runs of each script, median is reported.")
+    parser.add_argument("--top", type=int, default=5, help="Number of heaviest imports reported for each script.")
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        default=1.0,
+        help="Startup time limit, the benchmark exits with non-zero code if some script starts slower.",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Path to json file with results. Default is benchmark-results/imports-<time>.json.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    interpreter_startup = statistics.median(run_time([sys.executable, "-c", "pass"])[0] for _ in range(args.runs))
+    print(f"Interpreter startup {interpreter_startup * 1000:.0f}ms.")
+
+    results = []
+    for script in args.scripts:
+        result = benchmark_script(script, args.runs, interpreter_startup, args.top)
+        if "error" in result:
+            print(f"{script}: failed, {result['error']}")
+        else:
+            heaviest = ", ".join(f"{name} {ms:.0f}ms" for name, ms in result["heaviest_imports_ms"])
+            print(f"{script}: {result['startup_s'] * 1000:.0f}ms (imports {result['imports_s'] * 1000:.0f}ms), "
+                  f"heaviest: {heaviest}")
+        results.append(result)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version,
+        "interpreter_startup_s": interpreter_startup,
+        "results": results,
+    }
+    output = args.output
+    if output is None:
+        time_string = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        output = f"benchmark-results/imports-{time_string}.json"
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Results saved to {output}.")
+
+    # A tool failing on startup usually has a broken deferred import, which is what the benchmark should catch
+    failed = [result["script"] for result in results if "error" in result]
+    slow = [result["script"] for result in results if "error" not in result and result["startup_s"] > args.max_seconds]
+    if failed:
+        print(f"Failed to start: {', '.join(failed)}")
+    if slow:
+        print(f"Slower than {args.max_seconds}s: {', '.join(slow)}")
+    if failed or slow:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+from datetime import datetime
+
+# Words for the synthetic workload are sampled from the gold dataset, so tokenization
+# cost is close to the one of real Czech texts and topics.
+VOCABULARY_SOURCE = "data/gold_annotated_dataset.json"
+
+MLM_MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+
+
+def load_vocabulary(path=VOCABULARY_SOURCE):
+    with open(path, "r") as f:
+        data = json.load(f)
+    words = set()
+    for item in data.values():
+        words.update(item["text"].replace("<b>", " ").replace("</b>", " ").split())
+        for topic in item["topics"]:
+            words.update(topic.split())
+    return sorted(words)
+
+
+def create_workload(num_texts, seed=0, text_words=40, topics_range=(2, 5), topic_words=(1, 4)):
+    """
+    Creates synthetic records in the same format as `*-generated-topics.json` files.
+    :param num_texts: Number of texts in workload
+    :param seed: Seed for random generator, same seed gives same workload
+    :return: List of dicts with keys `text`, `annotator_topics` and `generated_topics`
+    """
+    vocabulary = load_vocabulary()
+    rng = random.Random(seed)
+
+    def topic():
+        return " ".join(rng.choices(vocabulary, k=rng.randint(*topic_words)))
+
+    workload = []
+    for i in range(num_texts):
+        workload.append(
+            {
+                "text-id": f"synthetic-{i}",
+                "text": " ".join(rng.choices(vocabulary, k=text_words)),
+                "annotator_topics": [topic() for _ in range(rng.randint(*topics_range))],
+                "generated_topics": [topic() for _ in range(rng.randint(*topics_range))],
+            }
+        )
+    return workload
+
+
+def count_pairs(metric_name, record):
+    annotator_topics = len(record["annotator_topics"])
+    if metric_name == "CrossEncoderMetric":
+        # annotator topics are compared with all generated topics merged together
+        return annotator_topics
+    if metric_name == "MLMTopicEvaluator":
+        # text is compared with each annotator topic
+        return annotator_topics
+    return annotator_topics * len(record["generated_topics"])
+
+
+def create_metric(metric_name):
+    if metric_name == "MLMTopicEvaluator":
+        from similarity_modeling import MLMTopicEvaluator
+
+        evaluator = MLMTopicEvaluator(MLM_MODEL_NAME)
+        return lambda record: list(evaluator.get_similarity(record["text"], record["annotator_topics"]))
+
+    import evaluate_topic_modelling
+
+    metric = getattr(evaluate_topic_modelling, metric_name)()
+    return lambda record: metric.calculate_matching_score(record["annotator_topics"], record["generated_topics"])
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if sys.platform == "darwin":
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+def benchmark_metric(metric_name, workload, warmup):
+    start = time.perf_counter()
+    score = create_metric(metric_name)
+    load_time = time.perf_counter() - start
+
+    for record in workload[:warmup]:
+        score(record)
+
+    pairs = sum(count_pairs(metric_name, record) for record in workload)
+    start = time.perf_counter()
+    for record in workload:
+        score(record)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "metric": metric_name,
+        "texts": len(workload),
+        "pairs": pairs,
+        "load_time_s": load_time,
+        "elapsed_s": elapsed,
+        "texts_per_s": len(workload) / elapsed if elapsed else float("inf"),
+        "pairs_per_s": pairs / elapsed if elapsed else float("inf"),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_isolated(metric_name, workload, warmup):
+    """
+    Runs benchmark of one metric in a fresh process, so model load time and peak RSS
+    are not affected by models loaded for other metrics.
+    """
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(benchmark_metric, (metric_name, workload, warmup))
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    Compares throughput with stored baseline results.
+    :return: List of metric names which are slower than baseline by more than `tolerance`
+    """
+    baseline_by_metric = {r["metric"]: r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        base = baseline_by_metric.get(result["metric"])
+        if base is None:
+            print(f"{result['metric']}: not present in baseline.")
+            continue
+        change = result["pairs_per_s"] / base["pairs_per_s"] - 1
+        print(
+            f"{result['metric']}: {base['pairs_per_s']:.1f} -> {result['pairs_per_s']:.1f} pairs/s "
+            f"({change:+.1%}), load {base['load_time_s']:.2f}s -> {result['load_time_s']:.2f}s, "
+            f"peak RSS {base['peak_rss_mb']:.0f}MB -> {result['peak_rss_mb']:.0f}MB"
+        )
+        if change < -tolerance:
+            regressions.append(result["metric"])
+    return regressions
+
+
+METRICS = [
+    "BasicMetric",
+    "CrossEncoderMetric",
+    "CrossEncoderMetric1to1",
+    "MLMSimilarity1to1",
+    "MLMTopicEvaluator",
+]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Throughput benchmark for topic scoring metrics.")
+    parser.add_argument("--metrics", nargs="+", choices=METRICS, default=METRICS)
+    parser.add_argument("--texts", type=int, default=200, help="Number of synthetic texts in workload.")
+    parser.add_argument("--warmup", type=int, default=5, help="Number of texts scored before measuring.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Path to json file with results. Default is benchmark-results/metrics-<time>.json.",
+    )
+    parser.add_argument("--baseline", default=None, help="Path to results json to compare with.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Allowed relative throughput drop against baseline before reporting regression.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    workload = create_workload(args.texts, seed=args.seed)
+
+    results = []
+    for metric_name in args.metrics:
+        print(f"Benchmarking {metric_name} on {len(workload)} texts.")
+        result = run_isolated(metric_name, workload, args.warmup)
+        print(
+            f"\t{result['pairs_per_s']:.1f} pairs/s, {result['texts_per_s']:.1f} texts/s, "
+            f"load time {result['load_time_s']:.2f}s, peak RSS {result['peak_rss_mb']:.0f}MB"
+        )
+        results.append(result)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "workload": {"texts": args.texts, "seed": args.seed, "warmup": args.warmup},
+        "results": results,
+    }
+
+    output = args.output
+    if output is None:
+        time_string = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        output = f"benchmark-results/metrics-{time_string}.json"
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Results saved to {output}.")
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Throughput regressions: {', '.join(regressions)}")
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
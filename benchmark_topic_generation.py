@@ -0,0 +1,69 @@
+import argparse
+import asyncio
+import itertools
+import time
+
+from llm_client import LLMClient
+from openai_stub import StubChatCompletionsServer
+from topic_modelling import GptGenerator, generate_topics_async
+from utils import get_annotations
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Compares blocking and concurrent topic generation against local stub of chat completions API."
+    )
+    parser.add_argument("--source", default="data/gold_annotated_dataset.json")
+    parser.add_argument("--texts", type=int, default=50, help="Number of texts to generate topics for.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Latency of one stub response in seconds.")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--stub-capacity",
+        type=int,
+        default=None,
+        help="Number of concurrent requests stub accepts before responding with rate limit error.",
+    )
+    parser.add_argument("--skip-sync", action="store_true", help="Measure only concurrent generation.")
+    return parser.parse_args()
+
+
+def load_annotations(path, texts):
+    # Texts are repeated when dataset is smaller than requested workload
+    annotations = list(get_annotations(path))
+    return list(itertools.islice(itertools.cycle(annotations), texts))
+
+
+def main():
+    args = get_args()
+    annotations = load_annotations(args.source, args.texts)
+
+    with StubChatCompletionsServer(latency=args.latency, capacity=args.stub_capacity) as stub:
+        # Response cache is off, repeated texts have to reach the stub
+        topic_generator = GptGenerator(LLMClient(base_url=stub.base_url, api_key="stub"))
+
+        if not args.skip_sync:
+            start = time.perf_counter()
+            for text, _, _ in annotations:
+                topic_generator(text)
+            sync_elapsed = time.perf_counter() - start
+            print(f"Blocking loop: {len(annotations)} texts in {sync_elapsed:.2f}s "
+                  f"({len(annotations) / sync_elapsed:.1f} texts/s)")
+
+        requests_before = stub.requests
+        start = time.perf_counter()
+        generated = asyncio.run(
+            generate_topics_async(topic_generator, annotations, concurrency=args.concurrency)
+        )
+        async_elapsed = time.perf_counter() - start
+        print(f"Concurrent ({args.concurrency}): {len(generated)} texts in {async_elapsed:.2f}s "
+              f"({len(generated) / async_elapsed:.1f} texts/s), "
+              f"{stub.requests - requests_before} requests, {stub.rate_limited} rate limited")
+
+        in_order = all(g["text-id"] == key for g, (_, _, key) in zip(generated, annotations))
+        print(f"Results in input order: {in_order}")
+        if not args.skip_sync:
+            print(f"Speedup: {sync_elapsed / async_elapsed:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,12 +7,15 @@ import os
 
 from utils import (
     addstr_wordwrap,
+    BackgroundWriter,
     CursesWindow,
-    curses_overflow_restarts,
+    Prefetcher,
     ScreenOwner,
     print_job_done,
+    wrap_lines,
 )
 import getting_user_input
+from journal import JsonDictJournal
 
 NOT_VISITED = 0
 SKIPPED = 1
@@ -27,6 +30,18 @@ def get_args():
         default="evaluation-data/out-mlm-mpnet-base-v2-all-texts_example.jsonl",
     )
     parser.add_argument("--CLEAN_DATASET", default="data/clean_dataset.json")
+    parser.add_argument(
+        "--COMPACT_EVERY",
+        type=int,
+        default=100,
+        help="Number of cleaned texts after which progress sidecar file is compacted in background.",
+    )
+    parser.add_argument(
+        "--PREFETCH",
+        type=int,
+        default=4,
+        help="Number of next texts prepared in background while annotating.",
+    )
 
     return parser.parse_args()
 
@@ -38,29 +53,29 @@ class ScreenOwnerCleaning(ScreenOwner):
         "reconsider an answer.\n\n"
     )
 
-    def __init__(self, crs, text, nb_left, nb_cleaned_this_session, sorted_topics):
+    def __init__(self, crs, text, nb_left, nb_cleaned_this_session, sorted_topics, text_layout=None):
 
         self.correct_topics = None
         self.sorted_topics = sorted_topics
 
-        super().__init__(crs, text, nb_left, nb_cleaned_this_session)
-
-    def redraw(self):
-        super().redraw()
+        super().__init__(crs, text, nb_left, nb_cleaned_this_session, text_layout)
 
+    def body_lines(self):
+        lines = []
         if self.correct_topics is not None:
             for i, topic in enumerate(self.sorted_topics, start=1):
-                self.crs.addstr(f"Topic #{i}: ", curses.A_BOLD)
-                self.crs.addstr(f"{topic['topic']}\n")
-                self.crs.addstr("Relevant? ")
+                lines.append(((f"Topic #{i}: ", curses.A_BOLD), (topic["topic"], 0)))
                 if topic["topic"] in self.correct_topics:
-                    self.crs.addstr("✓\n\n")
+                    lines.append((("Relevant? ✓", 0),))
                 else:
-                    self.crs.addstr("✗\n\n")
+                    lines.append((("Relevant? ✗", 0),))
+                lines.append(())
+        return lines
 
     def update_correct_topics(self, correct_topics):
         self.correct_topics = correct_topics
-        self.redraw()
+        # Only lines of changed answers are redrawn
+        self.update_body(self.body_lines())
 
 
 def put_introduction(nb_texts, nb_cleaned, crs):
@@ -83,11 +98,12 @@ def put_introduction(nb_texts, nb_cleaned, crs):
     crs.addstr(
         "Once you mark a topic relevant, the rest of the topics will be marked as relevant as well.\n"
     )
+    crs.addstr("Long texts can be scrolled with arrow keys or PgUp/PgDn.\n")
     crs.addstr("After every cleaned text, your progress will be saved.\n\n\n")
     crs.addstr("If you want to start cleaning press 'c', to quit press 'q'.\n\n")
 
 
-def annotate_topics(sorted_topics, crs):
+def annotate_topics(sorted_topics, screen_owner):
     accepted_topic = False
     correct_topics = []
 
@@ -97,11 +113,8 @@ def annotate_topics(sorted_topics, crs):
             correct_topics.append(score["topic"])
             continue
 
-        crs.addstr("\n")
-        crs.addstr(f"Topic #{i}: ", curses.A_BOLD)
-        crs.addstr(f"{score['topic']}\n")
-
-        if getting_user_input.accept_or_reject(crs, "Relevant? [Y/n] "):
+        topic = (("\n", 0), (f"Topic #{i}: ", curses.A_BOLD), (f"{score['topic']}\n", 0))
+        if screen_owner.accept_or_reject("Relevant? [Y/n] ", *topic):
             correct_topics.append(score["topic"])
             accepted_topic = True
         else:
@@ -110,11 +123,16 @@ def annotate_topics(sorted_topics, crs):
     return correct_topics
 
 
-def get_topics_to_check(data_sample, clean_data):
+def get_state(data_sample, progress):
+    # State stored in progress sidecar is newer than the one in input file
+    return progress.get(data_sample["text_id"], {}).get("state", data_sample.get("state", NOT_VISITED))
+
+
+def get_topics_to_check(data_sample, clean_data, progress):
     topics_to_check = []
     warning = ""
 
-    state = data_sample.get("state", NOT_VISITED)
+    state = get_state(data_sample, progress)
 
     if state == NOT_VISITED:
         topics_to_check = data_sample["scores"]
@@ -145,11 +163,7 @@ def annotation_to_redo(nb_topics, crs):
 
 def redo_if_needed(sorted_topics, correct_topics, screen_owner, crs):
     while True:  # Outer loop to enable multiple redos or quitting after redo
-        addstr_wordwrap(
-            crs,
-            "\n\nPress 'c' to continue, 'r' to redo an annotation, 'q' to quit. ",
-            0,
-        )
+        screen_owner.show_prompt(("\n\nPress 'c' to continue, 'r' to redo an annotation, 'q' to quit. ", 0))
         action = getting_user_input.redo_or_proceed(crs)
         if action == "redo":  # Redo
             annot_id = annotation_to_redo(len(sorted_topics), crs)
@@ -183,49 +197,187 @@ def create_rejected_topics(correct_topics, sorted_topics):
     ]
 
 
-@curses_overflow_restarts
-def start_data_cleaning(clean_data, lines, args):
-    nb_texts = len(lines)
+class InputIndex:
+    """
+    Persistent index of input jsonl file with byte offset, text id and state of every record, stored next to
+    the input file. Startup reads only the index, records are parsed when the cleaning loop reaches them.
+    The index is rebuilt when size or modification time of the input file does not match.
+    """
+
+    def __init__(self, input_file):
+        self.input_file = input_file
+        self.index_path = input_file + ".index.json"
+        self.offsets = []
+        self.text_ids = []
+        self.states = []
+        self.file = None
+
+    @classmethod
+    def open(cls, input_file):
+        index = cls(input_file)
+        if not index.load():
+            index.build()
+            index.save()
+        index.file = open(input_file, "rb")
+        return index
+
+    def stat(self):
+        stat = os.stat(self.input_file)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def load(self):
+        try:
+            with open(self.index_path, "r") as f:
+                stored = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        if stored["input"] != self.stat():
+            return False
+        self.offsets = stored["offsets"]
+        self.text_ids = stored["text_ids"]
+        self.states = stored["states"]
+        return True
+
+    def build(self):
+        self.offsets, self.text_ids, self.states = [], [], []
+        with open(self.input_file, "rb") as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    data_sample = json.loads(line)
+                    self.offsets.append(offset)
+                    self.text_ids.append(data_sample["text_id"])
+                    self.states.append(data_sample.get("state", NOT_VISITED))
+                offset += len(line)
+
+    def save(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {"input": self.stat(), "offsets": self.offsets, "text_ids": self.text_ids, "states": self.states},
+                f,
+            )
+        os.replace(tmp_path, self.index_path)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def read(self, i):
+        self.file.seek(self.offsets[i])
+        return json.loads(self.file.readline())
+
+    def state(self, i, progress):
+        return progress.get(self.text_ids[i], {}).get("state", self.states[i])
+
+    def pending(self, clean_data, progress):
+        """
+        Positions of records which `get_topics_to_check` returns topics for, without parsing the records.
+        """
+        for i, text_id in enumerate(self.text_ids):
+            state = self.state(i, progress)
+            if state == NOT_VISITED or (state == CHECKED and text_id not in clean_data):
+                yield i
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def progress_path(input_file):
+    return input_file + ".progress.json"
+
+
+def open_progress(input_file, compact_every=None):
+    """
+    Opens sidecar store with cleaning progress keyed by text id. Each cleaned text costs one journal append,
+    input file and clean dataset are rewritten only by `export_progress`.
+    """
+    return JsonDictJournal(progress_path(input_file), compact_every=compact_every, create=True)
+
+
+def apply_progress(clean_data, progress):
+    for text_id, record in progress.items():
+        if "annotation" in record:
+            clean_data[text_id] = record["annotation"]
+    return clean_data
+
+
+def export_progress(progress, index, clean_dataset, clean_data):
+    """
+    Merges states of visited texts into input file and writes clean dataset, both files are replaced atomically.
+    Only records with changed state are parsed, the index is updated with new offsets.
+    """
+    input_file = index.input_file
+    tmp_path = input_file + ".tmp"
+    offsets = []
+    with open(input_file, "rb") as f_in, open(tmp_path, "wb") as f_out:
+        for i, offset in enumerate(index.offsets):
+            f_in.seek(offset)
+            line = f_in.readline()
+            text_id = index.text_ids[i]
+            if text_id in progress:
+                data_sample = json.loads(line)
+                data_sample["state"] = index.states[i] = progress[text_id]["state"]
+                line = (json.dumps(data_sample, ensure_ascii=False) + "\n").encode("utf-8")
+            offsets.append(f_out.tell())
+            f_out.write(line)
+    index.close()
+    os.replace(tmp_path, input_file)
+    index.offsets = offsets
+    index.save()
+
+    tmp_path = clean_dataset + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(clean_data, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, clean_dataset)
+
+
+def start_data_cleaning(clean_data, index, args, progress, journal):
+    nb_texts = len(index)
     nb_texts_cleaned = len(clean_data)
-    remaining = 0
-    for line in lines:
-        data_sample = json.loads(line)
-        state = data_sample.get("state", NOT_VISITED)
-        if state == NOT_VISITED:
-            remaining += 1
+    remaining = sum(1 for i in range(nb_texts) if index.state(i, progress) == NOT_VISITED)
     cleaned_texts_this_session = 0
 
-    with CursesWindow() as crs:
+    def prepare_screen(i):
+        data_sample = index.read(i)
+        topics_to_check, warning = get_topics_to_check(data_sample, clean_data, progress)
+        sorted_topics = sorted(
+            topics_to_check, key=lambda x: x["similarity"], reverse=False
+        )
+        _, width = crs.getmaxyx()
+        text_layout = (width, wrap_lines(data_sample["text"] + "\n", width))
+        return data_sample, sorted_topics, warning, text_layout
+
+    # Next texts are read and prepared in background while the user annotates, saves are written in background
+    with CursesWindow() as crs, \
+            Prefetcher(index.pending(clean_data, progress), prepare_screen, args.PREFETCH) as screens, \
+            BackgroundWriter() as writer:
         put_introduction(nb_texts, nb_texts_cleaned, crs)
 
         quit_or_proceed = getting_user_input.quit_or_proceed(crs)
         if quit_or_proceed == "quit":
             return 0
 
-        for i, line in enumerate(lines):
-            data_sample = json.loads(line)
-
-            topics_to_check, warning = get_topics_to_check(data_sample, clean_data)
-            if not topics_to_check:
+        for data_sample, sorted_topics, warning, text_layout in screens:
+            if not sorted_topics:
                 continue
             if warning:
                 crs.addstr(warning)
 
-            sorted_topics = sorted(
-                topics_to_check, key=lambda x: x["similarity"], reverse=False
-            )
             screen_owner = ScreenOwnerCleaning(
                 crs,
                 data_sample["text"],
                 remaining,
                 cleaned_texts_this_session,
                 sorted_topics,
+                text_layout,
             )
 
             skipped = False
             correct_topics = []
             try:
-                correct_topics = annotate_topics(sorted_topics, crs)
+                correct_topics = annotate_topics(sorted_topics, screen_owner)
                 screen_owner.update_correct_topics(correct_topics)
             except getting_user_input.SkipError:
                 skipped = True
@@ -242,15 +394,13 @@ def start_data_cleaning(clean_data, lines, args):
             except getting_user_input.SkipError:
                 skipped = True
 
-            # Original data, write back to file with updated state
-            data_sample["state"] = CHECKED if not skipped else SKIPPED
-            lines[i] = json.dumps(data_sample, ensure_ascii=False) + "\n"
-            with open(args.INPUT_FILE, "w") as f:
-                for line in lines:
-                    f.write(line)
+            text_id = data_sample["text_id"]
 
             # Do not update cleaned data if the text was skipped
             if skipped:
+                update = {"state": SKIPPED}
+                progress[text_id] = update
+                writer.submit(journal.append, text_id, update)
                 continue
 
             # Add user rejected topics to the set of potential hard negatives
@@ -265,19 +415,14 @@ def start_data_cleaning(clean_data, lines, args):
                 "potential_hard_negatives": new_potential_hns,
             }
 
-            # Update cleaned data
-            clean_data[data_sample["text_id"]] = new_annotated
+            # Update cleaned data, files are written on export at the end of the session
+            clean_data[text_id] = new_annotated
+            update = {"state": CHECKED, "annotation": new_annotated}
+            progress[text_id] = update
+            writer.submit(journal.append, text_id, update)
             cleaned_texts_this_session += 1
             remaining -= 1
 
-            # Clean data
-            json.dump(
-                clean_data,
-                open(args.CLEAN_DATASET, "w"),
-                indent=4,
-                ensure_ascii=False,
-            )
-
             if end:
                 break
 
@@ -288,8 +433,7 @@ def start_data_cleaning(clean_data, lines, args):
 def main():
     args = get_args()
 
-    with open(args.INPUT_FILE, "r") as f:
-        lines = f.readlines()
+    index = InputIndex.open(args.INPUT_FILE)
 
     if os.path.exists(args.CLEAN_DATASET):
         with open(args.CLEAN_DATASET, "r") as f:
@@ -297,7 +441,20 @@ def main():
     else:
         clean_data = {}
 
-    start_data_cleaning(clean_data, lines, args)
+    # Progress of interrupted session is restored from sidecar store
+    journal = open_progress(args.INPUT_FILE, args.COMPACT_EVERY)
+    progress = journal.load()
+    apply_progress(clean_data, progress)
+
+    try:
+        start_data_cleaning(clean_data, index, args, progress, journal)
+    finally:
+        journal.close()
+
+    if progress:
+        export_progress(progress, index, args.CLEAN_DATASET, clean_data)
+        journal.discard()
+    index.close()
 
 
 if __name__ == "__main__":
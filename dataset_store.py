@@ -0,0 +1,456 @@
+import argparse
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+
+from utils import read_records, write_records
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS texts (
+    text_id TEXT PRIMARY KEY,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS topics (
+    topic_id INTEGER PRIMARY KEY,
+    topic TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS annotations (
+    text_id TEXT NOT NULL,
+    annotation INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    user_id TEXT,
+    topic_id INTEGER NOT NULL,
+    PRIMARY KEY (text_id, annotation, position)
+);
+CREATE INDEX IF NOT EXISTS annotations_topic ON annotations (topic_id);
+CREATE TABLE IF NOT EXISTS scores (
+    source TEXT NOT NULL,
+    text_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    topic_id INTEGER NOT NULL,
+    similarity REAL,
+    label INTEGER,
+    PRIMARY KEY (source, text_id, position)
+);
+CREATE INDEX IF NOT EXISTS scores_text ON scores (text_id);
+CREATE INDEX IF NOT EXISTS scores_topic ON scores (topic_id);
+-- Other fields of scored records, e.g. `state` written by the dataset cleaner, as json object
+CREATE TABLE IF NOT EXISTS score_fields (
+    source TEXT NOT NULL,
+    text_id TEXT NOT NULL,
+    fields TEXT NOT NULL,
+    PRIMARY KEY (source, text_id)
+);
+CREATE TABLE IF NOT EXISTS hard_negatives (
+    text_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    topic_id INTEGER NOT NULL,
+    type TEXT,
+    similarity REAL,
+    annotation INTEGER,
+    PRIMARY KEY (text_id, kind, position)
+);
+CREATE INDEX IF NOT EXISTS hard_negatives_topic ON hard_negatives (topic_id);
+"""
+
+# Kinds of hard negatives: candidates found in similar texts by `negatives-exclusive-sets.py` with similarity
+# scores, alternatives generated by LLM and potential hard negatives merged for annotation
+CANDIDATE = "candidate"
+GENERATED = "generated"
+POTENTIAL = "potential"
+
+# Fields of scored records stored in their own tables, other fields are kept in `score_fields`
+SCORE_RECORD_KEYS = {"text_id", "text", "scores", "llm_generated_hn", "potential_hard_negatives"}
+
+
+class DatasetStore:
+    """
+    SQLite store of texts and everything computed for them: annotator topics, similarity scores of topics
+    from each scoring run (`source`) and hard negatives. All tables are indexed by text id and topic strings
+    are kept once in `topics`, so looking up one text or joining its data does not parse whole dataset files.
+
+    Records are read and written in the formats of the json files of the pipeline, `import_file` and
+    `export_file` convert between the store and the files for scripts which still work with files.
+    """
+
+    def __init__(self, path="data/dataset.sqlite"):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.topic_cache = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    @contextmanager
+    def transaction(self):
+        try:
+            with self.connection:
+                yield self.connection
+        except BaseException:
+            # Ids of topics added in rolled back transaction are not valid
+            self.topic_cache.clear()
+            raise
+
+    def topic_ids(self, topics):
+        """
+        :return: List of ids of topic strings, unknown topics are added
+        """
+        missing = [topic for topic in set(topics) if topic not in self.topic_cache]
+        if missing:
+            self.connection.executemany("INSERT OR IGNORE INTO topics (topic) VALUES (?)", [(t,) for t in missing])
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i + 500]
+                rows = self.connection.execute(
+                    f"SELECT topic, topic_id FROM topics WHERE topic IN ({','.join('?' * len(chunk))})", chunk
+                )
+                self.topic_cache.update(rows)
+        return [self.topic_cache[topic] for topic in topics]
+
+    def put_text(self, text_id, text):
+        # Upsert keeps rowid of existing texts, so texts are listed in order of their first import
+        self.connection.execute(
+            "INSERT INTO texts (text_id, text) VALUES (?, ?) ON CONFLICT (text_id) DO UPDATE SET text = excluded.text",
+            (text_id, text),
+        )
+
+    def text(self, text_id):
+        row = self.connection.execute("SELECT text FROM texts WHERE text_id = ?", (text_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def text_ids(self):
+        return [row[0] for row in self.connection.execute("SELECT text_id FROM texts ORDER BY rowid")]
+
+    def put_annotations(self, records, text_ids=None):
+        """
+        Replaces annotations of texts present in `records`.
+        :param records: Records of `data/out-clean.json`, one per annotation
+        :param text_ids: Texts whose annotations are replaced also when no record is left for them
+        """
+        by_text = {}
+        for record in records:
+            by_text.setdefault(record["text_id"], []).append(record)
+        with self.transaction():
+            for text_id in set(text_ids or ()) - set(by_text):
+                self.connection.execute("DELETE FROM annotations WHERE text_id = ?", (text_id,))
+            for text_id, text_records in by_text.items():
+                self.put_text(text_id, text_records[0]["text"])
+                self.connection.execute("DELETE FROM annotations WHERE text_id = ?", (text_id,))
+                for annotation, record in enumerate(text_records):
+                    self.connection.executemany(
+                        "INSERT INTO annotations VALUES (?, ?, ?, ?, ?)",
+                        [
+                            (text_id, annotation, position, record["user_id"], topic_id)
+                            for position, topic_id in enumerate(self.topic_ids(record["user_topics"]))
+                        ],
+                    )
+        return len(by_text)
+
+    def annotations(self, text_ids=None):
+        """
+        :return: Iterator of records in the format of `data/out-clean.json`
+        """
+        query = """
+            SELECT a.text_id, t.text, a.annotation, a.user_id, p.topic FROM annotations a
+            JOIN texts t ON t.text_id = a.text_id JOIN topics p ON p.topic_id = a.topic_id
+        """
+        yield from self.group_rows(
+            self.select_by_text(query, text_ids, "t.rowid, a.annotation, a.position"),
+            key=lambda row: row[:3],
+            record=lambda rows: {
+                "text_id": rows[0][0],
+                "text": rows[0][1],
+                "user_id": rows[0][3],
+                "user_topics": [row[4] for row in rows],
+            },
+        )
+
+    def put_scores(self, source, records):
+        """
+        Replaces scores of texts present in `records` computed by scoring run `source`.
+        :param records: Records with `text_id`, `text` and `scores` list of dicts with `topic`, `similarity`
+            and optionally `label`, other fields except hard negatives are kept as they are
+        """
+        count = 0
+        with self.transaction():
+            for record in records:
+                self.put_text(record["text_id"], record["text"])
+                self.connection.execute(
+                    "DELETE FROM scores WHERE source = ? AND text_id = ?", (source, record["text_id"])
+                )
+                self.connection.execute(
+                    "DELETE FROM score_fields WHERE source = ? AND text_id = ?", (source, record["text_id"])
+                )
+                fields = {key: value for key, value in record.items() if key not in SCORE_RECORD_KEYS}
+                if fields:
+                    self.connection.execute(
+                        "INSERT INTO score_fields VALUES (?, ?, ?)",
+                        (source, record["text_id"], json.dumps(fields, ensure_ascii=False)),
+                    )
+                topic_ids = self.topic_ids([score["topic"] for score in record["scores"]])
+                self.connection.executemany(
+                    "INSERT INTO scores VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (source, record["text_id"], position, topic_id, score["similarity"], score.get("label"))
+                        for position, (topic_id, score) in enumerate(zip(topic_ids, record["scores"]))
+                    ],
+                )
+                count += 1
+        return count
+
+    def scores(self, source, text_ids=None):
+        """
+        :return: Iterator of records with `text_id`, `text` and `scores`, as written by `similarity_modeling.py`
+        """
+        query = """
+            SELECT s.text_id, t.text, p.topic, s.similarity, s.label, f.fields FROM scores s
+            JOIN texts t ON t.text_id = s.text_id JOIN topics p ON p.topic_id = s.topic_id
+            LEFT JOIN score_fields f ON f.source = s.source AND f.text_id = s.text_id
+            WHERE s.source = ?
+        """
+
+        def score(row):
+            score = {"topic": row[2], "similarity": row[3]}
+            if row[4] is not None:
+                score["label"] = row[4]
+            return score
+
+        def record(rows):
+            record = {"text_id": rows[0][0], "text": rows[0][1], "scores": [score(row) for row in rows]}
+            if rows[0][5] is not None:
+                record.update(json.loads(rows[0][5]))
+            return record
+
+        yield from self.group_rows(
+            self.select_by_text(query, text_ids, "t.rowid, s.position", [source]),
+            key=lambda row: row[0],
+            record=record,
+        )
+
+    def score_sources(self):
+        return [row[0] for row in self.connection.execute("SELECT DISTINCT source FROM scores ORDER BY source")]
+
+    def put_hard_negatives(self, text_id, kind, hard_negatives):
+        """
+        Replaces hard negatives of one kind for a text.
+        :param hard_negatives: List of topic strings or dicts with `topic` and optionally `type`, `similarity`
+            and `annotation`
+        """
+        hard_negatives = [hn if isinstance(hn, dict) else {"topic": hn} for hn in hard_negatives]
+        self.connection.execute("DELETE FROM hard_negatives WHERE text_id = ? AND kind = ?", (text_id, kind))
+        topic_ids = self.topic_ids([hn["topic"] for hn in hard_negatives])
+        self.connection.executemany(
+            "INSERT INTO hard_negatives VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (text_id, kind, position, topic_id, hn.get("type"), hn.get("similarity"), hn.get("annotation"))
+                for position, (topic_id, hn) in enumerate(zip(topic_ids, hard_negatives))
+            ],
+        )
+
+    def hard_negatives(self, kind, text_ids=None):
+        """
+        :return: Iterator of tuples (text id, list of hard negative dicts), texts without hard negatives
+            of `kind` are left out
+        """
+        query = """
+            SELECT h.text_id, p.topic, h.type, h.similarity, h.annotation FROM hard_negatives h
+            JOIN texts t ON t.text_id = h.text_id JOIN topics p ON p.topic_id = h.topic_id
+            WHERE h.kind = ?
+        """
+        fields = ("topic", "type", "similarity", "annotation")
+
+        def hard_negative(row):
+            hn = {field: value for field, value in zip(fields, row[1:]) if value is not None}
+            if "annotation" in hn:
+                hn["annotation"] = bool(hn["annotation"])
+            return hn
+
+        yield from self.group_rows(
+            self.select_by_text(query, text_ids, "t.rowid, h.position", [kind]),
+            key=lambda row: row[0],
+            record=lambda rows: (rows[0][0], [hard_negative(row) for row in rows]),
+        )
+
+    def select_by_text(self, query, text_ids, order, params=()):
+        params = list(params)
+        if text_ids is not None:
+            text_ids = list(text_ids)
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS selected (text_id TEXT PRIMARY KEY)")
+            self.connection.execute("DELETE FROM selected")
+            self.connection.executemany("INSERT OR IGNORE INTO selected VALUES (?)", [(id,) for id in text_ids])
+            query += (" AND" if "WHERE" in query else " WHERE") + " t.text_id IN (SELECT text_id FROM selected)"
+        return self.connection.execute(f"{query} ORDER BY {order}", params)
+
+    @staticmethod
+    def group_rows(rows, key, record):
+        group = []
+        for row in rows:
+            if group and key(row) != key(group[0]):
+                yield record(group)
+                group = []
+            group.append(row)
+        if group:
+            yield record(group)
+
+    def text_view(self, text_id):
+        """
+        :return: Everything stored for one text, None for unknown text id
+        """
+        text = self.text(text_id)
+        if text is None:
+            return None
+        view = {"text_id": text_id, "text": text}
+        view["annotations"] = [
+            {"user_id": record["user_id"], "user_topics": record["user_topics"]}
+            for record in self.annotations([text_id])
+        ]
+        view["scores"] = {}
+        for source in self.score_sources():
+            for record in self.scores(source, [text_id]):
+                view["scores"][source] = record["scores"]
+        view["hard_negatives"] = {}
+        for kind in (CANDIDATE, GENERATED, POTENTIAL):
+            for _, hard_negatives in self.hard_negatives(kind, [text_id]):
+                view["hard_negatives"][kind] = hard_negatives
+        return view
+
+    def stats(self):
+        tables = ("texts", "topics", "annotations", "scores", "score_fields", "hard_negatives")
+        return {table: self.connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in tables}
+
+    def import_file(self, kind, path, source=None):
+        """
+        Imports one pipeline file.
+        :param kind: `annotations` for `data/out-clean.json`, `scores` for output of `similarity_modeling.py`
+            (json dict or jsonl, also with merged hard negatives), `candidates` for `neg_exSets-scores.json`
+        :param source: Name of scoring run, defaults to file name without extension
+        :return: Number of imported texts
+        """
+        if kind == "annotations":
+            return self.put_annotations(read_records(path))
+        if kind == "scores":
+            source = source or os.path.splitext(os.path.basename(path))[0]
+            return self.put_scores(source, self.import_hard_negatives(text_records(path)))
+        if kind == "candidates":
+            count = 0
+            with self.transaction():
+                for text_id, text in keyed_records(path):
+                    self.put_text(text_id, text["text"])
+                    self.put_hard_negatives(text_id, CANDIDATE, text["potential_negatives_all"])
+                    count += 1
+            return count
+        raise ValueError(f"Unknown kind of file {kind}")
+
+    def import_hard_negatives(self, records):
+        # Generation and merge of hard negatives store them in records of scored texts
+        for record in records:
+            self.put_text(record["text_id"], record["text"])
+            if "llm_generated_hn" in record:
+                self.put_hard_negatives(record["text_id"], GENERATED, record["llm_generated_hn"])
+            if "potential_hard_negatives" in record:
+                self.put_hard_negatives(record["text_id"], POTENTIAL, record["potential_hard_negatives"])
+            yield record
+
+    def export_hard_negatives(self, records):
+        generated = dict(self.hard_negatives(GENERATED))
+        potential = dict(self.hard_negatives(POTENTIAL))
+        for record in records:
+            if record["text_id"] in generated:
+                record["llm_generated_hn"] = [hn["topic"] for hn in generated[record["text_id"]]]
+            if record["text_id"] in potential:
+                record["potential_hard_negatives"] = potential[record["text_id"]]
+            yield record
+
+    def export_file(self, kind, path, source=None):
+        """
+        Writes store contents in the format of pipeline file, see `import_file`.
+        :return: Number of written records
+        """
+        if kind == "annotations":
+            return write_records(self.annotations(), path)
+        if kind == "scores":
+            if source is None:
+                raise ValueError("Scores export needs source")
+            return write_records(self.export_hard_negatives(self.scores(source)), path)
+        if kind == "candidates":
+            candidates = {
+                text_id: {"text": self.text(text_id), "potential_negatives_all": hard_negatives}
+                for text_id, hard_negatives in self.hard_negatives(CANDIDATE)
+            }
+            with open(path, "w") as f:
+                json.dump(candidates, f, indent=4, ensure_ascii=False)
+            return len(candidates)
+        raise ValueError(f"Unknown kind of file {kind}")
+
+
+def keyed_records(path):
+    """
+    :return: Iterator of (text id, record) from json dict keyed by text id, or from json array or jsonl
+        of records with `text_id`
+    """
+    for item in read_records(path):
+        yield item if isinstance(item, tuple) else (item["text_id"], item)
+
+
+def text_records(path):
+    for text_id, record in keyed_records(path):
+        yield dict(record, text_id=text_id)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Dataset store. 'import' loads pipeline files into the store, 'export' writes them back "
+                    "for scripts which read files, 'show' prints everything stored for one text, "
+                    "'stats' prints sizes of tables."
+    )
+    parser.add_argument("action", choices=["import", "export", "show", "stats"])
+    parser.add_argument("--store", default="data/dataset.sqlite")
+    parser.add_argument(
+        "--kind",
+        choices=["annotations", "scores", "candidates"],
+        help="Kind of imported or exported file: 'annotations' for data/out-clean.json, 'scores' for output of "
+             "similarity_modeling.py (also with generated and merged hard negatives), 'candidates' for "
+             "hard negative candidates with similarity scores from negatives-exclusive-sets.py.",
+    )
+    parser.add_argument("--file", help="Imported or exported file.")
+    parser.add_argument("--source", default=None, help="Name of scoring run, defaults to imported file name.")
+    parser.add_argument("--text-id", help="Text shown by 'show'.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    with DatasetStore(args.store) as store:
+        if args.action in ("import", "export"):
+            if args.kind is None or args.file is None:
+                print(f"You must specify --kind and --file with '{args.action}' action.")
+                exit(-1)
+            if args.action == "import":
+                count = store.import_file(args.kind, args.file, args.source)
+                print(f"Imported {count} texts from {args.file} into {args.store}.")
+            else:
+                count = store.export_file(args.kind, args.file, args.source)
+                print(f"Exported {count} records to {args.file}.")
+
+        if args.action == "show":
+            view = store.text_view(args.text_id)
+            if view is None:
+                print(f"Text {args.text_id} not found in {args.store}.")
+                exit(-1)
+            print(json.dumps(view, indent=4, ensure_ascii=False))
+
+        if args.action == "stats":
+            for table, count in store.stats().items():
+                print(f"{table}: {count}")
@@ -1,8 +1,8 @@
+import argparse
 import json
 import numpy as np
-from sentence_transformers import CrossEncoder, SentenceTransformer
-import torch
-from torch import nn
+
+from profiling import add_profile_args, count, profiler_from_args, timer
 
 class TopicEvaluator:
     def __init__(self, *args):
@@ -11,7 +11,8 @@ class TopicEvaluator:
     def get_results(self, generated):
         results = []
         for metric in self.metrics:
-            score_list = self.create_score_list(metric, generated)
+            with timer(f"metric: {metric.name}"):
+                score_list = self.create_score_list(metric, generated)
             # convert list to floats
             score_list = [float(score) for score in score_list]
             result = {
@@ -79,6 +80,9 @@ class CrossEncoderMetric1to1(Metric):
     name = "cross-encoder/nli-deberta-v3-base - 1 to 1 matching."
 
     def __init__(self):
+        # Model libraries are imported by metrics which use them, BasicMetric does not need them
+        from sentence_transformers import CrossEncoder
+
         self.ce = CrossEncoder('cross-encoder/stsb-TinyBERT-L-4')
 
     def calculate_matching_score(self, annotator_topics, generated_topics) -> float:
@@ -122,6 +126,9 @@ class MLMSimilarity1to1(Metric):
     name = "mlm-cosine-similarities - 1 to 1 matching."
 
     def __init__(self):
+        from sentence_transformers import SentenceTransformer
+        from torch import nn
+
         self.model = SentenceTransformer('sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
         self.cosine_similarity = nn.CosineSimilarity(dim=2)
 
@@ -136,6 +143,8 @@ class MLMSimilarity1to1(Metric):
         return np.mean(scores)
 
     def compare_pairs(self, annotator_topics, generated_topics):
+        import torch
+
         annotator_topics_embedding = self.model.encode(annotator_topics)
         annotator_topics_embedding = torch.tensor(np.array(annotator_topics_embedding))
         annotator_topics_embedding = annotator_topics_embedding.reshape(annotator_topics_embedding.size(0), 1, -1)
@@ -174,6 +183,8 @@ class CrossEncoderMetric(Metric):
     name = "cross-encoder/nli-deberta-v3-base"
 
     def __init__(self):
+        from sentence_transformers import CrossEncoder
+
         self.ce = CrossEncoder('cross-encoder/stsb-TinyBERT-L-4')
 
     def calculate_matching_score(self, annotator_topics, generated_topics) -> float:
@@ -201,13 +212,20 @@ class CrossEncoderMetric(Metric):
 
 
 if __name__ == "__main__":
-    with open("topic-generation-logs/2024-05-08_00-41-35-generated-topics.json", mode="r") as topics_json:
-        cross_enc_1to1 = CrossEncoderMetric1to1()
-        cross_enc = CrossEncoderMetric()
-        mlm_cos_sim = MLMSimilarity1to1()
+    parser = argparse.ArgumentParser(description="Scores generated topics of a generation log against annotator topics.")
+    add_profile_args(parser)
+    args = parser.parse_args()
+
+    with profiler_from_args(args, "evaluate_topic_modelling"), \
+            open("topic-generation-logs/2024-05-08_00-41-35-generated-topics.json", mode="r") as topics_json:
+        with timer("model_load"):
+            cross_enc_1to1 = CrossEncoderMetric1to1()
+            cross_enc = CrossEncoderMetric()
+            mlm_cos_sim = MLMSimilarity1to1()
         evaluator = TopicEvaluator(BasicMetric(), cross_enc, cross_enc_1to1, mlm_cos_sim)
 
-        all_topics = json.load(topics_json)
+        with timer("json_parse"):
+            all_topics = json.load(topics_json)
         all_topics = [text_topics for text_topics in all_topics if len(text_topics["annotator_topics"]) != 0]
         # text_topics contains generated and annotator topics for one text
         for i, text_topics in enumerate(all_topics):
@@ -216,9 +234,13 @@ if __name__ == "__main__":
             generated_topics = text_topics["generated_topics"]
             print(f"Processing {i}/{len(all_topics)} annotator_topics {annotator_topics}")
 
-            ce_scores_1to1 = cross_enc_1to1.calc_scores_for_text(annotator_topics, generated_topics)
-            ce_scores = cross_enc.calc_scores_for_text(annotator_topics, generated_topics)
-            mlm_scores_1to1 = mlm_cos_sim.calc_scores_for_text(annotator_topics, generated_topics)
+            count("texts")
+            with timer("cross_encoder_1to1"):
+                ce_scores_1to1 = cross_enc_1to1.calc_scores_for_text(annotator_topics, generated_topics)
+            with timer("cross_encoder"):
+                ce_scores = cross_enc.calc_scores_for_text(annotator_topics, generated_topics)
+            with timer("mlm_1to1"):
+                mlm_scores_1to1 = mlm_cos_sim.calc_scores_for_text(annotator_topics, generated_topics)
 
             text_topics["scoring"] = {
                 "ce_scores_1to1": ce_scores_1to1,
@@ -227,7 +249,7 @@ if __name__ == "__main__":
             }
 
         # print(json.dumps(all_topics_clean, indent=4, ensure_ascii=False))
-        with open("evaluation-data/out-eval-golden.json", mode="w") as eval_file:
+        with timer("write_output"), open("evaluation-data/out-eval-golden.json", mode="w") as eval_file:
             json.dump(all_topics, eval_file, indent=4, ensure_ascii=False)
 
         res = evaluator.get_results(all_topics)
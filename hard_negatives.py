@@ -2,19 +2,26 @@ import argparse
 import json
 import os
 import re
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 import curses
 
 import jsonlines
-from openai import OpenAI
 
 import getting_user_input
+from dataset_store import CANDIDATE, DatasetStore
+from journal import JsonDictJournal
+from llm_client import LLMClient, ResponseCache, add_cache_args, llm_client_from_args
+from profiling import add_profile_args, count, profiler_from_args, timer
 from utils import (
-    addstr_wordwrap,
+    BackgroundWriter,
     CursesWindow,
-    curses_overflow_restarts,
+    Prefetcher,
     ScreenOwner,
+    iter_json,
     print_job_done,
+    wrap_lines,
 )
 
 
@@ -69,129 +76,272 @@ class OpenAIGeneration:
 
     current_prompt = prompts["alternative"]
 
-    def __init__(self, path):
+    def __init__(self, path, llm_client=None):
         self.data_path = path
+        # Generated results are appended here right away and compacted into `path` from time to time
+        self.checkpoint_path = str(path) + ".checkpoint"
         self.data = []
 
-        already_generated = 0
-        i = 0
-        with jsonlines.open(self.data_path, mode='r') as reader:
-            for i, text_obj in enumerate(reader):
+        with timer("json_parse"), jsonlines.open(self.data_path, mode='r') as reader:
+            for text_obj in reader:
                 self.data.append(text_obj)
-                if "llm_generated_hn" in text_obj:
-                    already_generated += 1
 
+        restored = self.restore_checkpoint()
+        if restored:
+            print(f"Restored {restored} generated hard negatives from {self.checkpoint_path}.")
+
+        already_generated = sum("llm_generated_hn" in text_obj for text_obj in self.data)
         print(
             f"There are {already_generated} already generated hard negatives"
-            f" and {i - already_generated} to generate."
+            f" and {len(self.data) - already_generated} to generate."
         )
 
-        self.client = OpenAI()
+        self.llm_client = LLMClient(ResponseCache()) if llm_client is None else llm_client
 
-    def spam_api(self, take, force_regenerate):
-        print(f"Generating hard negatives for {take} texts.")
-        generated = 0
-        for text_index, text in enumerate(self.data):
-            id = text["text_id"]
-            if not force_regenerate and "llm_generated_hn" in text:
-                continue
-
-            if generated == take:
-                break
+    def restore_checkpoint(self):
+        """
+        Applies results of previous run, which were not compacted into the source file yet.
+        :return: Number of restored results
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return 0
 
-            prompt = f"{OpenAIGeneration.current_prompt}\nVstupní text: {text['text']}"
-            completion = self.client.chat.completions.create(
-                model=OpenAIGeneration.model,
-                messages=[
-                    {"role": "system", "content": OpenAIGeneration.system},
-                    {"role": "user", "content": prompt},
-                ],
+        index_by_id = {text["text_id"]: i for i, text in enumerate(self.data)}
+        restored = 0
+        with open(self.checkpoint_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line might be written only partially when the run was killed
+                    continue
+                if entry["text_id"] in index_by_id:
+                    self.data[index_by_id[entry["text_id"]]]["llm_generated_hn"] = entry["llm_generated_hn"]
+                    restored += 1
+        return restored
+
+    def compact(self):
+        """
+        Writes all results into the source file and empties the checkpoint. Source file is replaced
+        atomically, so it is never left half-written; checkpoint entries applied twice are harmless.
+        """
+        tmp_path = str(self.data_path) + ".tmp"
+        with timer("file_rewrite"), jsonlines.open(tmp_path, mode='w') as writer:
+            writer.write_all(self.data)
+        os.replace(tmp_path, self.data_path)
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    @staticmethod
+    def request_kwargs(text):
+        prompt = f"{OpenAIGeneration.current_prompt}\nVstupní text: {text}"
+        return dict(model=OpenAIGeneration.model, system=OpenAIGeneration.system, user=prompt)
+
+    @staticmethod
+    def parse_response(id, response):
+        """
+        Parses generated hard negatives from API response.
+        :return: Generated hard negatives or None if response is not valid JSON
+        """
+        try:
+            result = json.loads(response)
+        except json.JSONDecodeError:
+            print(
+                f"Error: Couldn't decode JSON response for text {id}."
+                f"Raw response: '{response}'"
             )
-            response = completion.choices[0].message.content
-            try:
-                result = json.loads(response)
-            except json.JSONDecodeError:
-                print(
-                    f"Error: Couldn't decode JSON response for text {id}."
-                    f"Raw response: '{response}'"
-                )
-                continue
-            if OpenAIGeneration.current_prompt == OpenAIGeneration.prompts["alternative"]:
-                result = [item for sublist in result.values() for item in sublist]
-            self.data[text_index]["llm_generated_hn"] = result
-            print(f"Generated hard negatives for text {id}.")
-            generated += 1
+            return None
+        if OpenAIGeneration.current_prompt == OpenAIGeneration.prompts["alternative"]:
+            result = [item for sublist in result.values() for item in sublist]
+        return result
+
+    def generate_one(self, text):
+        with timer("api_call"):
+            completion = self.llm_client.complete(**OpenAIGeneration.request_kwargs(text["text"]))
+        count("cached_responses" if completion.cached else "api_responses")
+        return OpenAIGeneration.parse_response(text["text_id"], completion.content)
+
+    def spam_api(self, take, force_regenerate, workers=4, compact_every=50):
+        print(f"Generating hard negatives for {take} texts.")
+        to_generate = iter(
+            [
+                text_index for text_index, text in enumerate(self.data)
+                if force_regenerate or "llm_generated_hn" not in text
+            ]
+        )
+        generated = 0
+        since_compaction = 0
+        running = {}
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        checkpoint = open(self.checkpoint_path, "a")
+        try:
+            while True:
+                # Keep workers busy, but do not start more requests than needed for `take` results
+                while len(running) < workers and generated + len(running) < take:
+                    text_index = next(to_generate, None)
+                    if text_index is None:
+                        break
+                    running[executor.submit(self.generate_one, self.data[text_index])] = text_index
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    text_index = running.pop(future)
+                    result = future.result()
+                    if result is None:
+                        continue
+
+                    id = self.data[text_index]["text_id"]
+                    self.data[text_index]["llm_generated_hn"] = result
+                    checkpoint.write(json.dumps({"text_id": id, "llm_generated_hn": result}, ensure_ascii=False) + "\n")
+                    checkpoint.flush()
+                    print(f"Generated hard negatives for text {id}.")
+                    generated += 1
+                    since_compaction += 1
+
+                if since_compaction >= compact_every:
+                    checkpoint.close()
+                    self.compact()
+                    checkpoint = open(self.checkpoint_path, "a")
+                    since_compaction = 0
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            checkpoint.close()
+            if os.path.getsize(self.checkpoint_path) > 0:
+                self.compact()
+            else:
+                os.remove(self.checkpoint_path)
 
         if generated < take:
             print(f"Hard negatives for only {generated}/{take} texts generated.")
+        print(self.llm_client.report())
 
-        with jsonlines.open(self.data_path, mode='w') as writer:
-            writer.write_all(self.data)
+
+class MergeCandidates:
+    """
+    Hard negative candidates from `--merge-json` stored in flat arrays. Candidates of text `i` are
+    `topic_ids[offsets[i]:offsets[i + 1]]` with `similarity` at the same positions, topic strings
+    are kept only once in `topics`. `--merge-json` can also be a dataset store (`.sqlite`) with imported candidates.
+    """
+
+    def __init__(self, path):
+        # Imported here, annotation does not need numpy
+        import numpy as np
+
+        if str(path).endswith(".sqlite"):
+            with DatasetStore(str(path)) as store:
+                found = dict(store.hard_negatives(CANDIDATE))
+                candidates = [(text_id, found.get(text_id, [])) for text_id in store.text_ids()]
+        else:
+            # Texts are parsed one by one, only the flat arrays grow with the file
+            candidates = ((text_id, text["potential_negatives_all"]) for text_id, text in iter_json(path))
+
+        self.text_index = {}
+        self.topics = []
+        topic_index = {}
+        offsets = array("q", [0])
+        topic_ids = array("q")
+        similarity = array("d")
+        for i, (text_id, hard_negatives) in enumerate(candidates):
+            self.text_index[text_id] = i
+            for hn in hard_negatives:
+                topic_ids.append(topic_index.setdefault(hn["topic"], len(topic_index)))
+                similarity.append(hn["similarity"])
+            offsets.append(len(topic_ids))
+        self.topics = list(topic_index)
+
+        self.offsets = np.frombuffer(offsets, dtype=np.int64)
+        self.topic_ids = np.frombuffer(topic_ids, dtype=np.int64)
+        self.similarity = np.frombuffer(similarity, dtype=np.float64)
+
+    def select(self, take, sort_threshold=None):
+        """
+        Selects `take` candidates with the lowest similarity, or closest to `sort_threshold` if given,
+        for all texts at once.
+        :return: Tuple (selected topic ids grouped by text, offsets of each text's group)
+        """
+        import numpy as np
+
+        sizes = np.diff(self.offsets)
+        text_of_candidate = np.repeat(np.arange(len(sizes)), sizes)
+        if sort_threshold is None:
+            key = self.similarity
+        else:
+            key = np.abs(self.similarity - sort_threshold)
+
+        # Sorted by text first and by key within text, stable for equal keys
+        order = np.lexsort((key, text_of_candidate))
+        rank = np.arange(len(order)) - self.offsets[text_of_candidate[order]]
+        selected = self.topic_ids[order[rank < take]]
+
+        selected_offsets = np.concatenate(([0], np.cumsum(np.minimum(sizes, take))))
+        return selected, selected_offsets
 
 
 class MergeHN:
     def __init__(self, merge_from_path, merge_to_path, take_api, take_from_dataset):
         print(f"Merging hard negatives from {merge_from_path}.")
-        self.data_from = json.load(open(merge_from_path, mode="r"))
-        self.data_to = []
+        with timer("load_candidates"):
+            self.candidates = MergeCandidates(merge_from_path)
         self.merge_to_path = merge_to_path
 
         self.take_api = take_api
         self.take_from_dataset = take_from_dataset
 
+        texts_total = 0
         hns_total = 0
         with jsonlines.open(merge_to_path, mode='r') as reader:
             for text in reader:
-                self.data_to.append(text)
+                texts_total += 1
                 if "potential_hard_negatives" in text:
                     hns_total += 1
 
         print(
-            f"There are {len(self.data_to) - hns_total} texts in dataset which already have hard negatives."
-            f"Merging hard negatives for {hns_total} texts."
+            f"There are {hns_total} texts in dataset which already have hard negatives. "
+            f"Merging hard negatives for {texts_total - hns_total} texts."
         )
-        if hns_total == len(self.data_to):
+        if hns_total == texts_total:
             print(
                 "All texts have hard negatives."
                 "You can specify --force to remerge not-annotated hard negatives."
             )
 
     def merge(self, hn_sort_threshold, force):
-        for i, text in enumerate(self.data_to):
-            id = text["text_id"]
-            if not force and "potential_hard_negatives" in text:
-                continue
-
-            hn_from_dataset = self.data_from[id]["potential_negatives_all"]
-
-            # sort hard negatives by similarity or threshold
-            if hn_sort_threshold is None:
-                hn_from_dataset = sorted(hn_from_dataset, key=lambda x: x["similarity"])
-            else:
-                hn_from_dataset = sorted(
-                    hn_from_dataset,
-                    key=lambda x: abs(x["similarity"] - hn_sort_threshold),
-                )
-            hn_from_dataset = hn_from_dataset[: self.take_from_dataset]
-            hn_from_dataset = [
-                {"topic": hn["topic"], "type": "from_dataset"} for hn in hn_from_dataset
-            ]
-
-            # take hard negatives from API
-            try:
-                hn_from_api = text["llm_generated_hn"][: self.take_api]
-            except KeyError:
-                print(
-                    f"Warning: There are no generated hard negatives to merge for text {id}."
-                )
-                hn_from_api = []
-            hn_from_api = [{"topic": hn, "type": "generated"} for hn in hn_from_api]
-
-            text["potential_hard_negatives"] = hn_from_dataset + hn_from_api
-            print(f"Merged hard negatives for text {id}.")
+        selected, selected_offsets = self.candidates.select(self.take_from_dataset, hn_sort_threshold)
+        topics = self.candidates.topics
 
-        with jsonlines.open(self.merge_to_path, mode='w') as writer:
-            writer.write_all(self.data_to)
+        # Merged texts are streamed into temporary file, which replaces the source at the end
+        tmp_path = str(self.merge_to_path) + ".tmp"
+        with jsonlines.open(self.merge_to_path, mode='r') as reader, jsonlines.open(tmp_path, mode='w') as writer:
+            for text in reader:
+                id = text["text_id"]
+                if not force and "potential_hard_negatives" in text:
+                    writer.write(text)
+                    continue
+
+                i = self.candidates.text_index[id]
+                hn_from_dataset = [
+                    {"topic": topics[topic_id], "type": "from_dataset"}
+                    for topic_id in selected[selected_offsets[i]:selected_offsets[i + 1]]
+                ]
+
+                # take hard negatives from API
+                try:
+                    hn_from_api = text["llm_generated_hn"][: self.take_api]
+                except KeyError:
+                    print(
+                        f"Warning: There are no generated hard negatives to merge for text {id}."
+                    )
+                    hn_from_api = []
+                hn_from_api = [{"topic": hn, "type": "generated"} for hn in hn_from_api]
+
+                text["potential_hard_negatives"] = hn_from_dataset + hn_from_api
+                writer.write(text)
+                print(f"Merged hard negatives for text {id}.")
+
+        os.replace(tmp_path, self.merge_to_path)
 
 
 class ScreenOwnerHns(ScreenOwner):
@@ -200,12 +350,13 @@ class ScreenOwnerHns(ScreenOwner):
         "You can also skip this text anytime by pressing 's'.\n"
     )
 
-    def __init__(self, crs, text, nb_left, nb_cleaned_this_session, good_topics):
+    def __init__(self, crs, text, nb_left, nb_cleaned_this_session, good_topics, text_layout=None):
         self.good_topics = good_topics
-        super().__init__(crs, text, nb_left, nb_cleaned_this_session)
+        self.annotated_topics = []
+        super().__init__(crs, text, nb_left, nb_cleaned_this_session, text_layout)
 
-    def redraw(self):
-        super().redraw()
+    def draw_header(self):
+        super().draw_header()
 
         if len(self.good_topics):
             self.crs.addstr("Correct topics: \n", curses.A_BOLD)
@@ -215,7 +366,8 @@ class ScreenOwnerHns(ScreenOwner):
 
         self.crs.addstr("\nHard negatives: \n", curses.A_BOLD)
 
-    def annotation_done(self, annotated_topic, hn_count):
+    @staticmethod
+    def annotation_line(annotated_topic, hn_count):
         annotation = "✓" if annotated_topic['annotation'] else "✗"
         type_shortcuts = {
             "from_dataset": "D",
@@ -223,35 +375,63 @@ class ScreenOwnerHns(ScreenOwner):
             "rejected": "R",
         }
         hn_type = type_shortcuts[annotated_topic["type"]]
-        self.crs.addstr(f"{annotation} #{hn_count} {hn_type}: {annotated_topic['topic']}\n")
+        return ((f"{annotation} #{hn_count} {hn_type}: {annotated_topic['topic']}", 0),)
 
-    def redraw_annotated(self, annotated_topics):
-        self.redraw()
+    def body_lines(self):
+        return [
+            self.annotation_line(annotated_topic, hn_count)
+            for hn_count, annotated_topic in enumerate(self.annotated_topics, start=1)
+        ]
 
-        for count, annotated_topic in enumerate(annotated_topics, start=1):
-            self.annotation_done(annotated_topic, count)
+    def redraw_annotated(self, annotated_topics):
+        self.annotated_topics = annotated_topics
+        # Only new or toggled annotation lines are redrawn
+        self.update_body(self.body_lines())
 
 
 class HNAnnotator:
-    def __init__(self, source_path, crs):
+    def __init__(self, source_path, crs, compact_every=100, prefetch=4):
         self.source_path = source_path
-        self.data = json.load(open(source_path, mode="r"))
+        # Decisions are appended to journal, the source file is rewritten in background from time to time
+        self.journal = JsonDictJournal(source_path, compact_every=compact_every)
+        with timer("journal_load"):
+            self.data = self.journal.load()
 
         self.out_json_path = str(source_path).strip(".json") + "_annotated.jsonl"
-        if os.path.exists(self.out_json_path):
-            with jsonlines.open(self.out_json_path, mode='r') as reader:
-                self.out_data = list(reader)
-        else:
-            self.out_data = []
+        self.out_file = open(self.out_json_path, mode="a", encoding="utf-8")
         self.curses_err_count = 0
         self.crs = crs
+        self.prefetch = prefetch
+
+    def close(self):
+        self.out_file.close()
+        self.journal.close()
+
+    def to_annotate(self):
+        for text_id, text in self.data.items():
+            if "skipped" in text or any("annotation" in hn for hn in text["potential_hard_negatives"]):
+                continue
+            yield text_id
+
+    def prepare_screen(self, text_id):
+        text = self.data[text_id]["text"]
+        _, width = self.crs.getmaxyx()
+        return text_id, (width, wrap_lines(text + "\n", width))
+
+    def save(self, text_id, update, out_record):
+        with timer("save"):
+            if out_record is not None:
+                self.out_file.write(json.dumps(out_record, ensure_ascii=False) + "\n")
+                self.out_file.flush()
+            self.journal.append(text_id, update)
 
     def annotate_text(self, screen_owner, potential_hard_negatives):
         annotated_hard_negatives = []
 
-        for count, hard_negative in enumerate(potential_hard_negatives, start=1):
-            self.crs.addstr(f"{hard_negative['topic']} \n")
-            is_good_hn = getting_user_input.accept_or_reject(self.crs, "Good hard negative? [Y/n]")
+        for position, hard_negative in enumerate(potential_hard_negatives, start=1):
+            is_good_hn = screen_owner.accept_or_reject(
+                "Good hard negative? [Y/n]", (f"{hard_negative['topic']} \n", 0)
+            )
 
             annotated_hn = {
                 "topic": hard_negative["topic"],
@@ -278,24 +458,32 @@ class HNAnnotator:
         if quit_or_proceed == "quit":
             return 0
 
+        # Next texts are prepared in background while the user annotates, saves are written in background
+        with Prefetcher(self.to_annotate(), self.prepare_screen, self.prefetch) as screens, \
+                BackgroundWriter() as writer:
+            annotated_texts_session = self.annotate_screens(
+                screens, writer, number_of_texts, number_of_annotated_texts
+            )
+
+        if number_of_texts - number_of_annotated_texts - annotated_texts_session == 0:
+            print_job_done(self.crs)
+
+    def annotate_screens(self, screens, writer, number_of_texts, number_of_annotated_texts):
+        """
+        :return: Number of texts annotated in this session
+        """
         annotated_texts_session = 0
         end = False
 
-        for text_id in self.data:
-            if "skipped" in self.data[text_id]:
-                continue
-
+        for text_id, text_layout in screens:
             skipped = False
-            if any(
-                    "annotation" in hn
-                    for hn in self.data[text_id]["potential_hard_negatives"]
-            ):
-                continue
             to_annotate = number_of_texts - number_of_annotated_texts - annotated_texts_session
             text = self.data[text_id]["text"]
 
             good_topics = self.data[text_id]["topics"]
-            screen_owner = ScreenOwnerHns(self.crs, text, to_annotate, annotated_texts_session, good_topics)
+            screen_owner = ScreenOwnerHns(
+                self.crs, text, to_annotate, annotated_texts_session, good_topics, text_layout
+            )
 
             potential_hard_negatives = self.data[text_id]["potential_hard_negatives"]
             try:
@@ -312,34 +500,27 @@ class HNAnnotator:
             except getting_user_input.SkipError:
                 skipped = True
 
+            out_record = None
             if skipped:
-                self.data[text_id]["skipped"] = True
+                update = {"skipped": True}
             else:
                 selected_hns = []
                 for hn in annotated_hard_negatives:
                     if hn["annotation"]:
                         selected_hns.append(hn["topic"])
-                self.data[text_id]["potential_hard_negatives"] = annotated_hard_negatives
-                self.out_data.append(
-                    {
-                        "text_id": text_id,
-                        "text": text,
-                        "topics": self.data[text_id]["topics"],
-                        "hard_negatives": selected_hns,
-                    }
-                )
+                update = {"potential_hard_negatives": annotated_hard_negatives}
 
-            # save data to input file for annotation control
-            json.dump(
-                self.data,
-                open(self.source_path, "w"),
-                indent=4,
-                ensure_ascii=False,
-            )
+                # append to output file for final merging
+                out_record = {
+                    "text_id": text_id,
+                    "text": text,
+                    "topics": self.data[text_id]["topics"],
+                    "hard_negatives": selected_hns,
+                }
 
-            # save data to output file for final merging
-            with jsonlines.open(self.out_json_path, mode='w') as writer:
-                writer.write_all(self.out_data)
+            # save decision for annotation control, applied to input file by journal compaction
+            self.data[text_id].update(update)
+            writer.submit(self.save, text_id, update, out_record)
 
             annotated_texts_session += 1
 
@@ -349,8 +530,7 @@ class HNAnnotator:
             if end:
                 break
 
-        if number_of_texts - number_of_annotated_texts - annotated_texts_session == 0:
-            print_job_done(self.crs)
+        return annotated_texts_session
 
     def put_introduction(self, number_of_texts, number_of_annotated_texts):
         self.crs.addstr("*******************************************\n")
@@ -376,15 +556,14 @@ class HNAnnotator:
         self.crs.addstr("Press y/Y if the topic is relevant, n/N if it is not.\n"
                         "You can also skip text anytime by pressing 's'.\n")
 
+        self.crs.addstr("Long texts can be scrolled with arrow keys or PgUp/PgDn.\n")
         self.crs.addstr("Your annotations will be saved after each text.\n\n\n")
         self.crs.addstr("If you want to start annotating, press 'c' or 'q' to quit.\n\n")
 
     def redo_if_needed(self, screen_owner, annotated_hard_negatives):
         while True:
-            addstr_wordwrap(
-                self.crs,
-                "\n\nPress 'c' to continue, 'r' to redo if you made a mistake, 'q' to quit. ",
-                0,
+            screen_owner.show_prompt(
+                ("\n\nPress 'c' to continue, 'r' to redo if you made a mistake, 'q' to quit. ", 0)
             )
             action = getting_user_input.redo_or_proceed(self.crs)
             if action == "redo":
@@ -414,11 +593,13 @@ class HNAnnotator:
         return annotated_hard_negatives
 
 
-@curses_overflow_restarts
 def run_annotation(annotation_source):
     with CursesWindow() as crs:
         annotator = HNAnnotator(annotation_source, crs)
-        annotator.annotate_loop()
+        try:
+            annotator.annotate_loop()
+        finally:
+            annotator.close()
 
 
 if "__main__" == __name__:
@@ -467,13 +648,27 @@ if "__main__" == __name__:
              "Use with 'generate' action to limit number of API calls.",
     )
 
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of concurrent API requests in 'generate' action.",
+    )
+    parser.add_argument(
+        "--compact-every",
+        type=int,
+        default=50,
+        help="Number of generated texts after which 'generate' rewrites --source with results "
+             "kept in its checkpoint file.",
+    )
+
     parser.add_argument(
         "--merge-json",
         type=Path,
         default=None,
         help="Path to json file with hard negatives to merge with clean dataset."
              "Should be json generated with `negative-exclusive-sets.py` with "
-             "added similarity scores using similarity modeling.",
+             "added similarity scores using similarity modeling, or dataset store (.sqlite) with imported candidates.",
     )
     parser.add_argument(
         "--hn-from-api",
@@ -504,6 +699,9 @@ if "__main__" == __name__:
              "'merge': Turn off skipping texts with already merged hard negatives.",
     )
 
+    add_cache_args(parser)
+    add_profile_args(parser)
+
     args = parser.parse_args()
 
     if args.action == "generate":
@@ -514,7 +712,9 @@ if "__main__" == __name__:
             exit(-1)
 
         print("Calling OpenAI API to generate hard negatives.")
-        OpenAIGeneration(src_path).spam_api(args.take, args.force)
+        with profiler_from_args(args, "hard_negatives_generate"):
+            generation = OpenAIGeneration(src_path, llm_client_from_args(args))
+            generation.spam_api(args.take, args.force, workers=args.workers, compact_every=args.compact_every)
 
     if args.action == "merge":
         if args.merge_json is None:
@@ -525,10 +725,13 @@ if "__main__" == __name__:
             print(f"File {args.json} not found.")
             exit(-1)
 
-        merger = MergeHN(
-            args.merge_json, args.source, args.hn_from_api, args.hn_from_dataset
-        )
-        merger.merge(args.hn_from_dataset_threshold, args.force)
+        with profiler_from_args(args, "hard_negatives_merge"):
+            merger = MergeHN(
+                args.merge_json, args.source, args.hn_from_api, args.hn_from_dataset
+            )
+            with timer("merge"):
+                merger.merge(args.hn_from_dataset_threshold, args.force)
 
     if args.action == "annotate":
-        run_annotation(args.annotate_source)
+        with profiler_from_args(args, "hard_negatives_annotate"):
+            run_annotation(args.annotate_source)
@@ -0,0 +1,185 @@
+import json
+import os
+import threading
+
+from profiling import timer
+
+
+class Journal:
+    """
+    Append-only write-ahead journal of record updates for a dataset file. Each update is one JSONL line
+    `{"text_id": ..., "update": {...}}`, so saving one decision costs the same no matter how large
+    the dataset is. Updates are applied to the dataset file itself only by compaction, which replaces
+    the file atomically and can run in a background thread.
+
+    Compaction first renames the journal to `<journal>.compacting` and starts a new journal, so new
+    updates can be appended while the dataset file is rewritten. Loading replays both files, a crash
+    at any point therefore loses no update. Subclasses define how the dataset file is read and written.
+    """
+
+    def __init__(self, source_path, compact_every=None):
+        """
+        :param source_path: Path to the dataset file
+        :param compact_every: Number of updates after which compaction starts in background,
+            None compacts only on `compact` and `close`
+        """
+        self.source_path = str(source_path)
+        self.journal_path = self.source_path + ".journal"
+        self.compacting_path = self.journal_path + ".compacting"
+        self.compact_every = compact_every
+        self.updates_since_compaction = 0
+        self.compaction_thread = None
+        # Exception of failed background compaction, raised on next append, compact or close
+        self.compaction_error = None
+        self.file = None
+
+    def read_source(self):
+        raise NotImplementedError
+
+    def write_source(self, data, path):
+        raise NotImplementedError
+
+    def apply(self, data, text_id, update):
+        raise NotImplementedError
+
+    @staticmethod
+    def read_updates(path):
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line might be written only partially when the program was killed
+                    continue
+                yield entry["text_id"], entry["update"]
+
+    def replay(self, data, path):
+        for text_id, update in self.read_updates(path):
+            self.apply(data, text_id, update)
+        return data
+
+    def load(self):
+        """
+        Reads the dataset file with all journaled updates applied and opens the journal for appending.
+        """
+        # Compaction interrupted by a crash is finished first
+        if os.path.exists(self.compacting_path):
+            self.compact_rotated()
+        data = self.replay(self.read_source(), self.journal_path)
+        self.file = open(self.journal_path, "a", encoding="utf-8")
+        return data
+
+    def append(self, text_id, update):
+        self.file.write(json.dumps({"text_id": text_id, "update": update}, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        # The update is already saved, only the failed compaction is reported
+        self.raise_compaction_error()
+
+        self.updates_since_compaction += 1
+        if self.compact_every is not None and self.updates_since_compaction >= self.compact_every:
+            self.compact_in_background()
+
+    def rotate(self):
+        """
+        Moves current journal aside for compaction and starts a new one.
+        :return: False if previous compaction is still running
+        """
+        if self.compaction_thread is not None and self.compaction_thread.is_alive():
+            return False
+        # Journal left by failed compaction would be overwritten, so it is compacted first
+        self.compact_rotated()
+        self.file.close()
+        if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) > 0:
+            os.replace(self.journal_path, self.compacting_path)
+        self.file = open(self.journal_path, "a", encoding="utf-8")
+        self.updates_since_compaction = 0
+        return True
+
+    def compact_rotated(self):
+        if not os.path.exists(self.compacting_path):
+            return
+        with timer("journal_compaction"):
+            data = self.replay(self.read_source(), self.compacting_path)
+            tmp_path = self.source_path + ".tmp"
+            self.write_source(data, tmp_path)
+            os.replace(tmp_path, self.source_path)
+            os.remove(self.compacting_path)
+
+    def compact_in_thread(self):
+        try:
+            self.compact_rotated()
+        except Exception as e:
+            self.compaction_error = e
+
+    def raise_compaction_error(self):
+        if self.compaction_error is not None:
+            error, self.compaction_error = self.compaction_error, None
+            raise error
+
+    def compact_in_background(self):
+        if self.rotate():
+            self.compaction_thread = threading.Thread(target=self.compact_in_thread, daemon=True)
+            self.compaction_thread.start()
+
+    def compact(self):
+        """
+        Applies all journaled updates to the dataset file, waits for background compaction first.
+        """
+        if self.compaction_thread is not None:
+            self.compaction_thread.join()
+        self.raise_compaction_error()
+        self.rotate()
+        self.compact_rotated()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.compact()
+        self.file.close()
+        self.file = None
+        if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) == 0:
+            os.remove(self.journal_path)
+
+    def discard(self):
+        """
+        Closes the journal and removes it together with the dataset file, use when updates were exported elsewhere.
+        """
+        if self.compaction_thread is not None:
+            self.compaction_thread.join()
+        self.compaction_error = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        for path in (self.journal_path, self.compacting_path, self.source_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class JsonDictJournal(Journal):
+    """
+    Journal for json file with dict of records keyed by text id, updates are merged into the records.
+    With `create` the file does not have to exist yet and updates of unknown text ids add new records.
+    """
+
+    def __init__(self, source_path, compact_every=None, create=False):
+        super().__init__(source_path, compact_every)
+        self.create = create
+
+    def read_source(self):
+        if self.create and not os.path.exists(self.source_path):
+            return {}
+        with open(self.source_path, "r") as f:
+            return json.load(f)
+
+    def write_source(self, data, path):
+        with open(path, "w") as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+
+    def apply(self, data, text_id, update):
+        if self.create:
+            data.setdefault(text_id, {}).update(update)
+        else:
+            data[text_id].update(update)
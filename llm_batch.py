@@ -0,0 +1,355 @@
+import argparse
+import json
+import os
+from datetime import datetime
+
+import jsonlines
+
+from llm_client import LLMClient, ResponseCache, add_cache_args
+from utils import get_annotations
+
+CHAT_COMPLETIONS_URL = "/v1/chat/completions"
+
+
+class TopicsTask:
+    name = "topics"
+
+    def __init__(self):
+        from topic_modelling import GptGenerator
+
+        self.generator = GptGenerator(LLMClient())
+
+    def items(self, source, args):
+        for text, _, key in get_annotations(source, num_iterations=args.take):
+            yield key, self.generator.request_kwargs(text)
+
+    def merge(self, source, contents, output, args):
+        generator_settings = self.generator.settings_fingerprint()
+        generated_all = []
+        for text, topics, key in get_annotations(source, num_iterations=args.take):
+            if key not in contents:
+                continue
+            generated_all.append(
+                {
+                    "text-id": key,
+                    "text": text,
+                    "annotator_topics": topics,
+                    "generated_topics": contents[key].split("\n"),
+                    "generator-settings": generator_settings,
+                }
+            )
+
+        with open(output, "w") as f:
+            json.dump(generated_all, f, indent=4, ensure_ascii=False)
+        # Records are also added to generation logs, so interactive generation does not repeat them
+        with jsonlines.open(os.path.splitext(output)[0] + ".jsonl", mode="w") as writer:
+            writer.write_all(generated_all)
+        return len(generated_all)
+
+    def fake_content(self, request):
+        return "téma první\ntéma druhé\ntéma třetí"
+
+    def default_output(self, source):
+        time_string = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        return f"topic-generation-logs/{time_string}-generated-topics.json"
+
+
+class DirectScoreTask:
+    name = "direct-score"
+
+    def __init__(self):
+        from similarity_modeling import DirectScoreEvaluator
+
+        self.evaluator = DirectScoreEvaluator(LLMClient())
+
+    @staticmethod
+    def load_texts(source):
+        """
+        :param source: `data/out-clean.json` with annotator topics or `data/gold_annotated_dataset.json`
+            with topics labeled as relevant or not
+        :return: Dict which maps text id to text and dict which maps its topics to labels, None without labels
+        """
+        data = json.load(open(source, "r"))
+        if isinstance(data, list) and all("user_topics" in record for record in data):
+            # Later annotation of a text replaces the earlier one, like in similarity_modeling.py
+            return {
+                record["text_id"]: {"text": record["text"], "topics": dict.fromkeys(record["user_topics"])}
+                for record in data
+            }
+        if isinstance(data, dict) and all(isinstance(text.get("topics"), dict) for text in data.values()):
+            return data
+        raise ValueError(
+            f"{source} is neither list of annotations like data/out-clean.json "
+            "nor texts with labeled topics like data/gold_annotated_dataset.json."
+        )
+
+    def items(self, source, args):
+        data = self.load_texts(source)
+        for text_id in list(data)[: args.take]:
+            yield text_id, self.evaluator.request_kwargs(data[text_id]["text"], list(data[text_id]["topics"]))
+
+    def merge(self, source, contents, output, args):
+        data = self.load_texts(source)
+        scores_dict = {}
+        for text_id, content in contents.items():
+            topics = data[text_id]["topics"]
+            try:
+                similarities = list(self.evaluator.parse_answer(content))
+            except (IndexError, ValueError):
+                print(f"Error: Couldn't parse scores for text {text_id}. Raw response: '{content}'")
+                continue
+            scores = []
+            for t, s in zip(topics, similarities):
+                score = {"topic": t, "similarity": s}
+                if topics[t] is not None:
+                    score["label"] = topics[t]
+                scores.append(score)
+            scores_dict[text_id] = {"text": data[text_id]["text"], "scores": scores}
+
+        json.dump(scores_dict, open(output, "w"), indent=4, ensure_ascii=False)
+        return len(scores_dict)
+
+    def fake_content(self, request):
+        user = request["messages"][-1]["content"]
+        topics = user.split("\n\n", 1)[1].split("\n")
+        return "\n".join(f"{topic}: 0.5" for topic in topics)
+
+    def default_output(self, source):
+        return "evaluation-data/out-direct-score.json"
+
+
+class HardNegativesTask:
+    name = "hard-negatives"
+
+    def items(self, source, args):
+        from hard_negatives import OpenAIGeneration
+
+        with jsonlines.open(source, mode="r") as reader:
+            selected = 0
+            for text in reader:
+                if not args.force and "llm_generated_hn" in text:
+                    continue
+                if args.take is not None and selected == args.take:
+                    break
+                selected += 1
+                yield text["text_id"], OpenAIGeneration.request_kwargs(text["text"])
+
+    def merge(self, source, contents, output, args):
+        from hard_negatives import OpenAIGeneration
+
+        with jsonlines.open(source, mode="r") as reader:
+            data = list(reader)
+
+        merged = 0
+        for text in data:
+            id = text["text_id"]
+            if id not in contents:
+                continue
+            result = OpenAIGeneration.parse_response(id, contents[id])
+            if result is None:
+                continue
+            text["llm_generated_hn"] = result
+            merged += 1
+
+        with jsonlines.open(output, mode="w") as writer:
+            writer.write_all(data)
+        return merged
+
+    def fake_content(self, request):
+        return json.dumps({"popis": ["alternativa první", "alternativa druhá"]}, ensure_ascii=False)
+
+    def default_output(self, source):
+        return source
+
+
+# Each task creates requests for records of source dataset by `items`, puts generated answers back into records
+# matched by text id by `merge` and provides answers in the expected format for fake results by `fake_content`
+TASKS = {task.name: task for task in (TopicsTask, DirectScoreTask, HardNegativesTask)}
+
+
+def custom_id(task_name, text_id):
+    return f"{task_name}:{text_id}"
+
+
+def split_custom_id(id):
+    task_name, text_id = id.split(":", 1)
+    return task_name, text_id
+
+
+def prepare(task, args):
+    """
+    Phase one: writes request for every text to jsonl file in batch API format.
+    """
+    os.makedirs(os.path.dirname(args.requests) or ".", exist_ok=True)
+    count = 0
+    with jsonlines.open(args.requests, mode="w") as writer:
+        for text_id, request_kwargs in task.items(args.source, args):
+            writer.write(
+                {
+                    "custom_id": custom_id(task.name, text_id),
+                    "method": "POST",
+                    "url": CHAT_COMPLETIONS_URL,
+                    "body": LLMClient.create_request(**request_kwargs),
+                }
+            )
+            count += 1
+    print(f"Written {count} requests to {args.requests}.")
+
+
+def read_results(path, task_name):
+    """
+    Reads results jsonl in batch API format.
+    :return: Tuple (dict which maps text id to answer content, dict which maps text id to response body)
+    """
+    contents = {}
+    bodies = {}
+    failed = 0
+    with jsonlines.open(path, mode="r") as reader:
+        for result in reader:
+            result_task, text_id = split_custom_id(result["custom_id"])
+            if result_task != task_name:
+                continue
+            response = result.get("response")
+            if result.get("error") or response is None or response["status_code"] != 200:
+                failed += 1
+                print(f"Error: Request {result['custom_id']} failed: {result.get('error') or response}")
+                continue
+            bodies[text_id] = response["body"]
+            contents[text_id] = response["body"]["choices"][0]["message"]["content"]
+    if failed:
+        print(f"{failed} requests failed, run 'prepare' again to create requests for missing texts.")
+    return contents, bodies
+
+
+def fill_cache(cache, requests_path, task_name, bodies):
+    """
+    Stores batch results in response cache, so interactive runs with the same requests are replayed.
+    """
+    stored = 0
+    with jsonlines.open(requests_path, mode="r") as reader:
+        for request in reader:
+            result_task, text_id = split_custom_id(request["custom_id"])
+            if result_task != task_name or text_id not in bodies:
+                continue
+            body = bodies[text_id]
+            response = {"content": body["choices"][0]["message"]["content"], "usage": body.get("usage")}
+            cache.put(ResponseCache.key(request["body"]), request["body"], response)
+            stored += 1
+    return stored
+
+
+def ingest(task, args):
+    """
+    Phase two: merges results jsonl back into dataset records by custom id.
+    """
+    contents, bodies = read_results(args.results, task.name)
+    output = args.output or task.default_output(args.source)
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    merged = task.merge(args.source, contents, output, args)
+    print(f"Merged {merged}/{len(contents)} results into {output}.")
+
+    if not args.no_cache and args.requests is not None:
+        cache = ResponseCache(args.cache_dir, args.cache_size_mb)
+        stored = fill_cache(cache, args.requests, task.name, bodies)
+        print(f"Stored {stored} responses in {args.cache_dir}.")
+
+
+def fake(args):
+    """
+    Creates results file for requests file without calling the API, for trying out both phases locally.
+    """
+    tasks = {}
+    count = 0
+    with jsonlines.open(args.requests, mode="r") as reader, jsonlines.open(args.results, mode="w") as writer:
+        for request in reader:
+            task_name, _ = split_custom_id(request["custom_id"])
+            if task_name not in tasks:
+                tasks[task_name] = TASKS[task_name]()
+            content = tasks[task_name].fake_content(request["body"])
+            count += 1
+            writer.write(
+                {
+                    "id": f"batch_req_fake_{count}",
+                    "custom_id": request["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "request_id": f"fake_{count}",
+                        "body": {
+                            "id": f"chatcmpl-fake-{count}",
+                            "object": "chat.completion",
+                            "model": request["body"]["model"],
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "message": {"role": "assistant", "content": content},
+                                    "finish_reason": "stop",
+                                }
+                            ],
+                            "usage": None,
+                        },
+                    },
+                    "error": None,
+                }
+            )
+    print(f"Written {count} fake results to {args.results}.")
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Batch mode for LLM jobs. 'prepare' writes requests jsonl for batch API, "
+                    "'ingest' merges results jsonl back into dataset, "
+                    "'fake' creates results for requests file without calling the API."
+    )
+    parser.add_argument("action", choices=["prepare", "ingest", "fake"])
+    parser.add_argument("--task", choices=list(TASKS), help="Kind of job, required by 'prepare' and 'ingest'.")
+    parser.add_argument(
+        "--source",
+        help="Dataset to create requests for and merge results into. Annotated json for 'topics', "
+             "data/out-clean.json or data/gold_annotated_dataset.json for 'direct-score', "
+             "jsonlines with texts for 'hard-negatives'.",
+    )
+    parser.add_argument("--requests", default=None, help="Requests jsonl file.")
+    parser.add_argument("--results", default=None, help="Results jsonl file, required by 'ingest' and 'fake'.")
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Output file of 'ingest'. Defaults to new generated topics log for 'topics', "
+             "evaluation-data/out-direct-score.json for 'direct-score' and --source for 'hard-negatives'.",
+    )
+    parser.add_argument("--take", type=int, default=None, help="Number of texts to create requests for.")
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        default=False,
+        help="'hard-negatives': Create requests also for texts with already generated hard negatives.",
+    )
+    add_cache_args(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    if args.action == "fake":
+        if args.requests is None or args.results is None:
+            print("You must specify --requests and --results with 'fake' action.")
+            exit(-1)
+        fake(args)
+        exit(0)
+
+    if args.task is None or args.source is None:
+        print(f"You must specify --task and --source with '{args.action}' action.")
+        exit(-1)
+    task = TASKS[args.task]()
+
+    if args.action == "prepare":
+        if args.requests is None:
+            print("You must specify --requests with 'prepare' action.")
+            exit(-1)
+        prepare(task, args)
+
+    if args.action == "ingest":
+        if args.results is None:
+            print("You must specify --results with 'ingest' action.")
+            exit(-1)
+        ingest(task, args)
@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+# Result of one chat completion. `usage` is dict with prompt, completion and total token counts,
+# `latency` is time spent waiting for the API (zero for cached responses).
+Completion = namedtuple("Completion", ["content", "usage", "latency", "cached"])
+
+
+class ResponseCache:
+    """
+    On-disk cache of chat completion responses. Each response is stored in its own json file
+    named by SHA-256 hash of the request (model, messages and sampling parameters), so the same
+    request always maps to the same file and concurrent writers never corrupt each other.
+    When `max_size_mb` is set, least recently used responses are removed once the cache grows over it.
+    """
+
+    def __init__(self, directory="llm-cache", max_size_mb=None):
+        self.directory = directory
+        self.max_size = None if max_size_mb is None else int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # The directory is created and its size summed only on first write, runs without API calls do not touch it
+        self.size = None
+
+    @staticmethod
+    def key(request):
+        canonical = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def ensure_size(self):
+        if self.size is None:
+            self.size = sum(os.path.getsize(path) for path in self.files())
+
+    def files(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".json"):
+                    yield os.path.join(root, name)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+            # Access time is tracked by modification time for least recently used eviction
+            os.utime(path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # FileNotFoundError also when the response was evicted after it was read
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return entry["response"]
+
+    def put(self, key, request, response):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps({"request": request, "response": response}, ensure_ascii=False).encode("utf-8")
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+
+        # Size of the replaced response is read together with the replacement, so concurrent writers count it once
+        with self.lock:
+            self.ensure_size()
+            previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            self.size += len(data) - previous_size
+            if self.max_size is not None and self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        files = sorted(self.files(), key=os.path.getmtime)
+        # Free a bit more than needed, so eviction does not run on every following write
+        target = self.max_size * 0.9
+        for path in files:
+            if self.size <= target:
+                break
+            self.size -= os.path.getsize(path)
+            os.remove(path)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self):
+        with self.lock:
+            self.ensure_size()
+        return (
+            f"LLM cache {self.directory}: {self.hits} hits, {self.misses} misses "
+            f"(hit rate {self.hit_rate:.1%}), {self.size / 1024 / 1024:.1f} MB"
+        )
+
+
+class LLMClient:
+    """
+    Shared layer for chat completion calls. Responses are looked up in `cache` first and the API is
+    called only on a miss, so a replayed run works offline. With `bypass_cache` the API is always
+    called and cached responses are refreshed. `api_key` defaults to OPENAI_API_KEY environment variable.
+    """
+
+    def __init__(self, cache=None, bypass_cache=False, base_url=None, api_key=None):
+        self.cache = cache
+        self.bypass_cache = bypass_cache
+        self.base_url = base_url
+        self.api_key = api_key
+        self._client = None
+        self._async_client = None
+
+    @property
+    def client(self):
+        # Clients are created lazily, replaying from cache needs neither network nor API key
+        if self._client is None:
+            from openai import OpenAI
+
+            self._client = OpenAI(base_url=self.base_url, api_key=self.api_key)
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            from openai import AsyncOpenAI
+
+            # Retries are left to the caller, which can adapt concurrency on rate limits
+            self._async_client = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key, max_retries=0)
+        return self._async_client
+
+    @staticmethod
+    def create_request(model, system, user, **params):
+        return {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system},
+                {"role": "user", "content": user},
+            ],
+            **params,
+        }
+
+    def lookup(self, request):
+        if self.cache is None:
+            return None, None
+        key = ResponseCache.key(request)
+        if self.bypass_cache:
+            return key, None
+        return key, self.cache.get(key)
+
+    def store(self, key, request, result, latency):
+        response = {
+            "content": result.choices[0].message.content,
+            "usage": result.usage.model_dump() if result.usage is not None else None,
+        }
+        if self.cache is not None:
+            self.cache.put(key, request, response)
+        return Completion(response["content"], response["usage"], latency, False)
+
+    def complete(self, model, system, user, **params):
+        """
+        Creates chat completion with system and user message.
+        :param params: Sampling parameters passed to the API, e.g. temperature or max_tokens
+        :return: `Completion`
+        """
+        request = self.create_request(model, system, user, **params)
+        key, cached = self.lookup(request)
+        if cached is not None:
+            return Completion(cached["content"], cached["usage"], 0.0, True)
+
+        start = time.perf_counter()
+        result = self.client.chat.completions.create(**request)
+        return self.store(key, request, result, time.perf_counter() - start)
+
+    async def complete_async(self, model, system, user, **params):
+        request = self.create_request(model, system, user, **params)
+        key, cached = self.lookup(request)
+        if cached is not None:
+            return Completion(cached["content"], cached["usage"], 0.0, True)
+
+        start = time.perf_counter()
+        result = await self.async_client.chat.completions.create(**request)
+        return self.store(key, request, result, time.perf_counter() - start)
+
+    def report(self):
+        return "LLM cache disabled." if self.cache is None else self.cache.report()
+
+
+def add_cache_args(parser):
+    """
+    Adds response cache arguments to argparse parser, use with `llm_client_from_args`.
+    """
+    parser.add_argument("--cache-dir", default="llm-cache", help="Directory of cached API responses.")
+    parser.add_argument("--cache-size-mb", type=float, default=None,
+                        help="Size limit of response cache, least recently used responses are removed first.")
+    parser.add_argument("--no-cache", action="store_true", default=False,
+                        help="Neither read nor store cached API responses.")
+    parser.add_argument("--refresh-cache", action="store_true", default=False,
+                        help="Bypass cached responses, call the API and store new responses.")
+
+
+def llm_client_from_args(args):
+    if args.no_cache:
+        return LLMClient()
+    return LLMClient(ResponseCache(args.cache_dir, args.cache_size_mb), bypass_cache=args.refresh_cache)
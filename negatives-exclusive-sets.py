@@ -2,16 +2,24 @@ import torch
 import pandas as pd
 import numpy as np
 from transformers import AutoTokenizer, AutoModel, AutoModelForMaskedLM
+import argparse
 import json
 
+from profiling import add_profile_args, count, profiler_from_args, timer
+
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
 
-def create_text_embeddings(model_name):
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModel.from_pretrained(model_name)
-    model = model.to(device)
+def create_text_embeddings(model_name, df_texts):
+    """
+    :param df_texts: Dataframe of texts with column 'text'
+    :return: Tensor with embedding of each text, which is also saved to text_embeddings_<model>.pt
+    """
+    with timer("model_load"):
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModel.from_pretrained(model_name)
+        model = model.to(device)
 
     batch_size = 256
 
@@ -23,11 +31,14 @@ def create_text_embeddings(model_name):
         end_idx = np.minimum((i + 1) * batch_size, len(df_texts["text"]))
         print(f"Processing from {i * batch_size}-{end_idx}/{texts_nr}.")
         batch = df_texts["text"].tolist()[start_idx:end_idx]
-        inputs_d = tokenizer(batch, return_tensors="pt", padding=True, truncation=True)
-        inputs_d.to(device)
+        with timer("tokenize"):
+            inputs_d = tokenizer(batch, return_tensors="pt", padding=True, truncation=True)
+            inputs_d.to(device)
 
-        with torch.no_grad():
+        with timer("forward"), torch.no_grad():
             outputs_d = model(**inputs_d)
+        count("batches")
+        count("texts", len(batch))
 
         outputs.append(outputs_d.pooler_output)
 
@@ -40,7 +51,7 @@ def create_text_embeddings(model_name):
     print(text_embeddings)
     print(text_embeddings.shape)
 
-    torch.save(text_embeddings, f"text_embeddings_{model_name_file}.pt")
+    torch.save(text_embeddings, f"text_embeddings_{model_name.replace('/', '_')}.pt")
     return text_embeddings
 
 
@@ -48,20 +59,16 @@ def flatten(xss):
     return [x for xs in xss for x in xs]
 
 
-if __name__ == "__main__":
-    df_texts = pd.read_json("data/out-clean.json")
-    model_name = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'
-    model_name_file = model_name.replace("/", "_")
-
-    regenerate_embeddings = False
-    if regenerate_embeddings:
-        text_embeddings = create_text_embeddings(model_name)
-    else:
-        text_embeddings = torch.load(f"text_embeddings_{model_name_file}.pt")
-
-    text_embeddings = text_embeddings / text_embeddings.norm(dim=1)[:, None]
-    similarity = text_embeddings @ text_embeddings.transpose(0, 1)
-    similarity = similarity.cpu().numpy()
+def find_similar_texts(text_embeddings, df_texts):
+    """
+    :param text_embeddings: Tensor with embedding of each text in `df_texts`
+    :param df_texts: Dataframe of texts with columns 'text', 'text_id' and 'user_topics'
+    :return: List of texts with the most similar texts and topics of those which the text does not have
+    """
+    with timer("similarity"):
+        text_embeddings_normalized = text_embeddings / text_embeddings.norm(dim=1)[:, None]
+        similarity = text_embeddings_normalized @ text_embeddings_normalized.transpose(0, 1)
+        similarity = similarity.cpu().numpy()
     k = 10
 
     similar_texts = []
@@ -94,7 +101,51 @@ if __name__ == "__main__":
                 "most_similar_texts": most_similar
             }
         )
+    return similar_texts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Finds topics of the most similar texts as hard negatives.")
+    parser.add_argument(
+        "--regenerate-embeddings",
+        action="store_true",
+        default=False,
+        help="Compute text embeddings instead of loading them, needed whenever data/out-clean.json changes.",
+    )
+    parser.add_argument(
+        "--embeddings-only",
+        action="store_true",
+        default=False,
+        help="Only compute text embeddings and save them to text_embeddings_<model>.pt.",
+    )
+    add_profile_args(parser)
+    args = parser.parse_args()
+
+    with profiler_from_args(args, "negatives_exclusive_sets"):
+        with timer("json_parse"):
+            df_texts = pd.read_json("data/out-clean.json")
+        model_name = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'
+        model_name_file = model_name.replace("/", "_")
+
+        if args.regenerate_embeddings or args.embeddings_only:
+            text_embeddings = create_text_embeddings(model_name, df_texts)
+        else:
+            with timer("embeddings_load"):
+                text_embeddings = torch.load(f"text_embeddings_{model_name_file}.pt")
+
+        # Embeddings are matched to texts by row, so they must come from the same version of the dataset
+        if len(text_embeddings) != len(df_texts):
+            print(
+                f"There are {len(text_embeddings)} embeddings for {len(df_texts)} texts, "
+                "run with --regenerate-embeddings."
+            )
+            exit(-1)
+
+        if not args.embeddings_only:
+            with timer("similar_texts"):
+                similar_texts = find_similar_texts(text_embeddings, df_texts)
 
-    with open(f"neg_exSets_{model_name_file}.json", "w") as f:
-        json.dump(similar_texts, f, indent=4, ensure_ascii=False)
-        print(json.dumps(similar_texts[:5], indent=4, ensure_ascii=False))
+            # Hard negatives scoring in similarity_modeling.py reads the sets from evaluation-data
+            with timer("write_output"), open(f"evaluation-data/neg_exSets_{model_name_file}.json", "w") as f:
+                json.dump(similar_texts, f, indent=4, ensure_ascii=False)
+                print(json.dumps(similar_texts[:5], indent=4, ensure_ascii=False))
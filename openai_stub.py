@@ -0,0 +1,113 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubChatCompletionsServer:
+    """
+    Local stand-in for OpenAI chat completions endpoint, used to benchmark and try out
+    generation code without calling the API. Pass `base_url` to the OpenAI client.
+
+    Each request waits `latency` seconds. When more than `capacity` requests are being
+    processed at the same time, the server responds with 429 like the real API does
+    when rate limit is reached.
+    """
+
+    def __init__(self, latency=0.2, capacity=None, content="téma první\ntéma druhé\ntéma třetí", port=0):
+        self.latency = latency
+        self.capacity = capacity
+        self.content = content
+        self.port = port
+        self.requests = 0
+        self.rate_limited = 0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), self.create_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def completion_content(self, request):
+        """
+        Content of generated answer, override to return different answer for different requests.
+        """
+        return self.content
+
+    def create_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                request = json.loads(body or b"{}")
+
+                with stub.lock:
+                    stub.requests += 1
+                    overloaded = stub.capacity is not None and stub.in_flight >= stub.capacity
+                    if overloaded:
+                        stub.rate_limited += 1
+                    else:
+                        stub.in_flight += 1
+
+                if overloaded:
+                    self.respond(429, {"error": {"message": "Rate limit reached.", "type": "requests"}})
+                    return
+
+                try:
+                    time.sleep(stub.latency)
+                    content = stub.completion_content(request)
+                finally:
+                    with stub.lock:
+                        stub.in_flight -= 1
+
+                prompt_tokens = sum(len(m["content"].split()) for m in request.get("messages", []))
+                completion_tokens = len(content.split())
+                self.respond(
+                    200,
+                    {
+                        "id": f"chatcmpl-stub-{stub.requests}",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": request.get("model", "stub"),
+                        "choices": [
+                            {
+                                "index": 0,
+                                "message": {"role": "assistant", "content": content},
+                                "finish_reason": "stop",
+                            }
+                        ],
+                        "usage": {
+                            "prompt_tokens": prompt_tokens,
+                            "completion_tokens": completion_tokens,
+                            "total_tokens": prompt_tokens + completion_tokens,
+                        },
+                    },
+                )
+
+            def respond(self, status, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -1,62 +1,334 @@
-import json5
+import argparse
+import asyncio
 import json
-from utils import Annotator_API
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import json5
 from dotenv import load_dotenv
+
+from dataset_store import DatasetStore
+from utils import Annotator_API, AsyncAnnotator_API, clean_dataset, clean_records
+
 load_dotenv()
 
-data = {
-    "annotation_task_id": "947d8ee7-38ed-49c1-87e8-0e5ecba9a482",
-    "from_date": "2023-10-06",
-    "to_date": "2024-02-29",
-}
+TOPICS_FIELD = "249a3c3d-b3f7-45ea-961e-442bcb9c85ed"
 
-username = os.getenv('API_USER')
-password = os.getenv('API_PASSWORD')
-pull_annotations = True
 
-if __name__ == "__main__":
+def get_args():
+    parser = argparse.ArgumentParser(description="Scrapes annotation results and annotated texts from the API.")
+    parser.add_argument("--base-url", default="https://anotator.semant.cz")
+    parser.add_argument("--task-id", default="947d8ee7-38ed-49c1-87e8-0e5ecba9a482", help="Annotation task id.")
+    parser.add_argument("--from-date", default="2023-10-06")
+    parser.add_argument("--to-date", default="2024-02-29")
+    parser.add_argument(
+        "--results-file",
+        default=None,
+        help="Read annotation results from this json file instead of pulling them from the API.",
+    )
+    parser.add_argument("--output", default="data/out.json")
+    parser.add_argument("--workers", type=int, default=8, help="Number of concurrently fetched task instances.")
+    parser.add_argument(
+        "--text-cache",
+        default="annotator-cache/task-instances.jsonl",
+        help="File with already fetched texts of task instances, only missing texts are fetched.",
+    )
+    parser.add_argument("--no-cache", action="store_true", default=False, help="Fetch all texts again.")
+    parser.add_argument(
+        "--use-async",
+        action="store_true",
+        default=False,
+        help="Fetch texts with asyncio client instead of threads, suitable for large --workers.",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        default=False,
+        help="Pull only results created since the last sync (--from-date on the first sync) until today, "
+             "merge them into --output and update --clean-output for changed texts.",
+    )
+    parser.add_argument("--window-days", type=int, default=7, help="Length of one results request in sync mode.")
+    parser.add_argument("--clean-output", default="data/out-clean.json")
+    parser.add_argument(
+        "--store",
+        default=None,
+        help="Dataset store (e.g. data/dataset.sqlite) to put cleaned annotations of scraped or changed texts into.",
+    )
+    return parser.parse_args()
 
-    # Pull the data from the API
-    if pull_annotations:
-        api = Annotator_API('https://anotator.semant.cz', username, password)
-        with api.API_session():
-            results = api.post(api.base_url + '/api/task/results', data=data).json()
-    else:
-        with open("data.json", "r") as f:
-            results = json5.load(f)
 
-    out = {}
+class TextCache:
+    """
+    On-disk cache of task instance texts, one jsonl line per fetched instance. Texts of task instances
+    do not change, so each of them is fetched only once across runs.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: Cache file, None keeps fetched texts only in memory
+        """
+        self.path = path
+        self.texts = {}
+        self.lock = threading.Lock()
+        self.file = None
+        if path is None:
+            return
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line might be written only partially when the program was killed
+                        continue
+                    self.texts[entry["id"]] = entry["text"]
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def __contains__(self, instance_id):
+        return instance_id in self.texts
+
+    def __getitem__(self, instance_id):
+        return self.texts[instance_id]
+
+    def put(self, instance_id, text):
+        with self.lock:
+            self.texts[instance_id] = text
+            if self.file is not None:
+                self.file.write(json.dumps({"id": instance_id, "text": text}, ensure_ascii=False) + "\n")
+                self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def pull_results(api, task_id, from_date, to_date):
+    query = {"annotation_task_id": task_id, "from_date": from_date, "to_date": to_date}
+    response = api.post(api.base_url + "/api/task/results", data=query)
+    response.raise_for_status()
+    return response.json()
 
+
+def date_windows(from_date, to_date, days):
+    """
+    Splits date range into windows of `days` days. Neighbouring windows share the boundary day,
+    results from it are pulled twice and deduplicated by id.
+    """
+    start = date.fromisoformat(from_date)
+    end = date.fromisoformat(to_date)
+    while True:
+        window_end = min(start + timedelta(days=days), end)
+        yield start.isoformat(), window_end.isoformat()
+        if window_end >= end:
+            return
+        start = window_end
+
+
+def pull_results_windowed(api, task_id, from_date, to_date, days):
+    results = {}
+    for window_from, window_to in date_windows(from_date, to_date, days):
+        window_results = pull_results(api, task_id, window_from, window_to)
+        print(f"Pulled {len(window_results)} results from {window_from} to {window_to}.")
+        for result in window_results:
+            results[result["id"]] = result
+    return list(results.values())
+
+
+def sync_state_path(output):
+    return output + ".sync.json"
+
+
+def load_sync_state(output, task_id):
+    try:
+        with open(sync_state_path(output), "r") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    return state if state["task_id"] == task_id else None
+
+
+def save_sync_state(output, task_id, high_water_mark):
+    path = sync_state_path(output)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"task_id": task_id, "high_water_mark": high_water_mark}, f, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+def merge_results(out, results, texts):
+    """
+    Merges annotation results into scraped data by annotation id, rejected results remove earlier annotations.
+    :return: Set of ids of changed task instances
+    """
+    changed = set()
     for result in results:
-        if result['result_type'] == 'rejected':
+        instance_id = result["annotation_task_instance_id"]
+        if result["result_type"] == "rejected":
+            if result["id"] in out.get(instance_id, {}):
+                del out[instance_id][result["id"]]
+                changed.add(instance_id)
             continue
-        result2 = json5.loads(result['result'])
-        annotation_id = result['id']
-        user_id = result['user_id']
-        annotation_task_id = result['annotation_task_instance_id']
-
-        res = json5.loads(result2['249a3c3d-b3f7-45ea-961e-442bcb9c85ed'])
-        topics = []
-        for r in res:
-            topics.append(r['text'])
-
-        with api.API_session():
-            text = api.get(api.base_url + f'/api/task/task_instance/{annotation_task_id}').json()['text']
-
-        if annotation_task_id not in out:
-            out[annotation_task_id] = {
-                "text": text
-            }
-
-        if annotation_id not in out[annotation_task_id]:
-            out[annotation_task_id]["annotation"] = {
-                "annotation_id": annotation_id,
-                "user_id": user_id,
-                "topics": topics
-            }
-        break
-
-    with open("out-better.json", "w", encoding='utf8') as f:
+        annotation = {
+            "annotation_id": result["id"],
+            "user_id": result["user_id"],
+            "topics": parse_topics(result),
+        }
+        if instance_id not in out:
+            out[instance_id] = {"text": texts[instance_id]}
+        if out[instance_id].get(result["id"]) != annotation:
+            out[instance_id][result["id"]] = annotation
+            changed.add(instance_id)
+    return changed
+
+
+def parse_topics(result):
+    result_data = json5.loads(result["result"])
+    return [r["text"] for r in json5.loads(result_data[TOPICS_FIELD])]
+
+
+def fetch_texts(api, instance_ids, cache, workers, text_api=None):
+    """
+    Fetches texts of task instances missing in cache, at most `workers` requests run at once.
+    :param text_api: `AsyncAnnotator_API` used for fetching instead of threads sharing session of `api`,
+        it opens its own session
+    """
+    missing = sorted({id for id in instance_ids if id not in cache})
+
+    def fetch(instance_id):
+        response = api.get(api.base_url + f"/api/task/task_instance/{instance_id}")
+        response.raise_for_status()
+        cache.put(instance_id, response.json()["text"])
+
+    start = time.perf_counter()
+    if isinstance(text_api, AsyncAnnotator_API):
+        asyncio.run(fetch_texts_async(text_api, missing, cache, workers))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for done, _ in enumerate(executor.map(fetch, missing), start=1):
+                if done % 100 == 0:
+                    print(f"Fetched {done}/{len(missing)} texts.")
+    print(f"Fetched {len(missing)} texts in {time.perf_counter() - start:.1f}s, "
+          f"{len(set(instance_ids)) - len(missing)} texts were cached.")
+
+
+async def fetch_texts_async(api, instance_ids, cache, workers):
+    semaphore = asyncio.Semaphore(workers)
+    done = 0
+
+    async def fetch(instance_id):
+        nonlocal done
+        async with semaphore:
+            response = await api.get(api.base_url + f"/api/task/task_instance/{instance_id}")
+        response.raise_for_status()
+        cache.put(instance_id, response.json()["text"])
+        done += 1
+        if done % 100 == 0:
+            print(f"Fetched {done}/{len(instance_ids)} texts.")
+
+    async with api.API_session():
+        await asyncio.gather(*(fetch(instance_id) for instance_id in instance_ids))
+
+
+def build_output(results, texts):
+    """
+    Groups accepted annotation results by task instance.
+    :return: Dict which maps task instance id to its text and annotations keyed by annotation id
+    """
+    out = {}
+    merge_results(out, [result for result in results if result["result_type"] != "rejected"], texts)
+    return out
+
+
+def write_output(out, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf8") as f:
         json.dump(out, f, indent=4, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def update_store(path, output, text_ids=None):
+    """
+    Puts cleaned annotations of scraped texts into dataset store.
+    :param text_ids: Changed texts, None puts all texts
+    """
+    records = clean_records(output)
+    if text_ids is not None:
+        records = (record for record in records if record["text_id"] in text_ids)
+    with DatasetStore(path) as store:
+        count = store.put_annotations(records, text_ids)
+    print(f"Updated annotations of {count} texts in {path}.")
+
+
+def sync(api, text_api, cache, args):
+    """
+    Incremental sync, pulls results since the high-water mark of the previous sync and merges them into output.
+    """
+    state = load_sync_state(args.output, args.task_id)
+    if state is None or not os.path.exists(args.output):
+        from_date, out = args.from_date, {}
+    else:
+        with open(args.output, "r") as f:
+            out = json.load(f)
+        from_date = state["high_water_mark"]
+    to_date = date.today().isoformat()
+
+    with api.API_session():
+        results = pull_results_windowed(api, args.task_id, from_date, to_date, args.window_days)
+        new_instances = [
+            result["annotation_task_instance_id"] for result in results
+            if result["result_type"] != "rejected" and result["annotation_task_instance_id"] not in out
+        ]
+        fetch_texts(api, new_instances, cache, args.workers, text_api)
+
+    changed = merge_results(out, results, cache)
+    write_output(out, args.output)
+    # Results created on the last day might not be complete yet, next sync starts from it again
+    save_sync_state(args.output, args.task_id, to_date)
+    print(f"Synced {len(results)} results from {from_date} to {to_date}, {len(changed)} texts changed.")
+
+    if changed or not os.path.exists(args.clean_output):
+        clean_dataset(args.output, args.clean_output, text_ids=changed if state is not None else None)
+        print(f"Updated {args.clean_output}.")
+    if args.store is not None and (changed or state is None):
+        update_store(args.store, args.output, changed if state is not None else None)
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    cache = TextCache(None if args.no_cache else args.text_cache)
+    credentials = (args.base_url, os.getenv("API_USER"), os.getenv("API_PASSWORD"))
+    api = Annotator_API(*credentials, pool_size=args.workers)
+    text_api = AsyncAnnotator_API(*credentials, pool_size=args.workers) if args.use_async else None
+
+    if args.sync:
+        sync(api, text_api, cache, args)
+        cache.close()
+        print(api.report())
+        if text_api is not None:
+            print(text_api.report())
+        exit(0)
+
+    # One session for the whole run, requests reuse its login and connections
+    with api.API_session():
+        if args.results_file is None:
+            results = pull_results(api, args.task_id, args.from_date, args.to_date)
+        else:
+            with open(args.results_file, "r") as f:
+                results = json5.load(f)
+
+        accepted = [result for result in results if result["result_type"] != "rejected"]
+        fetch_texts(api, [result["annotation_task_instance_id"] for result in accepted], cache, args.workers, text_api)
+    cache.close()
+    print(api.report())
+    if text_api is not None:
+        print(text_api.report())
 
+    out = build_output(accepted, cache)
+    write_output(out, args.output)
+    print(f"Written {len(out)} texts with {len(accepted)} annotations to {args.output}.")
+    if args.store is not None:
+        update_store(args.store, args.output)
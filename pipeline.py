@@ -0,0 +1,282 @@
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from utils import clean_dataset
+
+EMBEDDINGS_MODEL = "sentence-transformers_paraphrase-multilingual-MiniLM-L12-v2"
+
+
+class Stage:
+    """
+    One step of the pipeline. `run` is command line of a script or a python callable, it reads `inputs`
+    and writes `outputs`. A stage depends on stages producing its inputs. `code` lists source files whose
+    changes make the stage run again, `params` are settings passed to `run` other than file paths.
+    """
+
+    def __init__(self, name, run, inputs=(), outputs=(), code=(), params=None):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.code = list(code)
+        self.params = params or {}
+
+    def describe(self):
+        if callable(self.run):
+            return f"{self.run.__module__}.{self.run.__name__}({', '.join(map(repr, self.params.values()))})"
+        return " ".join(self.run)
+
+
+def python(script, *args):
+    return [sys.executable, script, *args]
+
+
+def create_stages(args):
+    return [
+        Stage(
+            "scrape",
+            python("parse_annotations.py", "--output", "data/out.json", "--workers", str(args.workers)),
+            outputs=["data/out.json"],
+            code=["parse_annotations.py", "utils.py"],
+        ),
+        Stage(
+            "clean",
+            clean_dataset,
+            inputs=["data/out.json"],
+            outputs=["data/out-clean.json"],
+            code=["utils.py"],
+            params={"source": "data/out.json", "output": "data/out-clean.json"},
+        ),
+        Stage(
+            "score",
+            python("similarity_modeling.py"),
+            inputs=["data/out-clean.json"],
+            outputs=["evaluation-data/out-mlm-mpnet-base-v2-all-texts.jsonl"],
+            code=["similarity_modeling.py", "llm_client.py"],
+        ),
+        Stage(
+            "embed",
+            python("negatives-exclusive-sets.py", "--embeddings-only"),
+            inputs=["data/out-clean.json"],
+            outputs=[f"text_embeddings_{EMBEDDINGS_MODEL}.pt"],
+            code=["negatives-exclusive-sets.py"],
+        ),
+        Stage(
+            "mine",
+            python("negatives-exclusive-sets.py"),
+            inputs=["data/out-clean.json", f"text_embeddings_{EMBEDDINGS_MODEL}.pt"],
+            outputs=[f"evaluation-data/neg_exSets_{EMBEDDINGS_MODEL}.json"],
+            code=["negatives-exclusive-sets.py"],
+        ),
+        Stage(
+            "mine-scores",
+            [sys.executable, "-c", "import similarity_modeling; similarity_modeling.create_hard_negatives_scores()"],
+            inputs=[f"evaluation-data/neg_exSets_{EMBEDDINGS_MODEL}.json"],
+            outputs=["evaluation-data/neg_exSets-scores.json"],
+            code=["similarity_modeling.py", "llm_client.py"],
+        ),
+        Stage(
+            "merge",
+            python(
+                "hard_negatives.py", "merge",
+                "--merge-json", "evaluation-data/neg_exSets-scores.json",
+                "--source", "evaluation-data/out-mlm-mpnet-base-v2-all-texts.jsonl",
+                "--hn-from-api", str(args.hn_from_api),
+                "--hn-from-dataset", str(args.hn_from_dataset),
+                # The stage runs when candidates changed, so already merged texts are merged again
+                "--force",
+            ),
+            # Merge rewrites scored texts in place
+            inputs=["evaluation-data/neg_exSets-scores.json", "evaluation-data/out-mlm-mpnet-base-v2-all-texts.jsonl"],
+            outputs=["evaluation-data/out-mlm-mpnet-base-v2-all-texts.jsonl"],
+            code=["hard_negatives.py", "dataset_store.py", "utils.py"],
+        ),
+    ]
+
+
+class Pipeline:
+    """
+    Runs stages in dependency order, independent stages run concurrently. Each finished stage is stored
+    with fingerprint of its inputs, code, command and params in `state_path`. Stages with unchanged
+    fingerprint and existing outputs are skipped. A rerun stage which produces the same outputs as before
+    therefore does not make stages after it run again.
+
+    File hashes are cached by size and modification time, so unchanged large files are not read again.
+    """
+
+    def __init__(self, stages, state_path="pipeline-cache/state.json"):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        try:
+            with open(state_path, "r") as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = {"files": {}, "stages": {}}
+
+    def producers(self, stage):
+        """
+        :return: Names of stages producing inputs of `stage`, stages rewriting their input depend on the
+            stages declared before them
+        """
+        names = list(self.stages)
+        return {
+            other.name for other in self.stages.values()
+            if other is not stage and set(other.outputs) & set(stage.inputs)
+            and (not set(other.outputs) & set(stage.outputs) or names.index(other.name) < names.index(stage.name))
+        }
+
+    def with_dependencies(self, names):
+        selected = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name not in selected:
+                selected.add(name)
+                pending.extend(self.producers(self.stages[name]))
+        return [name for name in self.stages if name in selected]
+
+    def file_hash(self, path):
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        with self.lock:
+            cached = self.state["files"].get(path)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        with self.lock:
+            self.state["files"][path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def fingerprint(self, stage):
+        description = {
+            "run": stage.describe(),
+            "params": stage.params,
+            "inputs": {path: self.file_hash(path) for path in stage.inputs},
+            "code": {path: self.file_hash(path) for path in stage.code},
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def up_to_date(self, stage):
+        return (
+            all(os.path.exists(path) for path in stage.outputs)
+            and self.state["stages"].get(stage.name) == self.fingerprint(stage)
+        )
+
+    def save_state(self):
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        with self.lock:
+            with open(self.state_path + ".tmp", "w") as f:
+                json.dump(self.state, f, indent=4)
+            os.replace(self.state_path + ".tmp", self.state_path)
+
+    def execute(self, stage):
+        start = time.perf_counter()
+        if callable(stage.run):
+            stage.run(**stage.params)
+        else:
+            subprocess.run(stage.run, check=True)
+        # Fingerprint after the run, stages rewriting their inputs are then up to date on the next run
+        fingerprint = self.fingerprint(stage)
+        with self.lock:
+            self.state["stages"][stage.name] = fingerprint
+        self.save_state()
+        return time.perf_counter() - start
+
+    def run(self, names, force=(), jobs=2, dry_run=False):
+        """
+        :param names: Stages to bring up to date, together with stages they depend on
+        :param force: Stages run even when up to date
+        :return: True if all stages succeeded
+        """
+        selected = self.with_dependencies(names)
+        waiting = {name: self.producers(self.stages[name]) & set(selected) for name in selected}
+        finished = set()
+        rerun = set()
+        failed = set()
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            while waiting or running:
+                for name in [name for name, deps in waiting.items() if deps <= finished]:
+                    deps = waiting.pop(name)
+                    stage = self.stages[name]
+                    if deps & failed:
+                        print(f"[{name}] not run, {', '.join(sorted(deps & failed))} failed.")
+                        failed.add(name)
+                    elif dry_run and (name in force or deps & rerun or not self.up_to_date(stage)):
+                        # Outputs of stages before it are not known yet, so it would possibly run
+                        print(f"[{name}] would run: {stage.describe()}")
+                        rerun.add(name)
+                    elif name not in force and self.up_to_date(stage):
+                        print(f"[{name}] up to date.")
+                    elif not dry_run:
+                        print(f"[{name}] running: {stage.describe()}")
+                        running[executor.submit(self.execute, stage)] = name
+                        continue
+                    finished.add(name)
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    finished.add(name)
+                    try:
+                        elapsed = future.result()
+                    except Exception as e:
+                        print(f"[{name}] failed: {e}")
+                        failed.add(name)
+                        continue
+                    print(f"[{name}] done in {elapsed:.1f}s.")
+        self.save_state()
+        return not failed
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Runs pipeline stages scrape -> clean -> score, embed -> mine -> mine-scores -> merge. "
+                    "Stages whose inputs, code and settings did not change since their last run are skipped."
+    )
+    parser.add_argument(
+        "stages",
+        nargs="*",
+        help="Stages to bring up to date together with stages they depend on, all stages by default.",
+    )
+    parser.add_argument(
+        "--force",
+        nargs="+",
+        default=[],
+        help="Stages run even when up to date, e.g. 'scrape' to pull new annotations.",
+    )
+    parser.add_argument("--dry-run", action="store_true", default=False, help="Only print stages which would run.")
+    parser.add_argument("--jobs", type=int, default=2, help="Number of stages running at once.")
+    parser.add_argument("--state", default="pipeline-cache/state.json")
+    parser.add_argument("--workers", type=int, default=8, help="Number of concurrent API requests of 'scrape'.")
+    parser.add_argument("--hn-from-api", type=int, default=3)
+    parser.add_argument("--hn-from-dataset", type=int, default=2)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    pipeline = Pipeline(create_stages(args), args.state)
+    unknown = [name for name in args.stages + args.force if name not in pipeline.stages]
+    if unknown:
+        print(f"Unknown stages {', '.join(unknown)}, choose from {', '.join(pipeline.stages)}.")
+        exit(-1)
+
+    if not pipeline.run(args.stages or list(pipeline.stages), set(args.force), args.jobs, args.dry_run):
+        exit(1)
@@ -0,0 +1,223 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then left out of reports
+    resource = None
+
+# Profiler of the running script, timers and counters are no-ops while it is None
+current = None
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+class StackSampler:
+    """
+    Samples stacks of all threads every `interval` seconds and counts them in collapsed format,
+    one `frame;frame;frame count` line per distinct stack, which flamegraph.pl, speedscope and inferno read.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def frame_name(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.thread.ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self.frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def work(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def stop(self, path):
+        self.stop_event.set()
+        self.thread.join()
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    """
+    Collects wall time of named code sections, counters and peak memory of one run and writes them as json
+    report into `output_dir`. With `capture` it also records profile of the whole run:
+    `cprofile` writes pstats file (snakeviz, flameprof), `sampling` collapsed stacks for flame graphs and
+    `torch` trace of torch operations (chrome://tracing, Perfetto) with their stacks for flame graphs.
+
+    Sections are measured by module level `timer`, so code does not need the profiler passed around.
+    """
+
+    def __init__(self, name, output_dir="profiles", capture=None, sample_interval=0.005):
+        self.name = name
+        self.output_dir = output_dir
+        self.capture = capture
+        self.sample_interval = sample_interval
+        self.prefix = os.path.join(output_dir, f"{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}-{name}")
+        self.timers = {}
+        self.counters = Counter()
+        self.lock = threading.Lock()
+        self.capturer = None
+        self.profile_files = []
+
+    def __enter__(self):
+        global current
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.start_time = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.started = datetime.now().isoformat(timespec="seconds")
+        if self.capture == "cprofile":
+            import cProfile
+
+            self.capturer = cProfile.Profile()
+            self.capturer.enable()
+        elif self.capture == "sampling":
+            self.capturer = StackSampler(self.sample_interval)
+            self.capturer.start()
+        elif self.capture == "torch":
+            import torch
+
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.capturer = torch.profiler.profile(activities=activities, with_stack=True, profile_memory=True)
+            self.capturer.__enter__()
+        current = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global current
+        current = None
+        wall_time = time.perf_counter() - self.start_time
+        cpu_time = time.process_time() - self.start_cpu
+        self.stop_capture()
+        path = self.write_report(wall_time, cpu_time, failed=exc_type is not None)
+        print(f"Profile report written to {path}.")
+
+    def stop_capture(self):
+        if self.capture == "cprofile":
+            self.capturer.disable()
+            self.capturer.dump_stats(self.prefix + ".prof")
+            self.profile_files.append(self.prefix + ".prof")
+        elif self.capture == "sampling":
+            self.capturer.stop(self.prefix + ".folded")
+            self.profile_files.append(self.prefix + ".folded")
+        elif self.capture == "torch":
+            self.capturer.__exit__(None, None, None)
+            self.capturer.export_chrome_trace(self.prefix + ".trace.json")
+            self.capturer.export_stacks(self.prefix + ".stacks", "self_cpu_time_total")
+            self.profile_files += [self.prefix + ".trace.json", self.prefix + ".stacks"]
+
+    @contextmanager
+    def timer(self, name):
+        if self.capture == "torch":
+            import torch
+
+            section = torch.profiler.record_function(name)
+        else:
+            section = nullcontext()
+        start = time.perf_counter()
+        try:
+            with section:
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            rss = peak_rss_mb()
+            with self.lock:
+                timer = self.timers.setdefault(name, {"total_s": 0.0, "count": 0, "max_s": 0.0})
+                timer["total_s"] += elapsed
+                timer["count"] += 1
+                timer["max_s"] = max(timer["max_s"], elapsed)
+                # Peak memory of the process when the section last finished, shows which section raised it
+                timer["peak_rss_mb"] = rss
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def write_report(self, wall_time, cpu_time, failed=False):
+        timers = {
+            name: dict(timer, mean_s=timer["total_s"] / timer["count"])
+            for name, timer in sorted(self.timers.items(), key=lambda item: -item[1]["total_s"])
+        }
+        report = {
+            "name": self.name,
+            "argv": sys.argv,
+            "started": self.started,
+            "failed": failed,
+            "wall_time_s": wall_time,
+            "cpu_time_s": cpu_time,
+            "peak_rss_mb": peak_rss_mb(),
+            "timers": timers,
+            "counters": dict(self.counters),
+            "profile_files": self.profile_files,
+        }
+        path = self.prefix + ".json"
+        with open(path, "w") as f:
+            json.dump(report, f, indent=4, ensure_ascii=False)
+        return path
+
+
+def timer(name):
+    """
+    Measures wall time of a code section in `with` statement when profiling is enabled.
+    """
+    return nullcontext() if current is None else current.timer(name)
+
+
+def count(name, n=1):
+    if current is not None:
+        current.count(name, n)
+
+
+def add_profile_args(parser):
+    """
+    Adds profiling arguments to argparse parser, use with `profiler_from_args`.
+    """
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="Write json report with time spent in sections of the run, counters and peak memory.")
+    parser.add_argument("--profile-dir", default="profiles", help="Directory of profile reports.")
+    parser.add_argument("--profile-capture", choices=["cprofile", "sampling", "torch"], default=None,
+                        help="Also record profile of the whole run: 'cprofile' pstats file, 'sampling' collapsed "
+                             "stacks for flame graphs, 'torch' trace and stacks of torch operations.")
+
+
+def profiler_from_args(args, name):
+    """
+    :return: Context manager which profiles the run when --profile or --profile-capture is given
+    """
+    if not args.profile and args.profile_capture is None:
+        return nullcontext()
+    return Profiler(name, args.profile_dir, args.profile_capture)
@@ -1,36 +1,52 @@
-from sentence_transformers import SentenceTransformer
-from transformers import BertTokenizer, BertModel
-import numpy as np
-import torch
-from torch import nn
+import argparse
 import json
-from openai import OpenAI
+
+from llm_client import LLMClient, ResponseCache
+from profiling import add_profile_args, count, profiler_from_args, timer
 
 
 class MLMTopicEvaluator:
     def __init__(self, mlm_model_name):
         self.mlm_model_name = mlm_model_name
 
-        if mlm_model_name == "googlebert-cased":
-            self.tokenizer = BertTokenizer.from_pretrained(
-                "bert-base-multilingual-cased"
-            )
-            self.model = BertModel.from_pretrained("bert-base-multilingual-cased")
-        else:
-            self.model = SentenceTransformer(mlm_model_name)
-            self.cos_sim = nn.CosineSimilarity(dim=1)
+        # Model libraries are imported only here, DirectScoreEvaluator does not need them
+        with timer("model_load"):
+            if mlm_model_name == "googlebert-cased":
+                from transformers import BertTokenizer, BertModel
+
+                self.tokenizer = BertTokenizer.from_pretrained(
+                    "bert-base-multilingual-cased"
+                )
+                self.model = BertModel.from_pretrained("bert-base-multilingual-cased")
+            else:
+                from sentence_transformers import SentenceTransformer
+                from torch import nn
+
+                self.model = SentenceTransformer(mlm_model_name)
+                self.cos_sim = nn.CosineSimilarity(dim=1)
 
     def get_embedding(self, text):
-        return self.model.encode(text)
+        # Tokenisation and forward pass, sentence transformers do both in `encode`
+        with timer("encode"):
+            return self.model.encode(text)
 
     def get_similarity(self, text, topics):
+        import numpy as np
+        import torch
+
+        count("texts")
+        count("topics", len(topics))
         if self.mlm_model_name == "googlebert-cased":
-            encoded_input = self.tokenizer(text, return_tensors="pt")
-            output = self.model(**encoded_input).last_hidden_state.mean(dim=1)
+            with timer("tokenize"):
+                encoded_input = self.tokenizer(text, return_tensors="pt")
+            with timer("forward"):
+                output = self.model(**encoded_input).last_hidden_state.mean(dim=1)
             similarities = []
             for t in topics:
-                encoded_input = self.tokenizer(t, return_tensors="pt")
-                t_output = self.model(**encoded_input).last_hidden_state.mean(dim=1)
+                with timer("tokenize"):
+                    encoded_input = self.tokenizer(t, return_tensors="pt")
+                with timer("forward"):
+                    t_output = self.model(**encoded_input).last_hidden_state.mean(dim=1)
                 similarity = torch.cosine_similarity(output, t_output, dim=1)
                 similarities.append(similarity.item())
         else:
@@ -46,8 +62,8 @@ class MLMTopicEvaluator:
 
 class DirectScoreEvaluator:
 
-    def __init__(self):
-        self.client = OpenAI()
+    def __init__(self, llm_client=None):
+        self.llm_client = LLMClient(ResponseCache()) if llm_client is None else llm_client
         self.temperature = 0.2
         self.max_tokens = 64
         self.top_p = 1
@@ -81,26 +97,32 @@ class DirectScoreEvaluator:
 
             """
 
-    def get_similarity(self, text, topics):
+    def request_kwargs(self, text, topics):
         topics = "\n".join(topics)
         gpt4_input = f"{text}\n\n{topics}"
-        print(f"Input: '{gpt4_input}'")
-        generation_result = self.client.chat.completions.create(
+        return dict(
             model="gpt-4-turbo",
-            messages=[
-                {"role": "system", "content": self.system_message},
-                {"role": "user", "content": gpt4_input},
-            ],
+            system=self.system_message,
+            user=gpt4_input,
             temperature=self.temperature,
             max_tokens=self.max_tokens,
             top_p=self.top_p,
             frequency_penalty=self.frequency_penalty,
             presence_penalty=self.presence_penalty,
         )
-        generated_answer = generation_result.choices[0].message.content.split("\n")
+
+    @staticmethod
+    def parse_answer(content):
+        generated_answer = content.split("\n")
         print(f"Output: '{generated_answer}'")
         return map(lambda x: float(x.split(": ")[1]), generated_answer)
 
+    def get_similarity(self, text, topics):
+        request = self.request_kwargs(text, topics)
+        print(f"Input: '{request['user']}'")
+        completion = self.llm_client.complete(**request)
+        return self.parse_answer(completion.content)
+
 
 def create_text_topics_scores():
     # model_name = 'setu4993/LaBSE'
@@ -110,12 +132,13 @@ def create_text_topics_scores():
 
     evaluator = None  #  MLMTopicEvaluator(model_name)
     evaluator = MLMTopicEvaluator(model_name)
-    data = json.load(
-        open(
-            "data/gold_annotated_dataset.json",
-            "r",
+    with timer("json_parse"):
+        data = json.load(
+            open(
+                "data/gold_annotated_dataset.json",
+                "r",
+            )
         )
-    )
     scores_dict = {}
     for d in data:
         text = data[d]["text"]
@@ -136,12 +159,13 @@ def create_text_topics_scores():
             scores.append(topic_dict)
         scores_dict[d]["scores"] = scores
 
-    json.dump(
-        scores_dict,
-        open(f"evaluation-data/out-mlm-multilingual-google-bert-cased.json", "w"),
-        indent=4,
-        ensure_ascii=False,
-    )
+    with timer("write_output"):
+        json.dump(
+            scores_dict,
+            open(f"evaluation-data/out-mlm-multilingual-google-bert-cased.json", "w"),
+            indent=4,
+            ensure_ascii=False,
+        )
 
 
 def create_text_topics_scores_no_labels():
@@ -152,12 +176,13 @@ def create_text_topics_scores_no_labels():
 
     evaluator = None  #  MLMTopicEvaluator(model_name)
     evaluator = MLMTopicEvaluator(model_name)
-    data = json.load(
-        open(
-            "data/out-clean.json",
-            "r",
+    with timer("json_parse"):
+        data = json.load(
+            open(
+                "data/out-clean.json",
+                "r",
+            )
         )
-    )
     scores_dict = {}
     for d in data:
         text = d["text"]
@@ -177,7 +202,7 @@ def create_text_topics_scores_no_labels():
             scores.append(topic_dict)
         scores_dict[text_id]["scores"] = scores
 
-    with open(f"evaluation-data/out-mlm-mpnet-base-v2-all-texts.jsonl", "w") as f:
+    with timer("write_output"), open(f"evaluation-data/out-mlm-mpnet-base-v2-all-texts.jsonl", "w") as f:
         for text_id, text_data in scores_dict.items():
             f.write(
                 json.dumps(
@@ -195,12 +220,13 @@ def create_text_topics_scores_no_labels():
 def create_hard_negatives_scores():
     model_name = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
     evaluator = MLMTopicEvaluator(model_name)
-    data = json.load(
-        open(
-            "evaluation-data/neg_exSets_sentence-transformers_paraphrase-multilingual-MiniLM-L12-v2.json",
-            "r",
+    with timer("json_parse"):
+        data = json.load(
+            open(
+                "evaluation-data/neg_exSets_sentence-transformers_paraphrase-multilingual-MiniLM-L12-v2.json",
+                "r",
+            )
         )
-    )
 
     empty_exclusive_set_counter = 0
 
@@ -240,14 +266,20 @@ def create_hard_negatives_scores():
 
     print(f"Empty exclusive set in {empty_exclusive_set_counter}/{len(data)}")
 
-    json.dump(
-        scores_dict,
-        open(f"evaluation-data/neg_exSets-scores.json", "w"),
-        indent=4,
-        ensure_ascii=False,
-    )
+    with timer("write_output"):
+        json.dump(
+            scores_dict,
+            open(f"evaluation-data/neg_exSets-scores.json", "w"),
+            indent=4,
+            ensure_ascii=False,
+        )
 
 
 if __name__ == "__main__":
-    # create_hard_negatives_scores()
-    create_text_topics_scores_no_labels()
+    parser = argparse.ArgumentParser(description="Scores topics of all cleaned texts by similarity to the text.")
+    add_profile_args(parser)
+    args = parser.parse_args()
+
+    with profiler_from_args(args, "similarity_modeling"):
+        # create_hard_negatives_scores()
+        create_text_topics_scores_no_labels()
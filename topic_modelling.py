@@ -1,14 +1,18 @@
+import argparse
+import asyncio
+import hashlib
 import json
-
-from openai import OpenAI
+import random
 
 from evaluate_topic_modelling import TopicEvaluator, BasicMetric, CrossEncoderMetric
-from utils import TopicGenerationLogger, get_annotations
+from llm_client import LLMClient, ResponseCache, add_cache_args, llm_client_from_args
+from utils import TopicGenerationLogger, get_annotations, load_generated_index
 
 
 class GptGenerator:
-    def __init__(self):
-        self.client = OpenAI()
+    def __init__(self, llm_client=None):
+        self.llm_client = LLMClient(ResponseCache()) if llm_client is None else llm_client
+        self.model = "gpt-4-0125-preview"
         self.temperature = 0.2
         self.max_tokens = 64
         self.top_p = 1
@@ -29,27 +33,37 @@ class GptGenerator:
                                "jež on na tuto vědu kladl, byly příliš vysoké.\nText topics:\ndecké bádání "
                                "Tolstého\nVýzkum Lva Nikolajeviče Tolstého\n\n")
 
-    def __call__(self, example_text, *args, **kwargs):
-        generation_result = self.client.chat.completions.create(
-            model="gpt-4-0125-preview",
-            messages=[
-                {
-                    "role": "system",
-                    "content": self.system_message
-                },
-                {
-                    "role": "user",
-                    "content": example_text
-                }
-            ],
+    def request_kwargs(self, example_text):
+        return dict(
+            model=self.model,
+            system=self.system_message,
+            user=example_text,
             temperature=self.temperature,
             max_tokens=self.max_tokens,
             top_p=self.top_p,
             frequency_penalty=self.frequency_penalty,
             presence_penalty=self.presence_penalty
         )
-        generated_answer = generation_result.choices[0].message.content
-        return generated_answer.split("\n")
+
+    def __call__(self, example_text, *args, **kwargs):
+        completion = self.llm_client.complete(**self.request_kwargs(example_text))
+        return completion.content.split("\n")
+
+    async def generate_async(self, example_text):
+        """
+        :return: Tuple (list of topics, `llm_client.Completion` of the request)
+        """
+        completion = await self.llm_client.complete_async(**self.request_kwargs(example_text))
+        return completion.content.split("\n"), completion
+
+    def settings_fingerprint(self):
+        """
+        Hash of settings which affect generated topics. Records generated with the same fingerprint
+        are reused when generation is resumed.
+        """
+        settings = self.request_kwargs("")
+        canonical = json.dumps(settings, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
 
     def get_settings_repr(self):
         str_repr = "GPT4 model with settings:"
@@ -57,34 +71,153 @@ class GptGenerator:
         return str_repr
 
 
-if __name__ == "__main__":
-    max_topic_generations = 35
+class AdaptiveConcurrencyLimiter:
+    """
+    Bounds number of requests running at the same time. When API responds with rate limit error,
+    the limit is halved and new requests wait for a jittered exponential backoff. After `limit`
+    successful requests the limit grows by one again, up to `max_concurrency`. Other failures,
+    e.g. timeouts or server errors, leave the limit unchanged.
+    """
 
-    save_to_file = True
+    def __init__(self, max_concurrency, initial_backoff=1.0, max_backoff=60.0):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.backoff = initial_backoff
+        self.in_flight = 0
+        self.successes = 0
+        self.resume_at = 0.0
+        self.condition = asyncio.Condition()
 
-    # topic_generator should be callable which takes text as argument
-    # and returns list of topics on call
-    topic_generator = GptGenerator()
-    evaluator = TopicEvaluator(BasicMetric(), CrossEncoderMetric())
-    logger = TopicGenerationLogger(topic_generator, evaluator, max_topic_generations)
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        delay = self.resume_at - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def release(self, rate_limited=False, failed=False):
+        """
+        :param rate_limited: Request failed with rate limit error
+        :param failed: Request failed with another error, it counts neither as success nor as rate limit
+        """
+        async with self.condition:
+            self.in_flight -= 1
+            now = asyncio.get_running_loop().time()
+            # Requests sent before backoff started fail too, react only once per backoff period
+            if rate_limited and now >= self.resume_at:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+                self.resume_at = now + self.backoff * random.uniform(0.5, 1.0)
+                self.backoff = min(self.backoff * 2, self.max_backoff)
+            elif not rate_limited and not failed:
+                self.backoff = self.initial_backoff
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+async def generate_topics_async(topic_generator, annotations, concurrency=8, logger=None, max_attempts=8,
+                                generator_settings=None):
+    """
+    Generates topics for all annotated texts concurrently.
+    :param topic_generator: Object with coroutine `generate_async` which takes text and returns list of topics
+        and `llm_client.Completion` of the request
+    :param annotations: Iterable of (text, annotator topics, text id) as returned by `get_annotations`
+    :param concurrency: Maximum number of requests running at the same time
+    :param logger: Optional `TopicGenerationLogger`, notified about each generated record when it completes
+    :param max_attempts: Number of attempts for one text before rate limit error is raised
+    :param generator_settings: Optional fingerprint of generator settings stored with each record
+    :return: List of generated records in the same order as `annotations`
+    """
+    # Imported here like in `LLMClient`, cached runs and evaluation do not need the API client
+    import openai
+
+    limiter = AdaptiveConcurrencyLimiter(concurrency)
+
+    async def generate(text, topics, key):
+        for attempt in range(1, max_attempts + 1):
+            await limiter.acquire()
+            try:
+                generated_topics, completion = await topic_generator.generate_async(text)
+            except openai.RateLimitError:
+                await limiter.release(rate_limited=True)
+                if attempt == max_attempts:
+                    raise
+                continue
+            except BaseException:
+                # Timeouts, server or parse errors and cancellation must not raise the limit
+                await limiter.release(failed=True)
+                raise
+            await limiter.release()
+            break
 
-    logger.print_settings()
-    # Generating topics using topic_generator
-    generated_all = []
-    for text, topics, key in get_annotations("data/gold_annotated_dataset.json",
-                                             num_iterations=max_topic_generations):
         generated = {
             "text-id": key,
             "text": text,
             "annotator_topics": topics,
-            "generated_topics": topic_generator(text)
+            "generated_topics": generated_topics
         }
-        generated_all.append(generated)
-        logger.new_generated(generated)
+        if generator_settings is not None:
+            generated["generator-settings"] = generator_settings
+        if logger is not None:
+            logger.new_generated(generated, completion)
+        return generated
+
+    return await asyncio.gather(*(generate(text, topics, key) for text, topics, key in annotations))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Generates topics for annotated texts and evaluates them.")
+    parser.add_argument("--source", default="data/gold_annotated_dataset.json",
+                        help="Json with annotated texts. Default is gold dataset.")
+    parser.add_argument("--max-topic-generations", type=int, default=35)
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Maximum number of concurrent API requests.")
+    parser.add_argument("--log-dir", default="topic-generation-logs",
+                        help="Directory for generation logs and generated topics.")
+    parser.add_argument("--no-resume", action="store_true", default=False,
+                        help="Generate topics also for texts already generated with the same settings in --log-dir.")
+    add_cache_args(parser)
+    return parser.parse_args()
 
-    logger.finished_generation(generated_all)
 
-    # Evaluation
-    result = evaluator.get_results(generated_all)
-    logger.print_results(result)
+if __name__ == "__main__":
+    args = get_args()
+    max_topic_generations = args.max_topic_generations
+
+    save_to_file = True
+
+    # topic_generator should be callable which takes text as argument
+    # and returns list of topics on call
+    topic_generator = GptGenerator(llm_client_from_args(args))
+    evaluator = TopicEvaluator(BasicMetric(), CrossEncoderMetric())
+
+    generator_settings = topic_generator.settings_fingerprint()
+    annotations = list(get_annotations(args.source, num_iterations=max_topic_generations))
+    already_generated = {} if args.no_resume else load_generated_index(args.log_dir, generator_settings)
+    to_generate = [annotation for annotation in annotations if annotation[2] not in already_generated]
+    print(f"Topics for {len(annotations) - len(to_generate)}/{len(annotations)} texts were already generated "
+          f"with the same settings, generating {len(to_generate)}.")
+
+    with TopicGenerationLogger(topic_generator, evaluator, len(to_generate), to_file=save_to_file,
+                               log_dir=args.log_dir) as logger:
+        logger.print_settings()
+        # Generating topics using topic_generator
+        generated_new = asyncio.run(
+            generate_topics_async(topic_generator, to_generate, concurrency=args.concurrency, logger=logger,
+                                  generator_settings=generator_settings)
+        )
+
+        generated_by_id = {**already_generated, **{g["text-id"]: g for g in generated_new}}
+        generated_all = [generated_by_id[key] for _, _, key in annotations]
+        logger.finished_generation(generated_all)
+        logger.log(topic_generator.llm_client.report())
 
+        # Evaluation
+        result = evaluator.get_results(generated_all)
+        logger.print_results(result)
@@ -1,55 +1,169 @@
 import functools
+import glob
 import itertools
 import logging
-from contextlib import contextmanager
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
 from itertools import islice
 from datetime import datetime
+from urllib.parse import urlparse
 
-import pandas as pd
-import requests
 import json
 import curses
 
+import getting_user_input
+
 
 class TopicGenerationLogger:
-    def __init__(self, topic_generator, topic_evaluator, max_topic_generations, to_file=True):
+    """
+    Logs topic generation as JSONL events into one buffered file. Each event has `event` name,
+    wall-clock `time` and `elapsed` seconds since logger creation. Buffer is flushed when it holds
+    more than `flush_bytes` or when `flush_interval` seconds passed since the last flush.
+    Use as context manager or call `close` to flush and close the file.
+    """
+
+    def __init__(self, topic_generator, topic_evaluator, max_topic_generations, to_file=True,
+                 flush_interval=5.0, flush_bytes=64 * 1024, log_dir="."):
         self.topic_generator = topic_generator
         self.topic_evaluator = topic_evaluator
         self.max_topic_generations = max_topic_generations
         self.generated_num = 1
         self.to_file = to_file
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
         time_string = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
-        self.file_logging = f"{time_string}-generation.log"
-        self.file_results = f"{time_string}-generated-topics.json"
+        self.file_logging = os.path.join(log_dir, f"{time_string}-generation.jsonl")
+        self.file_results = os.path.join(log_dir, f"{time_string}-generated-topics.json")
+        # Generated records are appended here as soon as they are generated, so interrupted run can be resumed
+        self.file_results_stream = os.path.join(log_dir, f"{time_string}-generated-topics.jsonl")
+
+        self.start = time.monotonic()
+        self.last_flush = self.start
+        self.unflushed_bytes = 0
+        if to_file:
+            os.makedirs(log_dir, exist_ok=True)
+            self.log_file = open(self.file_logging, "a", encoding="utf-8")
+            self.results_stream = open(self.file_results_stream, "a", encoding="utf-8")
+        else:
+            self.log_file = None
+            self.results_stream = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_event(self, event, **fields):
+        if self.log_file is None:
+            return
+        now = time.monotonic()
+        record = {
+            "event": event,
+            "time": datetime.now().isoformat(timespec="milliseconds"),
+            "elapsed": round(now - self.start, 3),
+            **fields,
+        }
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        self.log_file.write(line)
+        self.unflushed_bytes += len(line)
+        if self.unflushed_bytes >= self.flush_bytes or now - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.log_file is not None:
+            self.log_file.flush()
+        self.unflushed_bytes = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        if self.log_file is not None:
+            self.flush()
+            self.log_file.close()
+            self.log_file = None
+        if self.results_stream is not None:
+            self.results_stream.close()
+            self.results_stream = None
 
     def print_results(self, result):
-        self.log("Evaluation results:")
-        self.log(result)
+        print("Evaluation results:")
+        print(result)
+        self.write_event("results", results=json.loads(result) if isinstance(result, str) else result)
 
     def print_settings(self):
-        self.topic_generator.get_settings_repr()
-
-    def new_generated(self, generated):
+        settings = self.topic_generator.get_settings_repr()
+        print(settings)
+        self.write_event("settings", settings=settings)
+
+    def new_generated(self, generated, completion=None):
+        """
+        Logs generated record.
+        :param generated: Record with generated topics
+        :param completion: Optional `llm_client.Completion` of the request, adds latency and token counts
+        """
         if self.generated_num == 1:
-            time_string = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-            self.log(f"\n\nGenerating started at {time_string}")
+            self.write_event("generation_started")
+
+        request = {}
+        if completion is not None:
+            request = {
+                "latency": round(completion.latency, 3),
+                "cached": completion.cached,
+                "usage": completion.usage,
+            }
+
+        message = f"Generated {self.generated_num}/{self.max_topic_generations}"
+        if completion is not None:
+            tokens = completion.usage["total_tokens"] if completion.usage else "?"
+            message += f" ({completion.latency:.2f}s, {tokens} tokens{', cached' if completion.cached else ''})"
+        print(message)
 
-        # Print log to stdout
-        self.log(f"Generated {self.generated_num}/{self.max_topic_generations}")
-        self.log(json.dumps(generated, indent=4, ensure_ascii=False))
+        self.write_event("generated", number=self.generated_num, record=generated, **request)
+        if self.results_stream is not None:
+            # Flushed right away, record must survive interruption of the run
+            self.results_stream.write(json.dumps(generated, ensure_ascii=False) + "\n")
+            self.results_stream.flush()
         self.generated_num += 1
 
     def log(self, message):
         print(message)
-        if self.to_file:
-            print(message, file=open(self.file_logging, 'a'))
+        self.write_event("message", message=message)
 
     def finished_generation(self, generated_all):
+        self.write_event("generation_finished", generated=len(generated_all), results_file=self.file_results)
+        self.flush()
         with open(self.file_results, 'w') as outfile:
             json.dump(generated_all, outfile, indent=4, ensure_ascii=False)
 
 
+def load_generated_index(log_dir, generator_settings):
+    """
+    Finds texts with topics already generated with the same generator settings in
+    `*-generated-topics.jsonl` files of earlier runs.
+    :param log_dir: Directory with generation logs
+    :param generator_settings: Fingerprint of generator settings, stored in `generator-settings` of each record
+    :return: Dict which maps text id to generated record
+    """
+    index = {}
+    for path in sorted(glob.glob(os.path.join(log_dir, "*-generated-topics.jsonl"))):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line of interrupted run might be written only partially
+                    continue
+                if record.get("generator-settings") == generator_settings:
+                    index[record["text-id"]] = record
+    return index
+
+
 def find_topics(item):
     for child in item.values():
         if isinstance(child, dict) and 'topics' in child:
@@ -57,57 +171,342 @@ def find_topics(item):
     return None
 
 
+def iter_json(file_path, chunk_size=1 << 16):
+    """
+    Parses json file incrementally, only one item of the top-level container is kept in memory.
+    :return: Iterator of items for top-level array, iterator of (key, value) tuples for top-level object
+    """
+    decoder = json.JSONDecoder()
+    whitespace = " \t\n\r"
+    with open(file_path, "r", encoding="utf-8") as f:
+        buffer = ""
+        pos = 0
+        eof = False
+
+        def fill():
+            nonlocal buffer, pos, eof
+            # Reading at least the buffered length keeps parsing of values longer than one chunk linear
+            chunk = f.read(max(chunk_size, len(buffer) - pos))
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            eof = chunk == ""
+
+        def next_char():
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos] in whitespace:
+                    pos += 1
+                if pos < len(buffer):
+                    return buffer[pos]
+                if eof:
+                    raise ValueError(f"Unexpected end of {file_path}")
+                fill()
+
+        def value():
+            nonlocal pos
+            next_char()
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    fill()
+                    continue
+                # Number cut at the end of buffer might continue in the next chunk
+                if not eof and (end == len(buffer) or buffer[end] in "0123456789.eE+-"):
+                    fill()
+                    continue
+                pos = end
+                return item
+
+        def expect(chars):
+            nonlocal pos
+            char = next_char()
+            if char not in chars:
+                raise ValueError(f"Expected one of '{chars}' at '{buffer[pos:pos + 20]}' in {file_path}")
+            pos += 1
+            return char
+
+        is_object = expect("[{") == "{"
+        closing = "}" if is_object else "]"
+        if next_char() == closing:
+            return
+        while True:
+            if is_object:
+                key = value()
+                expect(":")
+                yield key, value()
+            else:
+                yield value()
+            if expect("," + closing) == closing:
+                return
+
+
+def read_records(file_path):
+    """
+    Reads records of json array or jsonl file one by one.
+    """
+    if file_path.endswith(".jsonl"):
+        with open(file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        yield from iter_json(file_path)
+
+
+def write_records(records, file_path):
+    """
+    Writes records as they are generated, to jsonl file or to json array formatted as `json.dump` with indent 4.
+    The file is replaced atomically, so records may be read from the previous version of it.
+    :return: Number of written records
+    """
+    jsonl = file_path.endswith(".jsonl")
+    count = 0
+    with open(file_path + ".tmp", "w", encoding="utf-8") as f:
+        for record in records:
+            if jsonl:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            else:
+                item = json.dumps(record, indent=4, ensure_ascii=False).replace("\n", "\n    ")
+                f.write(("[\n    " if count == 0 else ",\n    ") + item)
+            count += 1
+        if not jsonl:
+            f.write("\n]" if count else "[]")
+    os.replace(file_path + ".tmp", file_path)
+    return count
+
+
 def get_annotations(file_path, num_iterations=None):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-        for key, value in islice(data.items(), num_iterations):
-            topics = value['topics']
-            if topics is not None:
-                yield value['text'], topics, key
+    for key, value in islice(iter_json(file_path), num_iterations):
+        topics = value['topics']
+        if topics is not None:
+            yield value['text'], topics, key
+
+
+class EndpointMetrics:
+    """
+    Latency of API requests per endpoint. Ids in paths are replaced by `{id}`,
+    so all requests for task instances are counted as one endpoint.
+    """
+    R_ID = re.compile(r"/(?:[0-9a-fA-F-]{32,36}|\d+)(?=/|$)")
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.retries = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def endpoint(cls, method, url):
+        return f"{method} {cls.R_ID.sub('/{id}', urlparse(url).path)}"
+
+    def add(self, endpoint, latency, error=False, retried=False):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + int(error)
+            self.retries[endpoint] = self.retries.get(endpoint, 0) + int(retried)
+
+    def report(self):
+        lines = []
+        with self.lock:
+            for endpoint, latencies in sorted(self.latencies.items()):
+                latencies = sorted(latencies)
+                p50 = latencies[len(latencies) // 2]
+                p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+                lines.append(
+                    f"{endpoint}: {len(latencies)} requests, {self.retries[endpoint]} retried, "
+                    f"{self.errors[endpoint]} failed, p50 {p50 * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms, "
+                    f"max {latencies[-1] * 1000:.0f} ms"
+                )
+        return "\n".join(lines)
 
 
 class Annotator_API():
-    def __init__(self, base_url: str, login: str, password: str):
+    """
+    Client of the annotation API. One session with a pool of kept-alive connections is shared by all requests
+    of `API_session`, also by requests from several threads. Expired login is renewed once for all threads,
+    failed renewal falls back to a new login. Requests failed with connection error, 429 or 5xx are retried
+    with jittered exponential backoff. Latency of requests is collected per endpoint, see `report`.
+    """
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url: str, login: str, password: str, pool_size: int = 10, max_retries: int = 5,
+                 backoff: float = 0.5, max_backoff: float = 30.0, timeout: float = 60.0):
+        """
+        :param pool_size: Number of kept-alive connections, set to number of threads sharing the session
+        :param max_retries: Number of retries of one request
+        :param backoff: Base of exponential backoff in seconds, the wait is random up to `backoff * 2 ** attempt`
+        """
         self.base_url = base_url
         self.login = login
         self.password = password
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
         self.session = None
+        self.metrics = EndpointMetrics()
+        self.auth_lock = threading.Lock()
+        # Incremented by every login or renewal, requests started with older login do not renew it again
+        self.auth_generation = 0
 
     def login_token(self):
         login_request = self.session.post(self.base_url + '/api/token',
-                                          data={'username': self.login, 'password': self.password}, verify=False)
+                                          data={'username': self.login, 'password': self.password}, verify=False,
+                                          timeout=self.timeout)
         if login_request.status_code != 200:
             logging.error(f'Failed to login: {login_request.status_code} {login_request.text}')
             raise Exception(f'Failed to login: {login_request.status_code} {login_request.text}')
+        self.auth_generation += 1
+
+    def renew_token(self, generation):
+        with self.auth_lock:
+            if generation != self.auth_generation:
+                return  # Renewed by another thread meanwhile
+            response = self.session.post(self.base_url + '/api/token/renew', timeout=self.timeout)
+            if response.status_code == 200:
+                self.auth_generation += 1
+                return
+            logging.warning(f'Failed to renew token: {response.status_code} {response.text}, logging in again')
+            self.login_token()
 
     @contextmanager
     def API_session(self):
+        # Imported here, TUI tools importing utils do not need HTTP client
+        import requests
+
         try:
             self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
             self.login_token()
             yield self
         finally:
             if self.session:
                 self.session.close()
 
-    def get(self, url: str):
-        response = self.session.get(url)
-        if response.status_code == 401:
-            self.session.post(self.base_url + '/api/token/renew')
-            if response.status_code != 200:
-                raise Exception(f'Failed to renew token: {response.status_code} {response.text}')
-            response = self.session.get(url)
+    def backoff_time(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def request(self, method, url, **kwargs):
+        import requests
+
+        endpoint = self.metrics.endpoint(method, url)
+        for attempt in range(self.max_retries + 1):
+            generation = self.auth_generation
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.metrics.add(endpoint, time.perf_counter() - start, error=True, retried=attempt > 0)
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.backoff_time(attempt))
+                continue
+
+            failed = response.status_code == 401 or response.status_code in self.RETRY_STATUSES
+            self.metrics.add(endpoint, time.perf_counter() - start, error=failed, retried=attempt > 0)
+            if response.status_code == 401 and attempt < self.max_retries:
+                self.renew_token(generation)
+            elif response.status_code in self.RETRY_STATUSES and attempt < self.max_retries:
+                time.sleep(self.backoff_time(attempt, response))
+            else:
+                return response
         return response
 
+    def get(self, url: str):
+        return self.request("GET", url)
+
     def post(self, url: str, data: dict):
-        response = self.session.post(url, json=data, verify=False)
-        if response.status_code == 401:
-            self.session.post(self.base_url + '/api/token/renew')
-            if response.status_code != 200:
-                raise Exception(f'Failed to renew token: {response.status_code} {response.text}')
-            response = self.session.post(url, json=data)
+        return self.request("POST", url, json=data, verify=False)
+
+    def report(self):
+        return self.metrics.report()
+
+
+class AsyncAnnotator_API(Annotator_API):
+    """
+    Asyncio variant of `Annotator_API` with the same interface for bulk scraping, use `async with api.API_session()`
+    and await `get` and `post`. Requests share one httpx client with `pool_size` kept-alive connections.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.auth_lock = None
+
+    async def login_token(self):
+        login_request = await self.session.post(self.base_url + '/api/token',
+                                                data={'username': self.login, 'password': self.password})
+        if login_request.status_code != 200:
+            logging.error(f'Failed to login: {login_request.status_code} {login_request.text}')
+            raise Exception(f'Failed to login: {login_request.status_code} {login_request.text}')
+        self.auth_generation += 1
+
+    async def renew_token(self, generation):
+        async with self.auth_lock:
+            if generation != self.auth_generation:
+                return
+            response = await self.session.post(self.base_url + '/api/token/renew')
+            if response.status_code == 200:
+                self.auth_generation += 1
+                return
+            logging.warning(f'Failed to renew token: {response.status_code} {response.text}, logging in again')
+            await self.login_token()
+
+    @asynccontextmanager
+    async def API_session(self):
+        import asyncio
+
+        import httpx
+
+        limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+        # Certificate verification is disabled as for login and POST requests of the blocking client
+        async with httpx.AsyncClient(limits=limits, timeout=self.timeout, verify=False) as self.session:
+            self.auth_lock = asyncio.Lock()
+            await self.login_token()
+            yield self
+
+    async def request(self, method, url, **kwargs):
+        import asyncio
+
+        import httpx
+
+        endpoint = self.metrics.endpoint(method, url)
+        for attempt in range(self.max_retries + 1):
+            generation = self.auth_generation
+            start = time.perf_counter()
+            try:
+                response = await self.session.request(method, url, **kwargs)
+            except httpx.TransportError:
+                self.metrics.add(endpoint, time.perf_counter() - start, error=True, retried=attempt > 0)
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self.backoff_time(attempt))
+                continue
+
+            failed = response.status_code == 401 or response.status_code in self.RETRY_STATUSES
+            self.metrics.add(endpoint, time.perf_counter() - start, error=failed, retried=attempt > 0)
+            if response.status_code == 401 and attempt < self.max_retries:
+                await self.renew_token(generation)
+            elif response.status_code in self.RETRY_STATUSES and attempt < self.max_retries:
+                await asyncio.sleep(self.backoff_time(attempt, response))
+            else:
+                return response
         return response
 
+    async def get(self, url: str):
+        return await self.request("GET", url)
+
+    async def post(self, url: str, data: dict):
+        return await self.request("POST", url, json=data)
+
 
 class GoldDatasetCreator:
     def __call__(self, *args, **kwargs):
@@ -212,28 +611,55 @@ class GoldDatasetConvertor:
                   indent=4, ensure_ascii=False)
 
 
-def clean_dataset():
-    f = open('data/out.json')
-
-    data = json.load(f)
+def clean_text(text_id, annotated_text):
+    """
+    :return: List of records with nonempty topics of one annotated text, one record per annotation
+    """
+    annotation_ids = [k for k in annotated_text.keys() if k not in ["text", "text_id"]]
+    annotations = []
+    for an_id in annotation_ids:
+        annotations.append(annotated_text[an_id])
     data_list = []
-    for text_id, annotated_text in data.items():
-        annotation_ids = [k for k in annotated_text.keys() if k not in ["text", "text_id"]]
-        annotations = []
-        for an_id in annotation_ids:
-            annotations.append(annotated_text[an_id])
-        for annotation in annotations:
-            new_text = {
-                'text_id': text_id,
-                'text': annotated_text['text'],
-                'user_id': annotation["user_id"],
-                'user_topics': [t for t in annotation["topics"] if t != ""],
-            }
-            if len(new_text['user_topics']) != 0:
-                data_list.append(new_text)
-
-    with open("data/out-clean.json", "w") as f:
-        json.dump(data_list, f, ensure_ascii=False, indent=4)
+    for annotation in annotations:
+        new_text = {
+            'text_id': text_id,
+            'text': annotated_text['text'],
+            'user_id': annotation["user_id"],
+            'user_topics': [t for t in annotation["topics"] if t != ""],
+        }
+        if len(new_text['user_topics']) != 0:
+            data_list.append(new_text)
+    return data_list
+
+
+def clean_records(source="data/out.json", previous_output=None, text_ids=None):
+    """
+    Generates cleaned records of scraped data text by text.
+    :param previous_output: Output of the previous run, records of texts not in `text_ids` are taken from it
+    :param text_ids: Texts changed since the previous run
+    """
+    previous = iter(()) if previous_output is None or not os.path.exists(previous_output) else read_records(previous_output)
+    pending = next(previous, None)
+    for text_id, annotated_text in iter_json(source):
+        # Previous output lists texts in the same order as the source, so it is merged in one pass
+        reused = []
+        while pending is not None and pending["text_id"] == text_id:
+            reused.append(pending)
+            pending = next(previous, None)
+        if text_ids is None or text_id in text_ids or not reused:
+            yield from clean_text(text_id, annotated_text)
+        else:
+            yield from reused
+
+
+def clean_dataset(source="data/out.json", output="data/out-clean.json", text_ids=None):
+    """
+    Removes annotations without topics from scraped data. Texts are streamed, memory holds only one of them.
+    :param output: Json array, or jsonl when the file name ends with `.jsonl`
+    :param text_ids: Texts changed since the last run, records of other texts are taken from existing output
+    """
+    previous_output = output if text_ids is not None else None
+    return write_records(clean_records(source, previous_output, text_ids), output)
 
 
 def addstr_wordwrap(window, s, mode=0):
@@ -241,26 +667,13 @@ def addstr_wordwrap(window, s, mode=0):
 
     Add a string to a curses window with given dimensions. If mode is given
     (e.g. curses.A_BOLD), then format text accordingly. We do very
-    rudimentary wrapping on word boundaries.
+    rudimentary wrapping on word boundaries, wrapped lines are cached by `wrap_lines`.
 
     Raise WindowFullException if we run out of room.
     """
-    height, width = window.getmaxyx()
+    _, width = window.getmaxyx()
     (y, x) = window.getyx() # Coords of cursor
-    # If the whole string fits on the current line, just add it all at once
-    if len(s) + x <= width:
-        window.addstr(s, mode)
-    # Otherwise, split on word boundaries and write each token individually
-    else:
-        for word in words_and_spaces(s):
-            if len(word) + x <= width:
-                window.addstr(word, mode)
-            else:
-                if y == height-1:
-                    # Can't go down another line
-                    raise curses.error("Window full")
-                window.addstr(y+1, 0, word, mode)
-            (y, x) = window.getyx()
+    addstr_lines(window, wrap_lines(s, width, x), mode)
 
 def words_and_spaces(s):
     """
@@ -271,22 +684,257 @@ def words_and_spaces(s):
     return list(itertools.chain.from_iterable(zip(s.split(' '), itertools.repeat(' '))))[:-1]
 
 
-def curses_overflow_restarts(func, attempts=100):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        assert attempts > 0
-        for attempt in range(attempts):
+@functools.lru_cache(maxsize=1024)
+def wrap_lines(s, width, x=0):
+    """
+    Splits string into lines of at most `width` characters on word boundaries, the same way
+    `addstr_wordwrap` does. Words longer than a line are split.
+    :param x: Column where the first line starts
+    :return: Tuple of lines, cached for repeated strings like controls and prompts
+    """
+    lines = []
+    capacity = width - x
+    for paragraph in s.split("\n"):
+        line = ""
+        for word in words_and_spaces(paragraph):
+            while len(line) + len(word) > capacity and len(word) > width:
+                lines.append(line)
+                line, word, capacity = word[:width], word[width:], width
+            if len(line) + len(word) <= capacity:
+                line += word
+            else:
+                lines.append(line)
+                line, capacity = word, width
+        lines.append(line)
+        capacity = width
+    return tuple(lines)
+
+
+def addstr_lines(window, lines, mode=0):
+    """
+    Adds lines created by `wrap_lines` at the cursor, the cursor is left after the last line.
+    Raises curses.error if the window is full.
+    """
+    height, width = window.getmaxyx()
+    y, x = window.getyx()
+    for i, line in enumerate(lines):
+        if y + i >= height:
+            raise curses.error("Window full")
+        if line:
+            window.addstr(y + i, x if i == 0 else 0, line, mode)
+    y, x = y + len(lines) - 1, (x if len(lines) == 1 else 0) + len(lines[-1])
+    if x >= width:
+        y, x = y + 1, 0
+        if y >= height:
+            raise curses.error("Window full")
+    window.move(y, x)
+
+
+class Prefetcher:
+    """
+    Prepares items ahead of time in a background thread, so the next screen of annotation TUI is ready
+    when the user finishes the current one. Iterating yields `prepare(item)` for items in order,
+    at most `ahead` prepared items are kept waiting. Exception raised by `prepare` is re-raised by iteration.
+    """
+
+    _done = object()
+
+    def __init__(self, items, prepare, ahead=4):
+        self.items = items
+        self.prepare = prepare
+        self.queue = queue.Queue(maxsize=ahead)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def put(self, value):
+        # Waits for free slot, but gives up when iteration was stopped
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def work(self):
+        try:
+            for item in self.items:
+                if not self.put((self.prepare(item), None)):
+                    return
+        except Exception as e:
+            self.put((None, e))
+            return
+        self.put((self._done, None))
+
+    def __iter__(self):
+        while True:
+            prepared, error = self.queue.get()
+            if error is not None:
+                raise error
+            if prepared is self._done:
+                return
+            yield prepared
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class BackgroundWriter:
+    """
+    Runs save jobs in order in a background thread, so the annotation TUI does not wait for disk writes.
+    Exception of a failed job is re-raised by the next `submit` or by `close`, which waits for all jobs.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            func, args = job
             try:
-                return func(*args, **kwargs)
-            except curses.error:
-                pass  # Try again in next loop
-        if attempt == attempts - 1:
-            print(
-                "Curses error, exiting to prevent terminal corruption."
-                "Try increasing the terminal size."
-            )
+                func(*args)
+            except Exception as e:
+                self.error = e
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, func, *args):
+        self.raise_error()
+        self.queue.put((func, args))
 
-    return wrapper
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PadScreen:
+    """
+    Drawing surface of annotation TUIs. Content is drawn into a curses pad and copied to the terminal only
+    when a key is read, so a sequence of changes reaches the terminal as one update of changed cells.
+    `clear` only erases the pad, unlike `window.clear` it does not force repainting of the whole terminal.
+
+    The pad grows with its content, so long texts and topic lists never overflow it. The terminal shows
+    a viewport of the pad which follows the cursor and can be scrolled with arrow keys and PgUp/PgDn
+    while a key is awaited. Other methods, e.g. `move` or `getyx`, are those of the pad.
+    """
+
+    # Largest pad ncurses can create
+    max_rows = 32767
+    scroll_keys = {curses.KEY_UP: -1, curses.KEY_DOWN: 1}
+    page_keys = {curses.KEY_PPAGE: -1, curses.KEY_NPAGE: 1}
+
+    def __init__(self, screen):
+        self.screen = screen
+        height, width = screen.getmaxyx()
+        self.pad = curses.newpad(height, width)
+        self.pad.keypad(True)
+        self.top = 0
+        # Called after the terminal was resized, e.g. to redraw the content wrapped to the new width
+        self.on_resize = None
+
+    def __getattr__(self, name):
+        return getattr(self.pad, name)
+
+    def getmaxyx(self):
+        _, width = self.screen.getmaxyx()
+        return self.max_rows, width
+
+    def resize(self):
+        """
+        Resizes the pad to the width of the terminal and redraws the content by `on_resize`.
+        """
+        _, width = self.screen.getmaxyx()
+        height, _ = self.pad.getmaxyx()
+        self.pad.resize(height, width)
+        if self.on_resize is not None:
+            self.on_resize()
+
+    def ensure_rows(self, rows):
+        height, width = self.pad.getmaxyx()
+        if rows > height:
+            self.pad.resize(min(self.max_rows, max(rows, 2 * height)), width)
+
+    def addstr(self, *args):
+        if isinstance(args[0], int):
+            y, s = args[0], args[2]
+        else:
+            y, s = self.pad.getyx()[0], args[0]
+        _, width = self.pad.getmaxyx()
+        # Room for all lines of the string, also when they wrap, and for the cursor after it
+        self.ensure_rows(y + s.count("\n") + len(s) // width + 2)
+        self.pad.addstr(*args)
+
+    def move(self, y, x):
+        self.ensure_rows(y + 2)
+        self.pad.move(y, x)
+
+    def clear(self):
+        self.pad.erase()
+        self.top = 0
+
+    def follow_cursor(self):
+        height, _ = self.screen.getmaxyx()
+        y, _ = self.pad.getyx()
+        if y < self.top:
+            self.top = y
+        elif y >= self.top + height:
+            self.top = y - height + 1
+
+    def refresh(self):
+        height, width = self.screen.getmaxyx()
+        pad_height, pad_width = self.pad.getmaxyx()
+        self.pad.noutrefresh(
+            self.top, 0, 0, 0, min(height, pad_height - self.top) - 1, min(width, pad_width) - 1
+        )
+        curses.doupdate()
+
+    def scroll(self, lines):
+        height, _ = self.screen.getmaxyx()
+        y, _ = self.pad.getyx()
+        # Content ends at the cursor, which is on the last drawn line
+        self.top = max(0, min(self.top + lines, y + 1 - height))
+
+    def getch(self):
+        self.follow_cursor()
+        while True:
+            self.refresh()
+            # Reading from the pad does not refresh the screen window over the pad content
+            key = self.pad.getch()
+            height, _ = self.screen.getmaxyx()
+            if key in self.scroll_keys:
+                self.scroll(self.scroll_keys[key])
+            elif key in self.page_keys:
+                self.scroll(self.page_keys[key] * (height - 1))
+            elif key == curses.KEY_RESIZE:
+                self.resize()
+                self.follow_cursor()
+            else:
+                return key
 
 
 class CursesWindow:
@@ -300,7 +948,7 @@ class CursesWindow:
             logging.error("Error initializing curses, try increasing the terminal size.")
             raise
 
-        return self.crs
+        return PadScreen(self.crs)
 
     def __exit__(self, exc_type, exc_value, traceback):
         assert self.crs is not None
@@ -309,23 +957,39 @@ class CursesWindow:
 
 
 class ScreenOwner:
+    """
+    Screen of one annotated text. Header with statistics, controls and the text is drawn once by `redraw`,
+    body below it, e.g. list of annotations, is updated by `update_body`, which redraws only changed lines.
+    Question awaiting an answer is drawn below the body by `show_prompt`, so that `redraw` can draw it again.
+    Subclasses add to the header by overriding `draw_header` and provide body by `body_lines`.
+    """
     controls_string = ""
 
-    def __init__(self, crs, text, nb_left, nb_cleaned_this_session):
+    def __init__(self, crs, text, nb_left, nb_cleaned_this_session, text_layout=None):
+        """
+        :param text_layout: Tuple (width, lines) with text wrapped by `wrap_lines`, e.g. prepared by `Prefetcher`.
+            Text is wrapped again when the window width differs.
+        """
         self.crs = crs
         self.text = text
         self.nb_left = nb_left
         self.nb_cleaned_this_session = nb_cleaned_this_session
+        self.text_layout = text_layout
+        self.body_y = 0
+        self.body = []
+        self.prompt = ()
 
+        # Text and body are wrapped again to the new width when the terminal is resized
+        self.crs.on_resize = self.redraw
         self.redraw()
 
-    def redraw(self):
-        assert_message = "You must set the controls_string attribute in the subclass."
-        assert self.controls_string != "", assert_message
-
-        self.crs.clear()
-        self.crs.refresh()
+    def wrapped_text(self):
+        _, width = self.crs.getmaxyx()
+        if self.text_layout is None or self.text_layout[0] != width:
+            self.text_layout = (width, wrap_lines(self.text + "\n", width))
+        return self.text_layout[1]
 
+    def draw_header(self):
         self.crs.addstr("Statistics:\n", curses.A_BOLD)
         self.crs.addstr(f"You have cleaned {self.nb_cleaned_this_session} texts this session.\n")
         self.crs.addstr(f"There are {self.nb_left} texts left.\n\n")
@@ -333,9 +997,73 @@ class ScreenOwner:
         addstr_wordwrap(self.crs, self.controls_string, 0)
 
         self.crs.addstr("\nText:\n\n", curses.A_BOLD)
-        addstr_wordwrap(self.crs, self.text + "\n", 0)
+        addstr_lines(self.crs, self.wrapped_text())
         self.crs.addstr("\n\n")
 
+    def body_lines(self):
+        """
+        :return: List of body lines, each line is tuple of (string, curses attribute) segments
+        """
+        return []
+
+    def redraw(self):
+        assert_message = "You must set the controls_string attribute in the subclass."
+        assert self.controls_string != "", assert_message
+
+        prompt = self.prompt
+        self.crs.clear()
+        self.draw_header()
+        self.body_y, _ = self.crs.getyx()
+        self.body = []
+        self.update_body(self.body_lines())
+        self.prompt = prompt
+        self.draw_prompt()
+
+    def draw_prompt(self):
+        for segment, mode in self.prompt:
+            addstr_wordwrap(self.crs, segment, mode)
+
+    def show_prompt(self, *segments):
+        """
+        Draws (string, curses attribute) segments below the body, they stay on the screen until the body is updated.
+        """
+        self.prompt = segments
+        self.draw_prompt()
+
+    def accept_or_reject(self, question_string, *segments):
+        """
+        Shows segments, e.g. the topic in question, followed by the question and waits for y/n answer.
+        :raises SkipError: If the user wants to skip the current text
+        """
+        self.prompt = (*segments, (question_string, 0))
+        for segment, mode in segments:
+            addstr_wordwrap(self.crs, segment, mode)
+        return getting_user_input.accept_or_reject(self.crs, question_string)
+
+    def update_body(self, lines):
+        """
+        Draws body lines which differ from the drawn ones and erases everything below the body,
+        the cursor is left on the line after the body.
+        """
+        _, width = self.crs.getmaxyx()
+        y = self.body_y
+        body = []
+        for i, line in enumerate(lines):
+            rows = max(1, -(-sum(len(segment) for segment, _ in line) // width))
+            if i >= len(self.body) or self.body[i] != (line, y):
+                for row in range(y, y + rows):
+                    self.crs.move(row, 0)
+                    self.crs.clrtoeol()
+                self.crs.move(y, 0)
+                for segment, mode in line:
+                    self.crs.addstr(segment, mode)
+            body.append((line, y))
+            y += rows
+        self.body = body
+        self.crs.move(y, 0)
+        self.crs.clrtobot()
+        self.prompt = ()
+
 
 def print_job_done(crs):
     crs.clear()